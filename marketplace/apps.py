@@ -0,0 +1,21 @@
+from allauth.account.apps import AccountConfig as BaseAccountConfig
+from django.apps import AppConfig
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+class MarketplaceConfig(AppConfig):
+    name = 'marketplace'
+
+
+class AccountConfig(BaseAccountConfig):
+    """
+    allauth.account, installed as ``marketplace.apps.AccountConfig``.
+    allauth's ``ready()`` only checks that its own middleware path is in
+    ``MIDDLEWARE``; the async-capable subclass is listed instead.
+    """
+    required_middleware = 'marketplace.middleware.AccountMiddleware'
+
+    def ready(self):
+        if self.required_middleware not in settings.MIDDLEWARE:
+            raise ImproperlyConfigured(f'{self.required_middleware} must be added to settings.MIDDLEWARE')
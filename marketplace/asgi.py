@@ -1,5 +1,18 @@
 """
 ASGI config for marketplace project.
+
+Serves the async catalog, cart and checkout views (``ASYNC_VIEWS``
+defaults to on here): checkout waits on Stripe without holding a worker
+thread, and catalog pages answer revalidations with a 304 without one.
+This is what the Procfile runs. Run it with uvicorn, either directly or as
+gunicorn workers:
+
+    uvicorn marketplace.asgi:application --host 0.0.0.0 --port 8000 --workers 4
+    gunicorn marketplace.asgi:application -k uvicorn.workers.UvicornWorker --workers 4
+
+Everything else (search, accounts, admin) stays synchronous and is run by
+Django in a thread per request, as under WSGI. Static files are served by
+``marketplace.middleware.StaticFilesMiddleware`` either way.
 """
 
 import os
@@ -7,5 +20,11 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'marketplace.settings')
+os.environ.setdefault('ASYNC_VIEWS', 'True')
+
+application = get_asgi_application()
+
+# Build the listing's facet index before this process serves requests.
+from products.facets import warm_up  # noqa: E402
 
-application = get_asgi_application()
\ No newline at end of file
+warm_up()
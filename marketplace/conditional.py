@@ -0,0 +1,113 @@
+"""
+Conditional GET (``ETag``/``Last-Modified``) for pages whose content has a
+cheap version stamp.
+
+A view using ``ConditionalGetMixin`` implements ``get_validators``, which
+returns what its content depends on (e.g. the catalog generation, an
+``updated_at``) and when that last changed, without building the page and
+with at most one small query. The mixin adds what the shared layout
+depends on: the visitor, their pricing tier, the cart badge and
+``RELEASE_VERSION``. A matching ``If-None-Match`` or ``If-Modified-Since``
+is answered with a 304 before the view runs any of its own queries;
+otherwise the validators are sent with the full response.
+
+Pages are marked ``private, no-cache`` so browsers revalidate each time.
+``Last-Modified`` is only sent to visitors without a session-specific
+layout (no login, empty cart), since it can't see layout changes. A
+request with flash messages waiting is always rendered in full.
+
+``AsyncConditionalGetMixin`` does the same for async views: the 304 is
+answered from the event loop, with the session, cart and validators read
+in short ``sync_to_async`` calls, and only a full page is built by the
+synchronous view, in one thread.
+"""
+import datetime
+import hashlib
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from products.models import get_price_tier
+
+
+class ConditionalGetMixin:
+
+    def get_validators(self):
+        """
+        Return ``(parts, last_modified)``: values that change whenever the
+        page content does, and a datetime or timestamp (or None). Return
+        None to skip conditional handling for this request.
+        """
+        raise NotImplementedError
+
+    def get(self, request, *args, **kwargs):
+        if len(get_messages(request)):
+            return super().get(request, *args, **kwargs)
+        validators = self.get_validators()
+        if validators is None:
+            return super().get(request, *args, **kwargs)
+        cart = getattr(request, 'cart', None)
+        etag, last_modified = self.conditional_headers(request.user, len(cart) if cart is not None else 0, validators)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = super().get(request, *args, **kwargs)
+        return self.add_conditional_headers(response, etag, last_modified)
+
+    def conditional_headers(self, user, cart_size, validators):
+        """The ``ETag`` and ``Last-Modified`` timestamp (or None) for this visitor."""
+        parts, last_modified = validators
+        etag_source = '|'.join(str(part) for part in (
+            settings.RELEASE_VERSION, user.pk or '', get_price_tier(user), cart_size, *parts,
+        ))
+        etag = f'W/"{hashlib.md5(etag_source.encode()).hexdigest()}"'
+        if isinstance(last_modified, datetime.datetime):
+            last_modified = last_modified.timestamp()
+        if user.is_authenticated or cart_size or last_modified is None:
+            return etag, None
+        return etag, int(last_modified)
+
+    def add_conditional_headers(self, response, etag, last_modified):
+        if response.status_code in (200, 304):
+            response.headers.setdefault('ETag', etag)
+            if last_modified is not None:
+                response.headers.setdefault('Last-Modified', http_date(last_modified))
+            patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def get_full_response(self, request, *args, **kwargs):
+        """The page itself, as the view under this mixin renders it."""
+        return super().get(request, *args, **kwargs)
+
+
+def _has_messages(request):
+    # Loads the session (and so may query the database) for the fallback storage.
+    return bool(len(get_messages(request)))
+
+
+class AsyncConditionalGetMixin(ConditionalGetMixin):
+    """
+    ``ConditionalGetMixin`` for an async view built on a synchronous one
+    (``class AsyncPage(AsyncConditionalGetMixin, Page)``).
+    """
+
+    async def aget_validators(self):
+        return await sync_to_async(self.get_validators)()
+
+    async def get(self, request, *args, **kwargs):
+        full_response = sync_to_async(self.get_full_response)
+        if await sync_to_async(_has_messages)(request):
+            return await full_response(request, *args, **kwargs)
+        validators = await self.aget_validators()
+        if validators is None:
+            return await full_response(request, *args, **kwargs)
+        user = await request.auser()
+        cart = getattr(request, 'cart', None)
+        cart_size = await cart.acount() if cart is not None else 0
+        etag, last_modified = self.conditional_headers(user, cart_size, validators)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = await full_response(request, *args, **kwargs)
+        return self.add_conditional_headers(response, etag, last_modified)
@@ -0,0 +1,56 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from orders import rollups
+
+
+class Command(BaseCommand):
+    """
+    Counts orders the sales rollups don't have yet, oldest first, one
+    transaction per batch. Each batch marks its orders as counted, so the
+    command can be stopped (or limited with --max-batches) and run again to
+    carry on where it left off. --rebuild forgets the range's rollups first,
+    to recount it from scratch (e.g. after products moved category).
+    """
+    help = 'Backfills the sales analytics rollups from existing orders.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='day_from', type=datetime.date.fromisoformat,
+                            help='First day to count (YYYY-MM-DD).')
+        parser.add_argument('--to', dest='day_to', type=datetime.date.fromisoformat,
+                            help='Last day to count (YYYY-MM-DD).')
+        parser.add_argument('--batch-size', type=int, default=1000, help='Orders per transaction.')
+        parser.add_argument('--max-batches', type=int, help='Stop after this many batches.')
+        parser.add_argument('--rebuild', action='store_true',
+                            help="Forget the range's rollups before counting it again.")
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        day_from, day_to = options['day_from'], options['day_to']
+        if day_from and day_to and day_from > day_to:
+            raise CommandError('--from must not be after --to.')
+        if options['rebuild']:
+            forgotten = rollups.reset(day_from, day_to)
+            self.stdout.write(f'Forgot the rollups of {forgotten} order(s).')
+
+        remaining = rollups.pending(day_from, day_to)
+        self.stdout.write(f'{remaining} order(s) to count.')
+        start = time.perf_counter()
+        counted = batches = 0
+        while options['max_batches'] is None or batches < options['max_batches']:
+            count = rollups.backfill(options['batch_size'], day_from, day_to)
+            if not count:
+                break
+            counted += count
+            batches += 1
+            elapsed = time.perf_counter() - start
+            self.stdout.write(f'  {counted}/{remaining} order(s) counted ({counted / elapsed:.0f}/s).')
+        left = rollups.pending(day_from, day_to)
+        message = f'Counted {counted} order(s) in {time.perf_counter() - start:.1f}s'
+        if left:
+            self.stdout.write(self.style.WARNING(f'{message}; {left} left, run again to continue.'))
+        else:
+            self.stdout.write(self.style.SUCCESS(f'{message}.'))
@@ -0,0 +1,218 @@
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter
+from decimal import Decimal
+from importlib import import_module
+
+import django
+import httpx
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.urls import reverse
+from django.utils import timezone
+
+from orders.models import Cart
+from products.models import Category, Product
+
+from .bench_storefront import percentile
+
+SERVERS = {
+    # Sync workers: one request at a time per process, as on the current deployment.
+    'wsgi': ['-m', 'gunicorn', 'marketplace.wsgi:application', '--worker-class', 'sync'],
+    'asgi': ['-m', 'uvicorn', 'marketplace.asgi:application', '--no-access-log'],
+}
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Command(BaseCommand):
+    """
+    Compares checkout throughput of the sync views under gunicorn's sync
+    workers (WSGI) with the async views under uvicorn (ASGI), each with the
+    same number of worker processes and the fake Stripe backend sleeping
+    --latency seconds per call, as a slow network round trip would.
+
+    Each simulated customer fetches a product page (for the CSRF cookie),
+    adds two products to their cart and then posts the checkout form
+    repeatedly. The servers run as subprocesses against the configured
+    database, so the seeded products, carts and sessions are committed and
+    deleted again at the end unless --keep is given.
+
+    Point DATABASE_URL at PostgreSQL for meaningful numbers: SQLite lets
+    one process write at a time and fails some concurrent checkouts with
+    "database is locked" (counted under ``errors``).
+
+    Run with DEBUG=True or after collectstatic, since templates resolve
+    static files through the configured storage.
+    """
+    help = 'Benchmarks checkout throughput under WSGI sync workers and ASGI async views.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--servers', nargs='+', choices=list(SERVERS), default=list(SERVERS))
+        parser.add_argument('--workers', type=int, default=2, help='Worker processes per server.')
+        parser.add_argument('--concurrency', type=int, default=50, help='Simultaneous customers.')
+        parser.add_argument('--requests', type=int, default=5, help='Checkouts per customer.')
+        parser.add_argument('--latency', type=float, default=0.3, help='Fake Stripe latency in seconds.')
+        parser.add_argument('--output', default='bench_async_checkout.json')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data.')
+
+    def handle(self, *args, **options):
+        seed = self.seed(options)
+        session_keys = set()
+        results = []
+        try:
+            self.stdout.write(f'{"server":<6} {"ok":>6} {"errors":>7} {"req/s":>8} '
+                              f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+            for server in options['servers']:
+                result = self.bench(server, seed, options, session_keys)
+                results.append(result)
+                latencies = ' '.join(f'{result[k] or 0:>8.1f}' for k in ('p50_ms', 'p95_ms', 'p99_ms'))
+                self.stdout.write(f'{server:<6} {result["ok"]:>6} {result["errors"]:>7} '
+                                  f'{result["throughput_rps"]:>8.1f} {latencies}')
+                for message, count in result['error_messages'].items():
+                    self.stderr.write(f'       {count} x {message}')
+        finally:
+            if not options['keep']:
+                self.cleanup(seed, session_keys)
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {k: options[k] for k in ('workers', 'concurrency', 'requests', 'latency')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def seed(self, options):
+        tag = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Bench async {tag}', slug=f'bench-async-{tag}')
+        products = Product.objects.bulk_create([
+            Product(name=f'Bench async product {i}', slug=f'bench-async-{tag}-{i}',
+                    description='Lorem ipsum dolor sit amet.', price=Decimal('19.99'),
+                    category=category, stock=options['concurrency'] * 10)
+            for i in range(2)
+        ])
+        return {'category': category, 'products': products}
+
+    def cleanup(self, seed, session_keys):
+        Cart.objects.filter(lines__product__in=seed['products']).delete()
+        # Cascades to cart lines and stock reservations.
+        Product.objects.filter(pk__in=[p.pk for p in seed['products']]).delete()
+        seed['category'].delete()
+        SessionStore = import_module(settings.SESSION_ENGINE).SessionStore
+        for session_key in session_keys:
+            SessionStore(session_key).delete()
+
+    def start(self, server, options, log):
+        port = _free_port()
+        env = {
+            **os.environ,
+            'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE', 'marketplace.settings'),
+            'PAYMENTS_BACKEND': 'fake',
+            'PAYMENTS_FAKE_LATENCY': str(options['latency']),
+            'ASYNC_VIEWS': str(server == 'asgi'),
+        }
+        bind = ['--bind', f'127.0.0.1:{port}'] if server == 'wsgi' else ['--host', '127.0.0.1', '--port', str(port)]
+        process = subprocess.Popen(
+            [sys.executable, *SERVERS[server], *bind, '--workers', str(options['workers'])],
+            cwd=settings.BASE_DIR, env=env, stdout=log, stderr=subprocess.STDOUT,
+        )
+        base_url = f'http://127.0.0.1:{port}'
+        deadline = time.monotonic() + 30
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                break
+            try:
+                httpx.get(base_url + reverse('cart'), timeout=1)
+                return process, base_url
+            except httpx.TransportError:
+                time.sleep(0.2)
+        process.kill()
+        log.seek(0)
+        raise CommandError(f'{server} server did not start:\n{log.read().decode(errors="replace")[-2000:]}')
+
+    def bench(self, server, seed, options, session_keys):
+        with tempfile.TemporaryFile() as log:
+            process, base_url = self.start(server, options, log)
+            try:
+                timings, errors, elapsed = asyncio.run(self.load(base_url, seed, options, session_keys))
+            finally:
+                process.terminate()
+                process.wait(timeout=30)
+        return {
+            'server': server,
+            'ok': len(timings),
+            'errors': sum(errors.values()),
+            'error_messages': dict(errors.most_common(5)),
+            'elapsed_s': elapsed,
+            'throughput_rps': len(timings) / elapsed,
+            'p50_ms': percentile(timings, 50) * 1000 if timings else None,
+            'p95_ms': percentile(timings, 95) * 1000 if timings else None,
+            'p99_ms': percentile(timings, 99) * 1000 if timings else None,
+            'mean_ms': statistics.mean(timings) * 1000 if timings else None,
+        }
+
+    async def load(self, base_url, seed, options, session_keys):
+        async with contextlib.AsyncExitStack() as stack:
+            # A client per customer, each with its own cookie jar.
+            customers = []
+            for _ in range(options['concurrency']):
+                client = await stack.enter_async_context(httpx.AsyncClient(base_url=base_url, timeout=120))
+                customers.append(await self.customer(client, seed))
+            timings, errors = [], Counter()
+
+            async def checkout(client):
+                for _ in range(options['requests']):
+                    start = time.perf_counter()
+                    try:
+                        response = await client.post(
+                            reverse('checkout'), json={'email': 'bench@example.com', 'full_name': 'Bench'},
+                            headers={'X-CSRFToken': client.cookies['csrftoken']},
+                        )
+                    except httpx.TransportError as e:
+                        errors[type(e).__name__] += 1
+                        continue
+                    if response.status_code == 200:
+                        timings.append(time.perf_counter() - start)
+                        continue
+                    try:
+                        errors[response.json()['error']] += 1
+                    except (ValueError, KeyError):
+                        errors[f'HTTP {response.status_code}'] += 1
+
+            start = time.perf_counter()
+            await asyncio.gather(*(checkout(client) for client in customers))
+            elapsed = time.perf_counter() - start
+            for client in customers:
+                if settings.SESSION_COOKIE_NAME in client.cookies:
+                    session_keys.add(client.cookies[settings.SESSION_COOKIE_NAME])
+        return timings, errors, elapsed
+
+    async def customer(self, client, seed):
+        """``client`` as a new customer with two products in their cart."""
+        await client.get(reverse('product_detail', args=[seed['products'][0].slug]))
+        for product in seed['products']:
+            response = await client.post(reverse('add_to_cart', args=[product.pk]),
+                                         data={'quantity': 1, 'csrfmiddlewaretoken': client.cookies['csrftoken']})
+            if response.status_code != 302:
+                raise CommandError(f'Adding to the cart failed with HTTP {response.status_code}.')
+        return client
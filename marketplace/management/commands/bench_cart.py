@@ -0,0 +1,181 @@
+import json
+import platform
+import statistics
+import time
+import uuid
+from decimal import Decimal
+
+import django
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from orders.cart_store import DatabaseCartStore
+from products.models import Category, Product
+
+from .bench_storefront import percentile
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """
+    Measures the write amplification of cart changes. A cart is filled to
+    --lines lines, every line's quantity is changed and every line removed
+    again, once the way the views used to do it (load the session, change
+    ``session['cart']``, save the session row) and once through the
+    database cart store. Each operation is one simulated request; the
+    statements it runs, the bytes of SQL it writes and its latency are
+    recorded, as is a cart read. All seeded data is rolled back unless
+    --keep is given.
+    """
+    help = 'Benchmarks session carts against the cart store and writes the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--lines', type=int, default=50)
+        parser.add_argument('--rounds', type=int, default=5, help='Times each fill/update/remove cycle is run.')
+        parser.add_argument('--output', default='bench_cart.json')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data.')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.seed(options)
+                results = {
+                    'session': self.run(options, SessionCart),
+                    'cart_store': self.run(options, StoreCart),
+                }
+                if not options['keep']:
+                    raise _Rollback
+        except _Rollback:
+            pass
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {k: options[k] for k in ('lines', 'rounds')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def seed(self, options):
+        tag = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Cart bench {tag}', slug=f'cart-bench-{tag}')
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Cart product {i}', slug=f'cart-bench-{tag}-{i}', description='Lorem ipsum.',
+                    price=Decimal('19.99'), category=category, stock=100)
+            for i in range(options['lines'])
+        ])
+
+    def run(self, options, cart_class):
+        samples = {'add': [], 'update': [], 'remove': [], 'read': []}
+        for _ in range(options['rounds']):
+            cart = cart_class()
+            keys = [f'{product.pk}--' for product in self.products]
+            for key, product in zip(keys, self.products):
+                samples['add'].append(self.measure(lambda: cart.add(key, product.pk)))
+            samples['read'].append(self.measure(cart.read))
+            for key in keys:
+                samples['update'].append(self.measure(lambda: cart.set_quantity(key, 3)))
+            samples['read'].append(self.measure(cart.read))
+            for key in keys:
+                samples['remove'].append(self.measure(lambda: cart.remove(key)))
+
+        results = {}
+        for operation, measured in samples.items():
+            timings = [m['seconds'] for m in measured]
+            results[operation] = {
+                'statements_per_op': statistics.mean(m['statements'] for m in measured),
+                'writes_per_op': statistics.mean(m['writes'] for m in measured),
+                'bytes_written_per_op': statistics.mean(m['bytes_written'] for m in measured),
+                'max_bytes_written': max(m['bytes_written'] for m in measured),
+                'p50_ms': percentile(timings, 50) * 1000,
+                'p95_ms': percentile(timings, 95) * 1000,
+                'mean_ms': statistics.mean(timings) * 1000,
+            }
+            r = results[operation]
+            self.stdout.write(f'{cart_class.name:<11} {operation:<7} {r["statements_per_op"]:>5.1f} stmts '
+                              f'{r["writes_per_op"]:>4.1f} writes {r["bytes_written_per_op"]:>8.0f} B written '
+                              f'(max {r["max_bytes_written"]:>6}) p50 {r["p50_ms"]:.2f}ms p95 {r["p95_ms"]:.2f}ms')
+        return results
+
+    def measure(self, operation):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            operation()
+            seconds = time.perf_counter() - start
+        writes = [q['sql'] for q in queries.captured_queries
+                  if q['sql'].lstrip().upper().startswith(('INSERT', 'UPDATE', 'DELETE'))]
+        return {
+            'seconds': seconds,
+            'statements': len(queries.captured_queries),
+            'writes': len(writes),
+            'bytes_written': sum(len(sql.encode()) for sql in writes),
+        }
+
+
+class SessionCart:
+    """The cart as the views kept it before the cart store: in the session, saved whole on every change."""
+    name = 'session'
+
+    def __init__(self):
+        session = SessionStore()
+        # What a signed-in customer's session typically carries besides the cart.
+        session.update({
+            '_auth_user_id': '1', '_auth_user_backend': 'django.contrib.auth.backends.ModelBackend',
+            '_auth_user_hash': '0' * 64, 'account_verified_email': None,
+        })
+        session.create()
+        self.session_key = session.session_key
+
+    def request(self, change=None):
+        session = SessionStore(self.session_key)
+        cart = session.get('cart', {})
+        if change is not None:
+            change(cart)
+            session['cart'] = cart
+            session.save()
+        return cart
+
+    def add(self, key, product_id):
+        def change(cart):
+            cart[key] = {'product_id': product_id, 'quantity': 1, 'size': None, 'color': None}
+        self.request(change)
+
+    def set_quantity(self, key, quantity):
+        self.request(lambda cart: cart[key].update(quantity=quantity))
+
+    def remove(self, key):
+        self.request(lambda cart: cart.pop(key))
+
+    def read(self):
+        return self.request()
+
+
+class StoreCart:
+    """The cart through the database cart store, with the cart id known from the cookie."""
+    name = 'cart_store'
+
+    def __init__(self):
+        self.store = DatabaseCartStore()
+        self.cart_id = self.store.new_guest_cart()
+
+    def add(self, key, product_id):
+        self.store.add(self.cart_id, key, product_id, 1)
+
+    def set_quantity(self, key, quantity):
+        self.store.set_quantity(self.cart_id, key, quantity)
+
+    def remove(self, key):
+        self.store.remove(self.cart_id, [key])
+
+    def read(self):
+        return self.store.lines(self.cart_id)
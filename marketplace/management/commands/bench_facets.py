@@ -0,0 +1,212 @@
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+import uuid
+from decimal import Decimal
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from products.facets import FacetFilters, FacetIndex
+from products.models import PRICE_TIER_MULTIPLIERS, Category, Color, FacetChange, Product, Size
+
+from .bench_storefront import percentile
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """
+    Seeds a catalog with sizes and colors (some products have neither),
+    builds the facet index over the whole catalog and times filter
+    combinations the way ProductListView runs them: the matches plus every
+    facet count from the index, then the first listing page. The same
+    counts done with GROUP BY over the join tables are timed for comparison
+    and checked against the index's for the seeded sizes, colors and
+    categories, which only seeded products have. An index rebuild and a
+    journal sync are timed too. All seeded data is rolled back unless
+    --keep is given.
+    """
+    help = 'Benchmarks faceted product filtering and writes the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=200000)
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--sizes', type=int, default=8)
+        parser.add_argument('--colors', type=int, default=12)
+        parser.add_argument('--changes', type=int, default=200, help='Products changed before the timed sync.')
+        parser.add_argument('--requests', type=int, default=50, help='Timed runs per filter combination.')
+        parser.add_argument('--page-size', type=int, default=12)
+        parser.add_argument('--output', default='bench_facets.json')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data.')
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                seed_seconds = self.seed(options)
+                results = self.run(options)
+                if not options['keep']:
+                    raise _Rollback
+        except _Rollback:
+            pass
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {k: options[k] for k in ('products', 'categories', 'sizes', 'colors', 'changes',
+                                                'requests', 'page_size')},
+            'seed_seconds': seed_seconds,
+            **results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def seed(self, options):
+        rng = random.Random(42)
+        tag = uuid.uuid4().hex[:8]
+        start = time.perf_counter()
+        self.categories = Category.objects.bulk_create([
+            Category(name=f'Facets {tag} {i}', slug=f'facets-{tag}-{i}') for i in range(options['categories'])
+        ])
+        self.sizes = Size.objects.bulk_create([Size(name=f'S{tag}{i}') for i in range(options['sizes'])])
+        self.colors = Color.objects.bulk_create([Color(name=f'C{tag}{i}') for i in range(options['colors'])])
+        for offset in range(0, options['products'], 5000):
+            products = Product.objects.bulk_create([
+                Product(
+                    name=f'Facet product {i}', slug=f'facets-{tag}-{i}', description='Lorem ipsum.',
+                    price=Decimal(rng.randint(500, 50000)) / 100,
+                    category=self.categories[rng.randrange(len(self.categories))],
+                    stock=0 if rng.random() < 0.15 else rng.randint(1, 50),
+                    available=rng.random() < 0.95,
+                )
+                for i in range(offset, min(offset + 5000, options['products']))
+            ])
+            Product.sizes.through.objects.bulk_create([
+                Product.sizes.through(product_id=product.id, size_id=size.id)
+                for product in products
+                for size in rng.sample(self.sizes, 0 if rng.random() < 0.1 else rng.randint(1, min(3, len(self.sizes))))
+            ])
+            Product.colors.through.objects.bulk_create([
+                Product.colors.through(product_id=product.id, color_id=color.id)
+                for product in products
+                for color in rng.sample(self.colors, 0 if rng.random() < 0.1 else rng.randint(1, min(2, len(self.colors))))
+            ])
+        seed_seconds = time.perf_counter() - start
+        self.stdout.write(f'Seeded {options["products"]} products in {seed_seconds:.1f}s')
+        return seed_seconds
+
+    def combinations(self):
+        sizes, colors = self.sizes, self.colors
+        yield 'none', FacetFilters()
+        yield 'size', FacetFilters(sizes=[sizes[0].pk])
+        yield 'size+color', FacetFilters(sizes=[sizes[0].pk, sizes[1].pk], colors=[colors[0].pk])
+        yield 'size+color+price', FacetFilters(sizes=[sizes[0].pk, sizes[1].pk], colors=[colors[0].pk],
+                                               min_price=Decimal('50'), max_price=Decimal('150'))
+        yield 'size+color+price+stock', FacetFilters(sizes=[sizes[0].pk], colors=[colors[0].pk, colors[1].pk],
+                                                     min_price=Decimal('100'), in_stock=True)
+        yield 'category+size+color+price', FacetFilters(category=self.categories[0].pk, sizes=[sizes[2].pk],
+                                                        colors=[colors[3].pk], max_price=Decimal('40'))
+
+    def group_by_counts(self, filters, base):
+        """Facet counts the way they'd be done without the index, for comparison."""
+        counts = {}
+        for facet, model_filter in (('size', 'sizes'), ('color', 'colors')):
+            others = FacetFilters(**{**filters.__dict__, f'{facet}s': []})
+            # Products without a size (color) have no link row to count.
+            counts[facet] = dict(others.apply(base).filter(**{f'{model_filter}__isnull': False})
+                                 .values_list(model_filter).annotate(n=Count('id')).values_list(model_filter, 'n'))
+        others = FacetFilters(**{**filters.__dict__, 'category': None})
+        counts['category'] = dict(others.apply(base).values('category_id').annotate(n=Count('id'))
+                                  .values_list('category_id', 'n'))
+        return counts
+
+    def seeded_counts(self, counts):
+        """The non-zero ``counts`` of the seeded sizes, colors and categories."""
+        seeded = {'size': self.sizes, 'color': self.colors, 'category': self.categories}
+        return {facet: {obj.pk: counts[facet][obj.pk] for obj in objs if counts[facet].get(obj.pk)}
+                for facet, objs in seeded.items()}
+
+    def differing_facets(self, facets, counts):
+        """Facets whose index counts differ from the GROUP BY ones, for the seeded values."""
+        index_counts, group_by_counts = self.seeded_counts(facets.counts), self.seeded_counts(counts)
+        return [facet for facet in index_counts if index_counts[facet] != group_by_counts[facet]]
+
+    def timed(self, fn, runs):
+        timings = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            value = fn()
+            timings.append(time.perf_counter() - start)
+        return value, {
+            'p50_ms': percentile(timings, 50) * 1000,
+            'p95_ms': percentile(timings, 95) * 1000,
+            'p99_ms': percentile(timings, 99) * 1000,
+            'mean_ms': statistics.mean(timings) * 1000,
+        }
+
+    def run(self, options):
+        start = time.perf_counter()
+        index = FacetIndex.build(generation=0)
+        build_seconds = time.perf_counter() - start
+        bitmaps = [index.live, index.in_stock, *(b for values in index.values.values() for b in values.values())]
+        memory_kib = sum(sys.getsizeof(bitmap) for bitmap in bitmaps) / 1024
+        self.stdout.write(f'Built index over {len(index.ids)} products in {build_seconds:.2f}s, '
+                          f'{len(bitmaps)} bitmaps, {memory_kib:.0f} KiB')
+
+        multiplier = PRICE_TIER_MULTIPLIERS['guest']
+        base = Product.objects.filter(available=True).with_price_for(None)
+        listing = base.for_listing().order_by('-created_at', '-id')
+        seeded = base.filter(category__in=self.categories)
+        results = []
+        self.stdout.write(f'{"filters":<28} {"matches":>8} {"facets p50":>11} {"p99":>7} '
+                          f'{"+page p50":>10} {"p99":>7} {"GROUP BY p50":>13}')
+        for name, filters in self.combinations():
+            facets, facet_timing = self.timed(lambda: index.search(filters, multiplier), options['requests'])
+            _, page_timing = self.timed(
+                lambda: list(index.search(filters, multiplier).filter(listing)[:options['page_size']]),
+                options['requests'],
+            )
+            counts, group_by_timing = self.timed(lambda: self.group_by_counts(filters, seeded),
+                                                 max(1, options['requests'] // 10))
+            differing = self.differing_facets(facets, counts)
+            if differing:
+                raise AssertionError(f'{name}: {", ".join(differing)} counts differ from GROUP BY')
+            results.append({'filters': name, 'matches': facets.total, 'facets': facet_timing,
+                            'facets_and_page': page_timing, 'group_by': group_by_timing})
+            self.stdout.write(f'{name:<28} {facets.total:>8} {facet_timing["p50_ms"]:>11.2f} '
+                              f'{facet_timing["p99_ms"]:>7.2f} {page_timing["p50_ms"]:>10.2f} '
+                              f'{page_timing["p99_ms"]:>7.2f} {group_by_timing["p50_ms"]:>13.2f}')
+
+        # Journal some changes the way the signals would, then sync them.
+        rng = random.Random(7)
+        changed = rng.sample(index.ids, min(options['changes'], len(index.ids)))
+        Product.objects.filter(id__in=changed[::2]).update(stock=0)
+        Product.objects.filter(id__in=changed[1::2]).update(available=False)
+        FacetChange.objects.bulk_create([FacetChange(product_id=product_id) for product_id in changed],
+                                        update_conflicts=True, unique_fields=['product_id'],
+                                        update_fields=['changed_at'])
+        start = time.perf_counter()
+        index = index.sync(generation=1)
+        sync_seconds = time.perf_counter() - start
+        _, after_sync = self.timed(lambda: index.search(FacetFilters(sizes=[self.sizes[0].pk]), multiplier),
+                                   options['requests'])
+        self.stdout.write(f'Synced {len(changed)} changed products in {sync_seconds * 1000:.1f}ms; '
+                          f'size filter afterwards p50 {after_sync["p50_ms"]:.2f}ms')
+        return {
+            'build_seconds': build_seconds,
+            'index_kib': memory_kib,
+            'sync_ms': sync_seconds * 1000,
+            'results': results,
+            'after_sync': after_sync,
+        }
@@ -0,0 +1,258 @@
+import datetime
+import gc
+import json
+import os
+import platform
+import resource
+import tempfile
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+import django
+import httpx
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries, transaction
+from django.test import Client
+from django.urls import reverse
+from django.utils import timezone
+
+from orders import export
+from orders.models import Order, OrderItem
+from products.models import Category, Product
+
+from .bench_async_checkout import Command as AsyncCheckoutCommand
+from .bench_storefront import _Rollback
+
+BATCH_SIZE = 2000
+PATHS = ('command', 'view', 'uvicorn')
+# Seeded orders are all created on this day, so exporting it exports them
+# and nothing else.
+EXPORT_DAY = datetime.date(2999, 1, 1)
+
+
+def current_rss(pid='self'):
+    """Resident set size in bytes, or None where /proc isn't available."""
+    try:
+        with open(f'/proc/{pid}/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        return None
+
+
+class RssSampler(threading.Thread):
+    """Polls the resident set size of a process while an export runs and keeps the peak."""
+
+    def __init__(self, interval=0.005, pid='self'):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.pid = pid
+        self.stopped = threading.Event()
+        self.peak = current_rss(pid) or 0
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, current_rss(self.pid) or 0)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, current_rss(self.pid) or 0)
+
+
+class Command(BaseCommand):
+    """
+    Seeds orders in growing batches and times the order export after each,
+    through the export generator (as the export_orders command runs it),
+    through the staff endpoint with the test client, and through the async
+    endpoint served by uvicorn in a subprocess (as the Procfile runs it).
+    Records rows per second, the time to the first chunk and the peak RSS
+    of the process doing the export, sampled every few milliseconds,
+    against its RSS before the export started; a streaming export should
+    show the same growth for every size.
+
+    All seeded data is rolled back, except with the ``uvicorn`` path: the
+    server only sees committed data, so the seed is committed and deleted
+    again at the end. Run with DEBUG=True for that path, or the server
+    redirects plain HTTP to HTTPS.
+
+    Peak RSS is read from /proc, so it is only reported on Linux.
+    """
+    help = 'Benchmarks the streaming order export and writes the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Total orders to export, in increasing order.')
+        parser.add_argument('--items', type=int, default=2, help='Items per order.')
+        parser.add_argument('--formats', nargs='+', choices=list(export.FORMATS), default=list(export.FORMATS))
+        parser.add_argument('--paths', nargs='+', choices=PATHS, default=list(PATHS))
+        parser.add_argument('--chunk-size', type=int, help='Rows per database round trip.')
+        parser.add_argument('--output', default='bench_order_export.json')
+
+    def handle(self, *args, **options):
+        results = []
+        if 'uvicorn' in options['paths']:
+            seed = self.setup()
+            try:
+                with tempfile.TemporaryFile() as log:
+                    server, base_url = AsyncCheckoutCommand().start('asgi', {'workers': 1, 'latency': 0}, log)
+                    try:
+                        self.run(seed, options, results, server, base_url)
+                    finally:
+                        server.terminate()
+                        server.wait(timeout=30)
+            finally:
+                self.cleanup(seed)
+        else:
+            try:
+                with transaction.atomic():
+                    self.run(self.setup(), options, results)
+                    raise _Rollback
+            except _Rollback:
+                pass
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {k: options[k] for k in ('sizes', 'items', 'formats', 'paths', 'chunk_size')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def setup(self):
+        tag = uuid.uuid4().hex[:8]
+        category = Category.objects.create(name=f'Export {tag}', slug=f'export-{tag}')
+        products = Product.objects.bulk_create([
+            Product(name=f'Export product {i}', slug=f'export-{tag}-{i}', description='Lorem ipsum',
+                    price=Decimal('12.50'), category=category)
+            for i in range(20)
+        ])
+        User = get_user_model()
+        users = [None] + [
+            User.objects.create_user(username=f'export-{tag}-{user_type}', email=f'export-{tag}-{user_type}@example.com',
+                                     password=None, user_type=user_type)
+            for user_type in ('normal', 'business')
+        ]
+        staff = User.objects.create_user(username=f'export-{tag}-staff', email=f'export-{tag}-staff@example.com',
+                                         password=None, is_staff=True)
+        client = Client()
+        client.force_login(staff)
+        return {'tag': tag, 'category': category, 'products': products, 'users': users[1:] + [staff],
+                'client': client}
+
+    def cleanup(self, seed):
+        # Cascades to the order items.
+        Order.objects.filter(stripe_payment_id__startswith=f'pi_{seed["tag"]}_').delete()
+        Product.objects.filter(pk__in=[p.pk for p in seed['products']]).delete()
+        seed['category'].delete()
+        seed['client'].logout()
+        get_user_model().objects.filter(pk__in=[u.pk for u in seed['users']]).delete()
+
+    def run(self, seed, options, results, server=None, base_url=None):
+        self.stdout.write(f'{"orders":>9} {"rows":>9} {"path":<8} {"format":<6} {"rows/s":>10} '
+                          f'{"first ms":>9} {"MiB":>8} {"RSS MiB":>8} {"growth":>8}')
+        seeded = 0
+        for size in sorted(options['sizes']):
+            self.seed(seeded, size, options['items'], seed)
+            seeded = size
+            for format in options['formats']:
+                for path in options['paths']:
+                    result = self.measure(path, format, seed, options, server, base_url)
+                    result.update({'orders': size})
+                    results.append(result)
+                    self.stdout.write(
+                        f'{size:>9} {result["rows"]:>9} {path:<8} {format:<6} {result["rows_per_s"]:>10.0f} '
+                        f'{result["first_chunk_ms"]:>9.1f} {result["output_mib"]:>8.1f} '
+                        f'{result["peak_rss_mib"] or 0:>8.1f} {result["rss_growth_mib"] or 0:>8.1f}'
+                    )
+
+    def seed(self, start, stop, items, seed):
+        products, users = seed['products'], [None, *seed['users'][:-1]]
+        created_at = timezone.make_aware(datetime.datetime.combine(EXPORT_DAY, datetime.time(12)))
+        for batch_start in range(start, stop, BATCH_SIZE):
+            count = min(BATCH_SIZE, stop - batch_start)
+            orders = Order.objects.bulk_create([
+                Order(user=users[i % len(users)], email=f'customer{i}@example.com', full_name=f'Customer {i}',
+                      address='Street 1', city='City', state='State', postal_code='0000', country='Country',
+                      phone='0', status=('processing', 'shipped', 'delivered')[i % 3],
+                      total_amount=Decimal('12.50') * items, stripe_payment_id=f'pi_{seed["tag"]}_{i}')
+                for i in range(batch_start, batch_start + count)
+            ])
+            # created_at is set on insert; move the batch to the export day.
+            Order.objects.filter(pk__in=[order.pk for order in orders]).update(created_at=created_at)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=products[(order.pk + j) % len(products)], price=Decimal('12.50'),
+                          quantity=1, size='M', color='Blue')
+                for order in orders for j in range(items)
+            ])
+
+    def measure(self, path, format, seed, options, server, base_url):
+        reset_queries()
+        gc.collect()
+        pid = server.pid if path == 'uvicorn' else 'self'
+        baseline = current_rss(pid)
+        sampler = RssSampler(pid=pid)
+        sampler.start()
+        rows = output = 0
+        first_chunk = None
+        params = {'format': format, 'created_from': EXPORT_DAY.isoformat(), 'created_to': EXPORT_DAY.isoformat()}
+        start = time.perf_counter()
+        if path == 'command':
+            counted = self.count(export.export_rows(chunk_size=options['chunk_size'], created_from=EXPORT_DAY,
+                                                    created_to=EXPORT_DAY))
+            with open(os.devnull, 'w') as devnull:
+                for chunk in export.encode(counted, format):
+                    first_chunk = first_chunk or time.perf_counter()
+                    output += len(chunk)
+                    devnull.write(chunk)
+            rows = self.rows
+        else:
+            if path == 'view':
+                response = seed['client'].get(reverse('order_export'), params, secure=True)
+                chunks = response.streaming_content
+            else:
+                cookies = {settings.SESSION_COOKIE_NAME: seed['client'].cookies[settings.SESSION_COOKIE_NAME].value}
+                response = httpx.stream('GET', base_url + reverse('order_export'), params=params, cookies=cookies,
+                                        timeout=600)
+                chunks = self.stream(response)
+            for chunk in chunks:
+                first_chunk = first_chunk or time.perf_counter()
+                output += len(chunk)
+                rows += chunk.count(b'\n')
+            # Exhausting streaming_content closes the response; closing it
+            # again would close the connection and roll back the seed.
+            if format == 'csv':
+                rows -= 1  # The header.
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+        return {
+            'path': path,
+            'format': format,
+            'rows': rows,
+            'elapsed_s': elapsed,
+            'rows_per_s': rows / elapsed if elapsed else 0,
+            'first_chunk_ms': ((first_chunk or start) - start) * 1000,
+            'output_mib': output / 2 ** 20,
+            'peak_rss_mib': sampler.peak / 2 ** 20 if baseline else None,
+            'rss_growth_mib': (sampler.peak - baseline) / 2 ** 20 if baseline else None,
+            'max_rss_mib': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 if path != 'uvicorn'
+                            else None),
+        }
+
+    def stream(self, response):
+        with response as response:
+            response.raise_for_status()
+            yield from response.iter_raw()
+
+    def count(self, rows):
+        self.rows = 0
+        for row in rows:
+            self.rows += 1
+            yield row
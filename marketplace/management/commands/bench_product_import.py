@@ -0,0 +1,141 @@
+import csv
+import json
+import os
+import platform
+import random
+import tempfile
+import time
+import uuid
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from products import facets, imports, search
+from products.cache import bump_generation_on_commit
+from products.models import Category, Color, Product, Size
+
+SIZES = ['XS', 'S', 'M', 'L', 'XL']
+COLORS = ['Red', 'Green', 'Blue', 'Black', 'White', 'Terracotta']
+WORDS = 'soil pot seed leaf root bloom clay water light fern moss stone garden indoor outdoor'.split()
+
+
+class Command(BaseCommand):
+    """
+    Times products.imports on a generated file of --rows products, in
+    three passes: the first import (all creates), the same file again
+    (all unchanged) and a file where --change-ratio of the rows have a new
+    price, stock or description. Each pass commits, so the search reindex
+    and facet journal that run on commit are included. Imported products,
+    categories, sizes and colors are deleted at the end unless --keep is
+    given.
+
+    Each pass also runs bleach on the descriptions it has to sanitize, which
+    dominates on few cores; --workers defaults to PRODUCT_IMPORT_WORKERS.
+    """
+    help = 'Benchmarks the bulk product import and writes the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--format', choices=imports.FORMATS, default='csv')
+        parser.add_argument('--workers', type=int, help='Processes sanitizing descriptions.')
+        parser.add_argument('--batch-size', type=int, help='Rows applied per batch.')
+        parser.add_argument('--change-ratio', type=float, default=0.1)
+        parser.add_argument('--output', default='bench_product_import.json')
+        parser.add_argument('--keep', action='store_true', help='Keep the imported data.')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        rng = random.Random(0)
+        rows = [self.row(tag, i, rng) for i in range(options['rows'])]
+        changed = [dict(row) for row in rows]
+        for row in rng.sample(changed, int(len(changed) * options['change_ratio'])):
+            field = rng.choice(('price', 'stock', 'description'))
+            row[field] = {'price': f'{rng.uniform(1, 200):.2f}', 'stock': str(rng.randint(0, 50)),
+                          'description': row['description'] + ' <em>Updated</em>'}[field]
+        existing_sizes = set(Size.objects.values_list('name', flat=True))
+        existing_colors = set(Color.objects.values_list('name', flat=True))
+
+        results = []
+        self.stdout.write(f'{"pass":<10} {"rows":>8} {"created":>8} {"updated":>8} {"unchanged":>9} '
+                          f'{"sanitized":>9} {"seconds":>8} {"rows/s":>8}')
+        try:
+            for name, data in (('create', rows), ('unchanged', rows), ('changed', changed)):
+                with tempfile.TemporaryFile() as f:
+                    self.write(f, data, options['format'])
+                    f.seek(0)
+                    start = time.perf_counter()
+                    report = imports.import_products(f, options['format'], workers=options['workers'],
+                                                     batch_size=options['batch_size'])
+                    elapsed = time.perf_counter() - start
+                result = {
+                    'pass': name, 'rows': report.rows, 'created': report.created, 'updated': report.updated,
+                    'unchanged': report.unchanged, 'errors': report.skipped, 'sanitized': report.sanitized,
+                    'elapsed_s': elapsed, 'rows_per_s': report.rows / elapsed if elapsed else 0,
+                }
+                results.append(result)
+                self.stdout.write(f'{name:<10} {report.rows:>8} {report.created:>8} {report.updated:>8} '
+                                  f'{report.unchanged:>9} {report.sanitized:>9} {elapsed:>8.1f} '
+                                  f'{result["rows_per_s"]:>8.0f}')
+                for line, message in report.errors[:5]:
+                    self.stderr.write(f'  line {line}: {message}')
+        finally:
+            if not options['keep']:
+                self.cleanup(tag, set(SIZES) - existing_sizes, set(COLORS) - existing_colors)
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'cpus': os.cpu_count(),
+            'options': {k: options[k] for k in ('rows', 'format', 'workers', 'batch_size', 'change_ratio')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def cleanup(self, tag, sizes, colors):
+        products = Product.objects.filter(slug__startswith=f'bench-import-{tag}-')
+        product_ids = list(products.values_list('pk', flat=True))
+        with transaction.atomic():
+            for column in imports.LINKS:
+                Product._meta.get_field(column).remote_field.through.objects.filter(product__in=products).delete()
+            # QuerySet.delete() sends post_delete per product, each updating
+            # search and the facet journal; do both once instead.
+            products._raw_delete(products.db)
+            search.remove_products(product_ids)
+            facets.record_changes(product_ids)
+            bump_generation_on_commit()
+            Category.objects.filter(name__startswith=f'Bench import {tag} ').delete()
+            Size.objects.filter(name__in=sizes).delete()
+            Color.objects.filter(name__in=colors).delete()
+
+    def row(self, tag, i, rng):
+        words = ' '.join(rng.choices(WORDS, k=40))
+        return {
+            'slug': f'bench-import-{tag}-{i}',
+            'name': f'Bench import product {i}',
+            'description': f'<p>{words}</p><ul><li><strong>{rng.choice(WORDS)}</strong></li></ul>',
+            'price': f'{rng.uniform(1, 200):.2f}',
+            'category': f'Bench import {tag} {i % 20}',
+            'stock': str(rng.randint(0, 50)),
+            'available': 'true',
+            'sizes': imports.LIST_SEPARATOR.join(rng.sample(SIZES, 2)),
+            'colors': rng.choice(COLORS),
+        }
+
+    def write(self, f, rows, format):
+        if format == 'csv':
+            text = tempfile.SpooledTemporaryFile(mode='w+', newline='', encoding='utf-8')
+            writer = csv.DictWriter(text, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+            text.seek(0)
+            f.write(text.read().encode())
+        else:
+            for row in rows:
+                f.write(json.dumps({**row, 'sizes': row['sizes'].split(imports.LIST_SEPARATOR),
+                                    'colors': [row['colors']]}).encode() + b'\n')
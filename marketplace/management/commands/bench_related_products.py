@@ -0,0 +1,184 @@
+import gc
+import itertools
+import json
+import platform
+import random
+import time
+import uuid
+from decimal import Decimal
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection, reset_queries, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from orders.models import Order, OrderItem
+from orders.rollups import SALES_STATUSES
+from products import related
+from products.models import Category, CoPurchase, Product, RelatedProduct
+
+from .bench_order_export import RssSampler, current_rss
+from .bench_storefront import _Rollback
+
+BATCH_SIZE = 5000
+# Products are sold in bundles of this many: most of an order's items come
+# from one bundle, so a bundle's products should rank each other first.
+BUNDLE = 8
+# Orders a product needs before its neighbours count towards the bundle share.
+MIN_ORDERS = 20
+
+
+class Command(BaseCommand):
+    """
+    Seeds order histories of growing size (1M order items by default),
+    with orders of one to five items drawn mostly from one bundle of
+    products, popular bundles more often. After each size it times a full
+    rebuild of the related products and an incremental refresh after
+    --increment more orders, with the process's peak RSS against the RSS
+    before the run; bounded memory shows as the same growth at every size.
+    It also reports how many of the co-purchased neighbours the page shows
+    come from the product's own bundle, for products sold at least
+    MIN_ORDERS times, and the queries the product page runs for them.
+    All seeded data is rolled back.
+
+    Peak RSS is read from /proc, so it is only reported on Linux.
+    """
+    help = 'Benchmarks the co-purchase related products job and writes the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[100000, 1000000],
+                            help='Total order items to seed, in increasing order.')
+        parser.add_argument('--products', type=int, default=5000)
+        parser.add_argument('--increment', type=float, default=0.01,
+                            help='Orders added before the incremental refresh, as a share of the seeded ones.')
+        parser.add_argument('--batch-size', type=int, help='Orders counted per transaction.')
+        parser.add_argument('--output', default='bench_related_products.json')
+
+    def handle(self, *args, **options):
+        results = []
+        try:
+            with transaction.atomic():
+                self.run(options, results)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {k: options[k] for k in ('sizes', 'products', 'increment', 'batch_size')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def run(self, options, results):
+        tag = uuid.uuid4().hex[:8]
+        self.rng = random.Random(0)
+        categories = Category.objects.bulk_create([
+            Category(name=f'Related {tag} {i}', slug=f'related-{tag}-{i}') for i in range(20)
+        ])
+        self.products = Product.objects.bulk_create([
+            Product(name=f'Related product {i}', slug=f'related-{tag}-{i}', description='Lorem ipsum',
+                    price=Decimal('9.99'), category=categories[i % len(categories)], stock=1000)
+            for i in range(options['products'])
+        ], batch_size=BATCH_SIZE)
+        self.bundle = {product.pk: i // BUNDLE for i, product in enumerate(self.products)}
+        # Only this run's orders are counted.
+        Order.objects.filter(status__in=SALES_STATUSES).update(status='cancelled')
+        related.refresh(rebuild=True, batch_size=options['batch_size'])
+
+        self.stdout.write(f'{"items":>9} {"orders":>8} {"pass":<8} {"counted":>8} {"entries":>9} {"ranked":>7} '
+                          f'{"seconds":>8} {"growth":>8}')
+        seeded = 0
+        for size in sorted(options['sizes']):
+            seeded += self.seed(size - seeded)
+            for name, rebuild in (('rebuild', True), ('refresh', False)):
+                if not rebuild:
+                    self.seed(int(seeded * options['increment']))
+                result = self.measure(rebuild, options['batch_size'])
+                result.update({'pass': name, 'items': size, 'orders': Order.objects.filter(
+                    status__in=SALES_STATUSES).count()})
+                results.append(result)
+                self.stdout.write(
+                    f'{size:>9} {result["orders"]:>8} {name:<8} {result["counted"]:>8} {result["entries"]:>9} '
+                    f'{result["ranked"]:>7} {result["elapsed_s"]:>8.1f} {result["rss_growth_mib"] or 0:>8.1f}'
+                )
+            results[-1].update(self.quality())
+            self.stdout.write(f'  {results[-1]["same_bundle"]:.0%} of shown co-purchased neighbours share a bundle; '
+                              f'product page: {results[-1]["page_queries"]} query, {results[-1]["page_ms"]:.2f} ms.')
+
+    def seed(self, items):
+        """Orders with ``items`` order items in total; returns how many items were created."""
+        rng, products = self.rng, self.products
+        bundles = range(len(products) // BUNDLE)
+        # Zipf-like: the k-th bundle sells 1/k as often as the first.
+        weights = list(itertools.accumulate(1 / (k + 1) for k in bundles))
+        created = 0
+        while created < items:
+            orders, lines = [], []
+            while created < items and len(orders) < BATCH_SIZE:
+                count = min(rng.randint(1, 5), items - created)
+                # One item in twenty is a random product.
+                bundle = rng.choices(bundles, cum_weights=weights)[0]
+                picked = {
+                    products[bundle * BUNDLE + rng.randrange(BUNDLE)] if rng.random() > 0.05 else rng.choice(products)
+                    for _ in range(count)
+                }
+                orders.append(Order(email='related@example.com', full_name='Related', address='Street 1',
+                                    status='processing', total_amount=Decimal('9.99') * len(picked)))
+                lines.append(picked)
+                created += len(picked)
+            orders = Order.objects.bulk_create(orders)
+            OrderItem.objects.bulk_create([
+                OrderItem(order=order, product=product, price=product.price, quantity=1)
+                for order, picked in zip(orders, lines) for product in picked
+            ], batch_size=BATCH_SIZE)
+        return created
+
+    def measure(self, rebuild, batch_size):
+        reset_queries()
+        gc.collect()
+        baseline = current_rss()
+        sampler = RssSampler()
+        sampler.start()
+        start = time.perf_counter()
+        report = related.refresh(rebuild=rebuild, batch_size=batch_size)
+        elapsed = time.perf_counter() - start
+        sampler.stop()
+        return {
+            'counted': report.orders,
+            'entries': report.pairs,
+            'ranked': report.products,
+            'copurchase_rows': CoPurchase.objects.count(),
+            'elapsed_s': elapsed,
+            'orders_per_s': report.orders / elapsed if elapsed else 0,
+            'peak_rss_mib': sampler.peak / 2 ** 20 if baseline else None,
+            'rss_growth_mib': (sampler.peak - baseline) / 2 ** 20 if baseline else None,
+        }
+
+    def quality(self):
+        # The neighbours the page shows; a bundle only has BUNDLE - 1 others.
+        # Products sold too rarely to tell their bundle apart are skipped.
+        sold = CoPurchase.objects.filter(product_id=F('other_id'), orders__gte=MIN_ORDERS).values('product_id')
+        pairs = list(RelatedProduct.objects.filter(source='co_purchase', product__in=sold, rank__lt=related.SHOWN)
+                     .values_list('product_id', 'related_id'))
+        same = sum(self.bundle.get(product_id) == self.bundle.get(related_id) for product_id, related_id in pairs)
+        product = self.products[0]
+        reset_queries()
+        timings = []
+        for _ in range(20):
+            with CaptureQueriesContext(connection) as queries:
+                start = time.perf_counter()
+                related.related_products(product)
+                timings.append(time.perf_counter() - start)
+        return {
+            'same_bundle': same / len(pairs) if pairs else 0,
+            'page_queries': len(queries),
+            'page_ms': sorted(timings)[len(timings) // 2] * 1000,
+        }
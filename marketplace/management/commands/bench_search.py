@@ -0,0 +1,165 @@
+import itertools
+import json
+import platform
+import random
+import statistics
+import time
+import uuid
+from decimal import Decimal
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.utils import timezone
+
+from products import facets
+from products.cache import bump_generation_on_commit
+from products.models import Category, Product
+from products.search import HEADING_TABLE, SEARCH_TABLE, rebuild_index, remove_products, search
+
+from .bench_storefront import percentile
+
+SYLLABLES = ('ba', 'ko', 'ri', 'mu', 'te', 'sa', 'lo', 'ni', 'pe', 'gu', 'da', 'vi', 'zo', 'fe', 'ha', 'ju')
+VOCABULARY_SIZE = 20000
+
+
+def vocabulary(rng):
+    """Distinct pseudo-words, most frequent first."""
+    words = set()
+    while len(words) < VOCABULARY_SIZE:
+        words.add(''.join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    words = sorted(words)
+    rng.shuffle(words)
+    return words
+
+
+class Command(BaseCommand):
+    """
+    Seeds a catalog whose names and descriptions draw words from a Zipf
+    distribution (like real text), rebuilds the search index over it and
+    times searches the way ProductSearchView runs them: ranked ids from the
+    index, then the first page of tier-priced listing rows. Queries are
+    drawn from common, mid-frequency and rare words, alone and in pairs.
+    The seed is committed before the searches run, as the index would be in
+    production (searching inside the seeding transaction is several times
+    slower on PostgreSQL), and deleted at the end unless --keep is given.
+    """
+    help = 'Benchmarks product full-text search and writes the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--products', type=int, default=500000)
+        parser.add_argument('--categories', type=int, default=50)
+        parser.add_argument('--requests', type=int, default=50, help='Timed searches per query.')
+        parser.add_argument('--page-size', type=int, default=12)
+        parser.add_argument('--output', default='bench_search.json')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data.')
+
+    def handle(self, *args, **options):
+        tag = uuid.uuid4().hex[:8]
+        try:
+            with transaction.atomic():
+                seed_seconds, index_seconds = self.seed(tag, options)
+            if connection.vendor == 'postgresql':
+                # What autovacuum would have done by the time anyone searches;
+                # otherwise the first searches set hint bits on every row.
+                with connection.cursor() as cursor:
+                    cursor.execute(f'VACUUM ANALYZE {Product._meta.db_table}, {SEARCH_TABLE}, {HEADING_TABLE}')
+            results = self.run(options)
+        finally:
+            if not options['keep']:
+                self.cleanup(tag)
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {k: options[k] for k in ('products', 'categories', 'requests', 'page_size')},
+            'seed_seconds': seed_seconds,
+            'index_seconds': index_seconds,
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def seed(self, tag, options):
+        rng = random.Random(42)
+        words = vocabulary(rng)
+        weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+        self.words = words
+        start = time.perf_counter()
+        categories = Category.objects.bulk_create([
+            Category(name=f'{" ".join(rng.choices(words, cum_weights=weights, k=2)).title()} {tag} {i}',
+                     slug=f'search-{tag}-{i}')
+            for i in range(options['categories'])
+        ])
+        batch = []
+        for i in range(options['products']):
+            batch.append(Product(
+                name=' '.join(rng.choices(words, cum_weights=weights, k=4)).title(),
+                slug=f'search-{tag}-{i}',
+                description=' '.join(rng.choices(words, cum_weights=weights, k=40)),
+                price=Decimal(rng.randint(500, 50000)) / 100, category=categories[i % len(categories)],
+            ))
+            if len(batch) == 5000:
+                Product.objects.bulk_create(batch)
+                batch = []
+        Product.objects.bulk_create(batch)
+        seed_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        indexed = rebuild_index()
+        index_seconds = time.perf_counter() - start
+        self.stdout.write(f'Seeded {options["products"]} products in {seed_seconds:.1f}s, '
+                          f'indexed {indexed} in {index_seconds:.1f}s')
+        return seed_seconds, index_seconds
+
+    def cleanup(self, tag):
+        products = Product.objects.filter(slug__startswith=f'search-{tag}-')
+        product_ids = list(products.values_list('pk', flat=True))
+        with transaction.atomic():
+            # QuerySet.delete() sends post_delete per product, each updating
+            # search and the facet journal; do both once instead.
+            products._raw_delete(products.db)
+            remove_products(product_ids)
+            facets.record_changes(product_ids)
+            bump_generation_on_commit()
+            Category.objects.filter(slug__startswith=f'search-{tag}-').delete()
+
+    def queries(self):
+        words = self.words
+        buckets = {'common': words[:10], 'mid': words[100:1000:90], 'rare': words[5000:15000:1000]}
+        for bucket, chosen in buckets.items():
+            for word in chosen:
+                yield bucket, word
+            yield f'{bucket}+common', f'{chosen[0]} {words[1]}'
+            yield f'{bucket} pair', f'{chosen[1]} {chosen[2]}'
+
+    def run(self, options):
+        user = get_user_model()(user_type='business')
+        base = Product.objects.filter(available=True).for_listing().with_price_for(user)
+        results = []
+        self.stdout.write(f'{"bucket":<14} {"query":<24} {"results":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+        for bucket, query in self.queries():
+            timings = []
+            for _ in range(options['requests']):
+                start = time.perf_counter()
+                found = search(base, query)
+                page = found[:options['page_size']]
+                timings.append(time.perf_counter() - start)
+
+            result = {
+                'bucket': bucket, 'query': query, 'results': len(found), 'truncated': found.truncated,
+                'first_page_rows': len(page),
+                'p50_ms': percentile(timings, 50) * 1000,
+                'p95_ms': percentile(timings, 95) * 1000,
+                'p99_ms': percentile(timings, 99) * 1000,
+                'mean_ms': statistics.mean(timings) * 1000,
+            }
+            results.append(result)
+            count = f'{len(found)}{"+" if found.truncated else ""}'
+            self.stdout.write(f'{bucket:<14} {query:<24} {count:>8} {result["p50_ms"]:>8.2f} '
+                              f'{result["p95_ms"]:>8.2f} {result["p99_ms"]:>8.2f}')
+        return results
@@ -0,0 +1,201 @@
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+import uuid
+from decimal import Decimal
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from orders.models import Order, OrderItem
+from payments.fake import FakeStripeBackend
+from payments.gateway import PaymentGateway, get_gateway, set_gateway
+from products.models import Category, Color, Product, Size
+
+SORTS = (None, 'latest', 'price_low_to_high', 'price_high_to_low', 'name_a_to_z')
+
+
+class _Rollback(Exception):
+    pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+class Command(BaseCommand):
+    """
+    Seeds a catalog and drives the storefront URLs in-process with the
+    Django test client, recording latency, queries and memory allocated per
+    request. Stripe is replaced by the in-process fake. All seeded data is
+    rolled back at the end unless --keep is given.
+
+    Run with DEBUG=True or after collectstatic, since templates resolve
+    static files through the configured storage.
+    """
+    help = 'Benchmarks the storefront request paths and writes the results as JSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=10)
+        parser.add_argument('--products', type=int, default=1000)
+        parser.add_argument('--sizes', type=int, default=6)
+        parser.add_argument('--colors', type=int, default=8)
+        parser.add_argument('--users', type=int, default=5, help='Users of each user_type.')
+        parser.add_argument('--orders', type=int, default=20, help='Orders per user.')
+        parser.add_argument('--requests', type=int, default=50, help='Timed requests per scenario and tier.')
+        parser.add_argument('--traced-requests', type=int, default=3,
+                            help='Extra requests per scenario run under tracemalloc.')
+        parser.add_argument('--output', default='bench_storefront.json')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded data.')
+
+    def handle(self, *args, **options):
+        previous_gateway = get_gateway() if options['keep'] else None
+        set_gateway(PaymentGateway(FakeStripeBackend()))
+        try:
+            with transaction.atomic():
+                seed = self.seed(options)
+                results = self.run(seed, options)
+                if not options['keep']:
+                    raise _Rollback
+        except _Rollback:
+            pass
+        finally:
+            set_gateway(previous_gateway)
+
+        report = {
+            'timestamp': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            'options': {k: options[k] for k in ('categories', 'products', 'sizes', 'colors', 'users', 'orders',
+                                                'requests', 'traced_requests')},
+            'results': results,
+        }
+        with open(options['output'], 'w') as f:
+            json.dump(report, f, indent=2)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
+
+    def seed(self, options):
+        tag = uuid.uuid4().hex[:8]
+        categories = Category.objects.bulk_create([
+            Category(name=f'Bench {tag} {i}', slug=f'bench-{tag}-{i}') for i in range(options['categories'])
+        ])
+        sizes = Size.objects.bulk_create([Size(name=f'S{tag}{i}') for i in range(options['sizes'])])
+        colors = Color.objects.bulk_create([Color(name=f'C{tag}{i}') for i in range(options['colors'])])
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Bench product {i}', slug=f'bench-{tag}-{i}',
+                description='Lorem ipsum dolor sit amet. ' * 40,
+                price=Decimal(10 + i % 490) + Decimal('0.99'),
+                category=categories[i % len(categories)], stock=1000,
+            )
+            for i in range(options['products'])
+        ])
+        Product.sizes.through.objects.bulk_create([
+            Product.sizes.through(product_id=p.id, size_id=sizes[(p.id + j) % len(sizes)].id)
+            for p in products for j in range(min(3, len(sizes)))
+        ])
+        Product.colors.through.objects.bulk_create([
+            Product.colors.through(product_id=p.id, color_id=colors[(p.id + j) % len(colors)].id)
+            for p in products for j in range(min(3, len(colors)))
+        ])
+
+        User = get_user_model()
+        users = {}
+        for user_type in ('normal', 'business'):
+            users[user_type] = [
+                User.objects.create_user(
+                    username=f'bench-{tag}-{user_type}-{i}', email=f'bench-{tag}-{user_type}-{i}@example.com',
+                    password=None, user_type=user_type,
+                )
+                for i in range(options['users'])
+            ]
+            for user in users[user_type]:
+                orders = Order.objects.bulk_create([
+                    Order(user=user, email=user.email, full_name='Bench', address='Street 1', city='City',
+                          state='State', postal_code='0000', country='Country', phone='0',
+                          status='processing', total_amount=Decimal('42.00'))
+                    for _ in range(options['orders'])
+                ])
+                OrderItem.objects.bulk_create([
+                    OrderItem(order=order, product=products[(order.id + j) % len(products)],
+                              price=Decimal('21.00'), quantity=1)
+                    for order in orders for j in range(2)
+                ])
+        return {'categories': categories, 'products': products, 'users': users}
+
+    def scenarios(self, seed):
+        product = seed['products'][len(seed['products']) // 2]
+        category = seed['categories'][0]
+        checkout_data = json.dumps({'email': 'bench@example.com', 'full_name': 'Bench', 'address': 'Street 1'})
+        for sort in SORTS:
+            query = f'?sort={sort}' if sort else ''
+            yield f'product_list{"[" + sort + "]" if sort else ""}', 'get', reverse('product_list') + query, {}
+        yield 'product_list_by_category', 'get', reverse('product_list_by_category', args=[category.slug]), {}
+        yield 'product_detail', 'get', reverse('product_detail', args=[product.slug]), {}
+        yield 'add_to_cart', 'post', reverse('add_to_cart', args=[product.id]), {'data': {'quantity': 1}}
+        yield 'cart', 'get', reverse('cart'), {}
+        yield 'checkout', 'get', reverse('checkout'), {}
+        yield 'checkout[post]', 'post', reverse('checkout'), {'data': checkout_data, 'content_type': 'application/json'}
+        yield 'order_list', 'get', reverse('order_list'), {}
+
+    def client_for(self, seed, tier):
+        client = Client()
+        if tier != 'guest':
+            client.force_login(seed['users'][tier][0])
+        # Give cart and checkout a realistic cart to work with.
+        for product in seed['products'][:5]:
+            client.post(reverse('add_to_cart', args=[product.id]), {'quantity': 1}, secure=True)
+        return client
+
+    def run(self, seed, options):
+        results = []
+        self.stdout.write(f'{"scenario":<32} {"tier":<9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} '
+                          f'{"queries":>8} {"alloc KiB":>10}')
+        for tier in ('guest', 'normal', 'business'):
+            client = self.client_for(seed, tier)
+            for name, method, url, kwargs in self.scenarios(seed):
+                if name == 'order_list' and tier == 'guest':
+                    continue
+                request = getattr(client, method)
+                timings, queries, statuses = [], [], set()
+                for _ in range(options['requests']):
+                    with CaptureQueriesContext(connection) as captured:
+                        start = time.perf_counter()
+                        response = request(url, secure=True, **kwargs)
+                        timings.append(time.perf_counter() - start)
+                    queries.append(len(captured))
+                    statuses.add(response.status_code)
+
+                allocations = []
+                for _ in range(options['traced_requests']):
+                    tracemalloc.start()
+                    request(url, secure=True, **kwargs)
+                    allocations.append(tracemalloc.get_traced_memory()[1] / 1024)
+                    tracemalloc.stop()
+
+                result = {
+                    'scenario': name, 'tier': tier, 'url': url, 'method': method.upper(),
+                    'statuses': sorted(statuses),
+                    'p50_ms': percentile(timings, 50) * 1000,
+                    'p95_ms': percentile(timings, 95) * 1000,
+                    'p99_ms': percentile(timings, 99) * 1000,
+                    'mean_ms': statistics.mean(timings) * 1000,
+                    'queries_per_request': statistics.mean(queries),
+                    'alloc_peak_kib_per_request': statistics.mean(allocations) if allocations else None,
+                }
+                results.append(result)
+                alloc = f'{result["alloc_peak_kib_per_request"]:>10.1f}' if allocations else f'{"-":>10}'
+                self.stdout.write(f'{name:<32} {tier:<9} {result["p50_ms"]:>8.2f} {result["p95_ms"]:>8.2f} '
+                                  f'{result["p99_ms"]:>8.2f} {result["queries_per_request"]:>8.1f} {alloc}')
+        return results
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from products.cache import get_generation, get_stats, reset_stats
+
+
+class Command(BaseCommand):
+    """
+    Shows how well the catalog response cache is doing: hits (fresh and
+    stale), misses, hit rate and the render time saved by hits.
+    """
+    help = 'Prints catalog cache statistics.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after printing them.')
+
+    def handle(self, *args, **options):
+        stats = get_stats()
+        self.stdout.write(f'generation={get_generation()}')
+        self.stdout.write(
+            f'hits={stats["hits"]} stale_hits={stats["stale_hits"]} misses={stats["misses"]} '
+            f'hit_rate={stats["hit_rate"]:.1%} saved={stats["saved_ms"] / 1000:.1f}s'
+        )
+        if options['reset']:
+            reset_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset.'))
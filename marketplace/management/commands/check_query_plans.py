@@ -0,0 +1,213 @@
+import html
+import re
+import uuid
+from decimal import Decimal
+from urllib.parse import unquote
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from orders.models import Order, OrderItem
+from products import related
+from products.facets import get_index
+from products.models import Category, Color, Product, RelatedProduct, Size
+
+SORTS = (None, 'latest', 'price_low_to_high', 'price_high_to_low', 'name_a_to_z')
+
+# Tables that must never be read with a sequential scan on the request paths.
+WATCHED_TABLES = {
+    Product._meta.db_table,
+    Product.sizes.through._meta.db_table,
+    Product.colors.through._meta.db_table,
+    RelatedProduct._meta.db_table,
+    Order._meta.db_table,
+    OrderItem._meta.db_table,
+}
+
+CURSOR_LINK = re.compile(r'\?cursor=([^"&]+)')
+PG_SEQ_SCAN = re.compile(r'Seq Scan on "?(\w+)"?')
+SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?: AS \w+)?$')
+
+
+class _Rollback(Exception):
+    pass
+
+
+def gated(sql):
+    """COUNT queries are cached by the paginator and may fairly scan; see Command."""
+    return not sql.lstrip().upper().startswith('SELECT COUNT(')
+
+
+def explain(sql, params):
+    """Return the plan lines and the tables it scans sequentially."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'EXPLAIN {sql}', params)
+            lines = [row[0] for row in cursor.fetchall()]
+            return lines, {m.group(1) for line in lines for m in [PG_SEQ_SCAN.search(line)] if m}
+        if connection.vendor == 'sqlite':
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+            lines = [row[3] for row in cursor.fetchall()]
+            return lines, {m.group(1) for line in lines for m in [SQLITE_SCAN.match(line)] if m}
+    raise CommandError(f'EXPLAIN checks are not implemented for {connection.vendor}.')
+
+
+class Command(BaseCommand):
+    """
+    Seeds a catalog and order history, requests every catalog and order
+    path (including a cursor page of each listing) with the test client,
+    and EXPLAINs every SELECT they run. Fails when a plan reads one of
+    WATCHED_TABLES with a sequential scan, i.e. when a listing or lookup
+    has lost its index. All seeded data is rolled back.
+
+    COUNT queries are reported but not gated: they are cached by the
+    paginator and on PostgreSQL may legitimately prefer a sequential scan
+    when most products are available.
+
+    Run with DEBUG=True or after collectstatic, since templates resolve
+    static files through the configured storage. ``marketplace.tests``
+    runs the same paths on a small catalog under ``manage.py test``; this
+    command is for checking plans at production-like sizes and on the
+    production database engine.
+    """
+    help = 'Checks the query plans of the storefront request paths for sequential scans.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--categories', type=int, default=20)
+        parser.add_argument('--products', type=int, default=20000)
+        parser.add_argument('--users', type=int, default=20)
+        parser.add_argument('--orders', type=int, default=200, help='Orders per user.')
+        parser.add_argument('--show-plans', action='store_true', help='Print every plan, not just failures.')
+
+    def handle(self, *args, **options):
+        # Run every query: cached pages and counts would hide their plans.
+        with override_settings(CATALOG_CACHE_TIMEOUT=0, PAGINATION_COUNT_CACHE_TIMEOUT=0):
+            try:
+                with transaction.atomic():
+                    seed = self.seed(options)
+                    with connection.cursor() as cursor:
+                        cursor.execute('ANALYZE')
+                    failures = self.run(seed, options)
+                    raise _Rollback
+            except _Rollback:
+                pass
+
+        if failures:
+            raise CommandError(f'{failures} queries scan a watched table sequentially.')
+        self.stdout.write(self.style.SUCCESS('No sequential scans on watched tables.'))
+
+    def seed(self, options):
+        tag = uuid.uuid4().hex[:8]
+        categories = Category.objects.bulk_create([
+            Category(name=f'Plans {tag} {i}', slug=f'plans-{tag}-{i}') for i in range(options['categories'])
+        ])
+        sizes = Size.objects.bulk_create([Size(name=f'S{tag}{i}') for i in range(4)])
+        colors = Color.objects.bulk_create([Color(name=f'C{tag}{i}') for i in range(4)])
+        products = Product.objects.bulk_create([
+            Product(
+                name=f'Plans product {i:06d}', slug=f'plans-{tag}-{i}', description='Lorem ipsum',
+                price=Decimal(10 + i % 490) + Decimal('0.99'), category=categories[i % len(categories)],
+                stock=100, available=i % 7 != 0,
+            )
+            for i in range(options['products'])
+        ], batch_size=1000)
+        Product.sizes.through.objects.bulk_create([
+            Product.sizes.through(product_id=p.id, size_id=sizes[p.id % len(sizes)].id) for p in products
+        ], batch_size=1000)
+        Product.colors.through.objects.bulk_create([
+            Product.colors.through(product_id=p.id, color_id=colors[p.id % len(colors)].id) for p in products
+        ], batch_size=1000)
+
+        User = get_user_model()
+        users = [
+            User.objects.create_user(username=f'plans-{tag}-{i}', email=f'plans-{tag}-{i}@example.com', password=None)
+            for i in range(options['users'])
+        ]
+        orders = Order.objects.bulk_create([
+            Order(user=user, email=user.email, full_name='Plans', address='Street 1', city='City',
+                  state='State', postal_code='0000', country='Country', phone='0', status='processing',
+                  total_amount=Decimal('42.00'), stripe_session_id=f'cs_plans_{tag}_{user.id}_{i}')
+            for user in users for i in range(options['orders'])
+        ], batch_size=1000)
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=products[order.id % len(products)], price=Decimal('21.00'), quantity=2)
+            for order in orders
+        ], batch_size=1000)
+        # The product page reads the neighbours the periodic job ranks.
+        related.refresh()
+        return {'category': categories[0], 'product': products[1], 'user': users[0],
+                'order': next(o for o in orders if o.user_id == users[0].id)}
+
+    def scenarios(self, seed):
+        for sort in SORTS:
+            query = f'?sort={sort}' if sort else ''
+            yield f'product_list[{sort or "default"}]', reverse('product_list') + query
+            yield (f'product_list_by_category[{sort or "default"}]',
+                   reverse('product_list_by_category', args=[seed['category'].slug]) + query)
+        yield 'home', reverse('home')
+        yield 'product_detail', reverse('product_detail', args=[seed['product'].slug])
+        yield 'order_list', reverse('order_list')
+        yield 'order_detail', reverse('order_detail', args=[seed['order'].id])
+        yield 'payment_success', reverse('payment_success')
+        yield 'payment_status', reverse('payment_status')
+
+    def logged_in_client(self, seed):
+        """A client for the seeded user, back from paying the seeded order."""
+        client = Client()
+        client.force_login(seed['user'])
+        session = client.session
+        session['stripe_checkout_session_id'] = seed['order'].stripe_session_id
+        session.save()
+        return client
+
+    def run(self, seed, options):
+        client = self.logged_in_client(seed)
+
+        # Building the facet index reads the whole join tables once per
+        # catalog generation, not per request: keep it out of the plans.
+        get_index()
+
+        failures = 0
+        for name, url in self.scenarios(seed):
+            for label, queries in self.paths(client, name, url):
+                for sql, params in queries:
+                    lines, scanned = explain(sql, params)
+                    bad = scanned & WATCHED_TABLES if gated(sql) else set()
+                    failures += bool(bad)
+                    if bad or options['show_plans']:
+                        style = self.style.ERROR if bad else self.style.NOTICE
+                        self.stdout.write(style(f'{label}: {"sequential scan of " + ", ".join(sorted(bad)) if bad else "ok"}'))
+                        self.stdout.write(f'  {sql}')
+                        for line in lines:
+                            self.stdout.write(f'    {line}')
+                self.stdout.write(f'{label:<48} {len(queries):>3} queries')
+        return failures
+
+    def paths(self, client, name, url):
+        """``(label, SELECTs)`` for ``url`` and for the first cursor link on it."""
+        statements = self.capture(client, url)
+        # Follow the first cursor link as well: the seek query differs from page 1.
+        cursor = CURSOR_LINK.search(statements.pop())
+        yield name, statements
+        if cursor:
+            cursor_url = f'{url}{"&" if "?" in url else "?"}cursor={unquote(html.unescape(cursor.group(1)))}'
+            yield f'{name}[cursor]', self.capture(client, cursor_url)[:-1]
+
+    def capture(self, client, url):
+        """Request ``url``; return its SELECTs followed by the response body."""
+        statements = []
+
+        def record(execute, sql, params, many, context):
+            if sql.lstrip().upper().startswith('SELECT'):
+                statements.append((sql, params))
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(record):
+            response = client.get(url, secure=True)
+        if response.status_code != 200:
+            raise CommandError(f'{url} returned {response.status_code}')
+        return statements + [response.content.decode()]
@@ -0,0 +1,70 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.apps import apps
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+from products import renditions
+from products.models import Product
+
+
+def _init_worker():
+    # Spawned (rather than forked) workers start without Django set up.
+    if not apps.ready:
+        django.setup()
+
+
+def _render(product_id, name):
+    try:
+        return product_id, name, renditions.render(name), None
+    except Exception as e:
+        return product_id, name, None, f'{type(e).__name__}: {e}'
+
+
+class Command(BaseCommand):
+    """
+    Generates image renditions for products that lack them, or whose image
+    changed since, in a pool of worker processes. The workers only read and
+    write the storage; this process stores the results on the products.
+    Needed once for images uploaded before renditions existed, and after
+    changing PRODUCT_IMAGE_WIDTHS (with --force).
+    """
+    help = 'Generates missing product image renditions.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+        parser.add_argument('--force', action='store_true', help='Regenerate renditions that are up to date.')
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image='').exclude(image=None).values_list('pk', 'image', 'renditions')
+        jobs = [(pk, name) for pk, name, current in products.iterator()
+                if options['force'] or current.get('source') != name]
+        if not jobs:
+            self.stdout.write(self.style.SUCCESS('All product images have renditions.'))
+            return
+        self.stdout.write(f'Rendering {len(jobs)} image(s) with {options["workers"]} worker(s)...')
+
+        # Forked workers must not share this process's database connections.
+        connections.close_all()
+        start = time.perf_counter()
+        done = failed = skipped = 0
+        with ProcessPoolExecutor(max_workers=options['workers'], initializer=_init_worker) as pool:
+            futures = [pool.submit(_render, pk, name) for pk, name in jobs]
+            for future in as_completed(futures):
+                product_id, name, metadata, error = future.result()
+                if error:
+                    failed += 1
+                    self.stderr.write(f'Product {product_id} ({name}): {error}')
+                elif renditions.save(product_id, name, metadata):
+                    done += 1
+                else:
+                    # The image changed meanwhile; its save signal renders it.
+                    skipped += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Rendered {done} image(s) in {time.perf_counter() - start:.1f}s, '
+            f'{skipped} changed meanwhile, {failed} failed.'
+        ))
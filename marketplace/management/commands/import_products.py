@@ -0,0 +1,59 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products import imports
+
+
+class Command(BaseCommand):
+    """
+    Creates and updates products from a CSV or JSON Lines file, like the
+    product admin's import page; see products.imports for the columns.
+    The format follows the file extension unless --format is given. With
+    --dry-run nothing is saved, and the report lists what would change.
+    """
+    help = 'Bulk imports products from CSV or JSON Lines.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=imports.FORMATS)
+        parser.add_argument('--dry-run', action='store_true', help='Report changes without saving them.')
+        parser.add_argument('--workers', type=int, help='Processes sanitizing descriptions.')
+        parser.add_argument('--batch-size', type=int, help='Rows applied per batch.')
+        parser.add_argument('--report', help='Write the full report as JSON to this file.')
+        parser.add_argument('--show', type=int, default=20, help='Changes and errors to print.')
+
+    def handle(self, *args, **options):
+        format = options['format'] or os.path.splitext(options['path'])[1].lower().lstrip('.')
+        if format == 'ndjson':
+            format = 'jsonl'
+        if format not in imports.FORMATS:
+            raise CommandError('Pass --format for files not ending in .csv or .jsonl.')
+        try:
+            with open(options['path'], 'rb') as f:
+                report = imports.import_products(f, format, dry_run=options['dry_run'],
+                                                 workers=options['workers'], batch_size=options['batch_size'])
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+
+        for change in report.changes[:options['show']]:
+            self.stdout.write(f'{change["line"]:>7} {change["action"]:<6} {change["slug"]}')
+            for name, (old, new) in change['fields'].items():
+                self.stdout.write(f'        {name}: {old!r} -> {new!r}')
+        for line, message in report.errors[:options['show']]:
+            self.stderr.write(f'{line:>7} skipped: {message}')
+        for kind in ('categories', 'sizes', 'colors'):
+            names = getattr(report, f'new_{kind}')
+            if names:
+                self.stdout.write(f'New {kind}: {", ".join(names)}')
+        if report.field_changes:
+            self.stdout.write('Changed fields: ' + ', '.join(
+                f'{name} {count}' for name, count in report.field_changes.most_common()))
+        if options['report']:
+            with open(options['report'], 'w') as f:
+                json.dump(report.as_dict(), f, indent=2)
+        self.stdout.write(self.style.SUCCESS(
+            f'{report.summary()} {report.rows} row(s) in {report.elapsed_s:.1f}s, '
+            f'{report.sanitized} description(s) sanitized.'
+        ))
@@ -0,0 +1,91 @@
+import threading
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+from django.db.models import Min
+from django.utils import timezone
+
+from orders.models import WebhookEvent
+from orders.webhooks import claim_batch, process
+
+
+class Command(BaseCommand):
+    """
+    Worker that drains the WebhookEvent table written by StripeWebhookView.
+    Runs until interrupted, or until the queue is empty with --once.
+    Several worker processes may run side by side.
+    """
+    help = 'Processes queued Stripe webhook events.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--concurrency', type=int, default=1, help='Worker threads in this process.')
+        parser.add_argument('--batch-size', type=int, default=20)
+        parser.add_argument('--poll-interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty.')
+        parser.add_argument('--stale-after', type=int, default=300,
+                            help='Seconds after which an event claimed by a dead worker is reclaimed.')
+        parser.add_argument('--stats-interval', type=float, default=30.0)
+        parser.add_argument('--once', action='store_true', help='Exit once no event is due.')
+
+    def handle(self, *args, **options):
+        self.options = options
+        self.lock = threading.Lock()
+        self.processed = self.failed = 0
+        self.lag_total = self.lag_max = 0.0
+        self.stop = threading.Event()
+        self.started = time.monotonic()
+
+        workers = [threading.Thread(target=self.work, daemon=True) for _ in range(options['concurrency'])]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(self.style.SUCCESS(f'Processing webhook events with {len(workers)} worker(s).'))
+
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(timeout=options['stats_interval'] / len(workers))
+                self.report()
+        except KeyboardInterrupt:
+            self.stop.set()
+            for worker in workers:
+                worker.join()
+            self.report()
+
+    def work(self):
+        options = self.options
+        try:
+            while not self.stop.is_set():
+                try:
+                    events = claim_batch(options['batch_size'], options['stale_after'])
+                except OperationalError:
+                    # SQLite reports a concurrent claim as "database is locked".
+                    time.sleep(options['poll_interval'] / 10)
+                    continue
+                if not events:
+                    if options['once']:
+                        return
+                    self.stop.wait(options['poll_interval'])
+                    continue
+                for event in events:
+                    ok = process(event)
+                    lag = (timezone.now() - event.created_at).total_seconds()
+                    with self.lock:
+                        self.processed += ok
+                        self.failed += not ok
+                        self.lag_total += lag
+                        self.lag_max = max(self.lag_max, lag)
+        finally:
+            connection.close()
+
+    def report(self):
+        with self.lock:
+            handled = self.processed + self.failed
+            elapsed = time.monotonic() - self.started
+            rate = handled / elapsed if elapsed else 0.0
+            avg_lag = self.lag_total / handled if handled else 0.0
+            stats = (f'processed={self.processed} failed={self.failed} rate={rate:.1f} events/s '
+                     f'lag_avg={avg_lag:.2f}s lag_max={self.lag_max:.2f}s')
+        backlog = WebhookEvent.objects.filter(status='pending', next_attempt_at__lte=timezone.now())
+        oldest = backlog.aggregate(oldest=Min('created_at'))['oldest']
+        queue_lag = (timezone.now() - oldest).total_seconds() if oldest else 0.0
+        self.stdout.write(f'{stats} backlog={backlog.count()} backlog_lag={queue_lag:.2f}s')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from orders.cart_store import purge_guest_carts
+
+
+class Command(BaseCommand):
+    """
+    Deletes guest carts nobody has touched for CART_COOKIE_AGE, by which
+    time their cookies have expired. Meant to run daily from a scheduler.
+    """
+    help = 'Deletes abandoned guest carts.'
+
+    def handle(self, *args, **options):
+        purged = purge_guest_carts()
+        self.stdout.write(self.style.SUCCESS(f'Purged {purged} guest cart(s).'))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from products import related
+
+
+class Command(BaseCommand):
+    """
+    Counts the orders placed since the last run into the co-purchase matrix
+    and reranks the related products of everything they contain, plus
+    products that have none yet. Meant to run periodically (e.g. hourly
+    from a scheduler); --rebuild recounts every order and reranks every
+    product, e.g. nightly.
+    """
+    help = 'Refreshes the related products shown on product pages from co-purchases.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rebuild', action='store_true', help='Recount every order and rerank every product.')
+        parser.add_argument('--batch-size', type=int, help='Orders counted per transaction.')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] is not None and options['batch_size'] < 1:
+            raise CommandError('--batch-size must be at least 1.')
+        progress = (lambda message: self.stdout.write(f'  {message}')) if options['verbosity'] > 1 else None
+        report = related.refresh(rebuild=options['rebuild'], batch_size=options['batch_size'], progress=progress)
+        self.stdout.write(self.style.SUCCESS(report.summary()))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from orders.inventory import release_expired_reservations
+
+
+class Command(BaseCommand):
+    """
+    Returns stock held by checkouts that were abandoned past their TTL.
+    Meant to run periodically (e.g. every few minutes from a scheduler).
+    """
+    help = 'Releases stock reservations whose TTL has expired.'
+
+    def handle(self, *args, **options):
+        released = release_expired_reservations()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} expired reservation(s).'))
@@ -0,0 +1,242 @@
+"""
+Per-request instrumentation.
+
+``RequestMetricsMiddleware`` records, for a sample of requests, the resolved
+URL name, total time, database time, query count, duplicated queries (by
+normalized SQL fingerprint) and template render time. It emits a
+``Server-Timing`` header, one structured log line per request on the
+``marketplace.requests`` logger (only built when INFO is enabled there), and
+a warning with the most duplicated queries on ``marketplace.slow_requests``
+when a threshold is exceeded.
+
+Queries are captured by an execute wrapper installed on every database
+connection; the wrapper finds the current request through a context
+variable, so it works under WSGI and ASGI alike (``sync_to_async`` copies
+the context into the thread running the ORM call). Template rendering is
+timed the same way by ``DjangoTemplates``, the template backend configured in
+``TEMPLATES``, whatever renders the template: ``render()``,
+``render_to_string`` or a ``TemplateResponse``.
+
+``StaticFilesMiddleware`` and ``AccountMiddleware`` are WhiteNoise's and
+allauth's middleware made async-capable. A sync-only middleware would make
+Django run everything inside it through ``async_to_sync`` under ASGI, tying
+up a thread per request for as long as an async view awaits. Both are
+listed in ``MIDDLEWARE`` in place of the originals; allauth's app config is
+replaced by ``marketplace.apps.AccountConfig``, which checks for this one.
+"""
+import contextvars
+import json
+import random
+import re
+import time
+from collections import Counter
+
+from allauth.account.middleware import AccountMiddleware as BaseAccountMiddleware
+from allauth.core import context
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.template.backends import django as django_backend
+from whitenoise.middleware import WhiteNoiseMiddleware
+
+import logging
+
+logger = logging.getLogger('marketplace.requests')
+slow_logger = logging.getLogger('marketplace.slow_requests')
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+_WHITESPACE = re.compile(r'\s+')
+_LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r'\(\s*(?:%s|\?)(?:\s*,\s*(?:%s|\?))*\s*\)')
+
+
+def fingerprint(sql):
+    """Normalize SQL so queries differing only in parameters compare equal."""
+    sql = _LITERAL.sub('?', sql)
+    sql = _PLACEHOLDER_LIST.sub('(...)', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_time = 0.0
+        self.template_time = 0.0
+        # Templates rendered from inside another one are timed by the outer one.
+        self.rendering = 0
+        self.queries = Counter()
+
+    @property
+    def query_count(self):
+        return sum(self.queries.values())
+
+    @property
+    def duplicate_count(self):
+        return self.query_count - len(self.queries)
+
+    def top_duplicates(self, limit=5):
+        return [(sql, count) for sql, count in self.queries.most_common(limit) if count > 1]
+
+
+def _record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.db_time += time.perf_counter() - start
+        metrics.queries[fingerprint(sql)] += 1
+
+
+def _install_wrapper(sender, connection, **kwargs):
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+connection_created.connect(_install_wrapper)
+
+
+class _TimedTemplate(django_backend.Template):
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None or metrics.rendering:
+            return super().render(context, request)
+        metrics.rendering += 1
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.template_time += time.perf_counter() - start
+            metrics.rendering -= 1
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """Django's template backend, timing renders for ``RequestMetricsMiddleware``."""
+
+    def from_string(self, template_code):
+        return _TimedTemplate(self.engine.from_string(template_code), self)
+
+    def get_template(self, template_name):
+        try:
+            return _TimedTemplate(self.engine.get_template(template_name), self)
+        except django_backend.TemplateDoesNotExist as exc:
+            django_backend.reraise(exc, self)
+
+
+class RequestMetricsMiddleware:
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.REQUEST_METRICS_SAMPLE_RATE
+        self.slow_ms = settings.REQUEST_METRICS_SLOW_MS
+        self.slow_queries = settings.REQUEST_METRICS_SLOW_QUERIES
+        self.server_timing = settings.REQUEST_METRICS_SERVER_TIMING
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics)
+
+    def sampled(self):
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def finish(self, request, response, metrics):
+        total_ms = (time.perf_counter() - metrics.start) * 1000
+        db_ms = metrics.db_time * 1000
+        template_ms = metrics.template_time * 1000
+        match = getattr(request, 'resolver_match', None)
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'url_name': match.view_name if match else None,
+            'status': response.status_code,
+            'total_ms': round(total_ms, 2),
+            'db_ms': round(db_ms, 2),
+            'template_ms': round(template_ms, 2),
+            'queries': metrics.query_count,
+            'duplicate_queries': metrics.duplicate_count,
+        }
+
+        if self.server_timing:
+            response['Server-Timing'] = (
+                f'db;dur={db_ms:.2f};desc="{metrics.query_count} queries", '
+                f'tpl;dur={template_ms:.2f}, total;dur={total_ms:.2f}'
+            )
+        if logger.isEnabledFor(logging.INFO):
+            logger.info(json.dumps(record))
+        if total_ms >= self.slow_ms or metrics.query_count >= self.slow_queries:
+            record['top_duplicates'] = metrics.top_duplicates()
+            slow_logger.warning(json.dumps(record))
+        return response
+
+
+class StaticFilesMiddleware(WhiteNoiseMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response=None, settings=settings):
+        super().__init__(get_response, settings=settings)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        if self.autorefresh:
+            static_file = await sync_to_async(self.find_file, thread_sensitive=False)(request.path_info)
+        else:
+            static_file = self.files.get(request.path_info)
+        if static_file is not None:
+            return await sync_to_async(self.serve, thread_sensitive=False)(static_file, request)
+        return await self.get_response(request)
+
+
+class AccountMiddleware(BaseAccountMiddleware):
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return super().__call__(request)
+
+    async def __acall__(self, request):
+        with context.request_context(request):
+            response = await self.get_response(request)
+            # Reads the session, so it may touch the database.
+            await sync_to_async(self._remove_dangling_login)(request, response)
+            return response
@@ -0,0 +1,218 @@
+"""
+Keyset (cursor) pagination for list views.
+
+``?page=N`` keeps working as classic OFFSET pagination, but its ``COUNT(*)``
+is cached and the page links are elided. Every page also carries opaque
+``next_cursor``/``previous_cursor`` tokens; following them (``?cursor=...``)
+seeks from the last/first row shown using the view's ordering plus an ``id``
+tiebreaker, so page 10,000 costs the same as page 1.
+
+Cursors are signed, so they cannot be forged into arbitrary filters, and
+carry the page number so the elided page links still render around them.
+They also carry the ordering they were made for: a cursor followed with
+another ordering (e.g. ``?sort=`` changed) is rejected with a 404 rather
+than seeking on the wrong columns.
+"""
+import datetime
+import hashlib
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet, ValidationError
+from django.core.paginator import Page, Paginator
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+CURSOR_SALT = 'marketplace.pagination.cursor'
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+def keyset_ordering(queryset):
+    """
+    The queryset's ordering as ``(field, descending)`` pairs, ending with the
+    primary key so that every row has a unique position.
+    """
+    ordering = queryset.query.order_by or queryset.model._meta.ordering
+    keys = []
+    for field in ordering:
+        if not isinstance(field, str) or field == '?':
+            raise ValueError(f'Cannot paginate by cursor over ordering {field!r}')
+        descending = field.startswith('-')
+        name = field.lstrip('-')
+        keys.append(('pk' if name in ('id', 'pk') else name, descending))
+    if not any(name == 'pk' for name, _ in keys):
+        keys.append(('pk', keys[0][1] if keys else False))
+    return keys
+
+
+def _order_by(keys, reverse=False):
+    return [f'{"-" if descending != reverse else ""}{name}' for name, descending in keys]
+
+
+def _seek(keys, values, reverse=False):
+    """Rows strictly after ``values`` in ``keys`` order (before, when ``reverse``)."""
+    condition = None
+    for (name, descending), value in reversed(list(zip(keys, values))):
+        lookup = 'lt' if descending != reverse else 'gt'
+        step = Q(**{f'{name}__{lookup}': value})
+        if condition is not None:
+            step |= Q(**{name: value}) & condition
+        condition = step
+    return condition
+
+
+def _value(obj, name):
+    for part in name.split('__'):
+        obj = getattr(obj, part)
+    return obj
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder drops microseconds, which would make seeks skip rows.
+        if isinstance(o, datetime.datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class CursorSerializer:
+    def dumps(self, obj):
+        return CursorEncoder(separators=(',', ':')).encode(obj).encode('latin-1')
+
+    def loads(self, data):
+        return signing.JSONSerializer().loads(data)
+
+
+class KeysetPage(Page):
+    def __init__(self, object_list, number, paginator, has_next=None, has_previous=None):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def has_next(self):
+        return super().has_next() if self._has_next is None else self._has_next
+
+    def has_previous(self):
+        return super().has_previous() if self._has_previous is None else self._has_previous
+
+    def _cursor(self, obj, number, reverse):
+        values = [_value(obj, name) for name, _ in self.paginator.keys]
+        return signing.dumps(
+            {'k': self.paginator.keys, 'v': values, 'n': number, 'r': reverse},
+            salt=CURSOR_SALT, serializer=CursorSerializer, compress=True,
+        )
+
+    @cached_property
+    def next_cursor(self):
+        if not self.has_next() or not len(self):
+            return None
+        return self._cursor(self[len(self) - 1], self.number + 1, False)
+
+    @cached_property
+    def previous_cursor(self):
+        if not self.has_previous() or not len(self):
+            return None
+        return self._cursor(self[0], self.number - 1, True)
+
+    @cached_property
+    def elided_page_range(self):
+        paginator = self.paginator
+        # A cached count may lag behind the rows a cursor has reached.
+        number = min(self.number, paginator.num_pages)
+        return list(paginator.get_elided_page_range(number, on_each_side=2, on_ends=1))
+
+
+class KeysetPaginator(Paginator):
+    """
+    A ``Paginator`` whose count is cached and which can also seek to a page
+    from a cursor. ``count_version`` is folded into the count's cache key,
+    so callers with their own invalidation (the catalog generation) can use
+    it to drop stale counts immediately. Callers that already know the
+    count can pass it as ``count`` to skip the query.
+    """
+
+    def __init__(self, object_list, per_page, count_version=None, count=None, **kwargs):
+        self.keys = keyset_ordering(object_list)
+        super().__init__(object_list.order_by(*_order_by(self.keys)), per_page, **kwargs)
+        self.count_version = count_version
+        if count is not None:
+            self.__dict__['count'] = count
+
+    @cached_property
+    def count(self):
+        timeout = settings.PAGINATION_COUNT_CACHE_TIMEOUT
+        try:
+            sql, params = self.object_list.query.sql_with_params()
+        except EmptyResultSet:
+            return 0
+        if timeout <= 0:
+            return super().count
+        digest = hashlib.md5(repr((sql, params, self.count_version)).encode()).hexdigest()
+        key = f'pagination:count:{digest}'
+        count = cache.get(key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(key, count, timeout)
+        return count
+
+    def _get_page(self, *args, **kwargs):
+        return KeysetPage(*args, **kwargs)
+
+    def cursor_page(self, token):
+        try:
+            cursor = signing.loads(token, salt=CURSOR_SALT)
+            keys, values, number, reverse = cursor['k'], cursor['v'], int(cursor['n']), bool(cursor['r'])
+        except (signing.BadSignature, KeyError, TypeError, ValueError):
+            raise InvalidCursor(token)
+        # Made for another ordering: its values are for other columns.
+        if keys != [[name, descending] for name, descending in self.keys] or len(values) != len(self.keys):
+            raise InvalidCursor(token)
+
+        queryset = self.object_list
+        if reverse:
+            queryset = queryset.order_by(*_order_by(self.keys, reverse=True))
+        try:
+            queryset = queryset.filter(_seek(self.keys, values, reverse))
+        except (ValidationError, TypeError, ValueError):
+            raise InvalidCursor(token)
+        rows = list(queryset[:self.per_page + 1])
+        has_more = len(rows) > self.per_page
+        rows = rows[:self.per_page]
+        if reverse:
+            rows.reverse()
+            return KeysetPage(rows, max(number, 1), self, has_next=True, has_previous=has_more)
+        return KeysetPage(rows, number, self, has_next=has_more, has_previous=True)
+
+
+class KeysetPaginationMixin:
+    """
+    For ``ListView``: paginate with ``KeysetPaginator`` and accept
+    ``?cursor=`` alongside ``?page=``. The view's queryset must be ordered
+    by concrete columns or annotations (the model's default ordering
+    counts).
+    """
+    paginator_class = KeysetPaginator
+    cursor_kwarg = 'cursor'
+
+    def get_count_version(self):
+        return None
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return super().get_paginator(queryset, per_page, count_version=self.get_count_version(), **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        token = self.request.GET.get(self.cursor_kwarg)
+        if not token:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = self.get_paginator(queryset, page_size)
+        try:
+            page = paginator.cursor_page(token)
+        except InvalidCursor:
+            raise Http404('Invalid cursor.')
+        return (paginator, page, page.object_list, page.has_other_pages())
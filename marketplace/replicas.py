@@ -0,0 +1,309 @@
+"""
+Read replicas for the catalog.
+
+Replicas are configured with ``DATABASE_REPLICA_URLS`` and appear in
+``DATABASES`` as ``replica_0``, ``replica_1``, ... (``DATABASE_REPLICAS``).
+``ReplicaRouter`` sends reads of the catalog models (``REPLICATED_MODELS``
+and their size/color link tables) to one of them, picked once per request.
+Everything else, and every write, goes to ``default``.
+
+Catalog reads stay on the primary when a replica could return rows older
+than what the reader has seen or been promised:
+
+* For the rest of a request that wrote to a catalog model, and for
+  ``REPLICA_PIN_SECONDS`` afterwards through a signed cookie set by
+  ``ReplicaPinningMiddleware`` (read-your-writes). Cart, order and session
+  writes don't pin, since no catalog read depends on them.
+* Inside a transaction on the primary.
+* After a catalog change (a generation bump: an edit, or a product selling
+  out; plain sales don't count), until the replica's measured lag shows it
+  has replayed the change, so the catalog response cache and the facet
+  index never store pre-change rows under the new catalog generation.
+  A change newer than the last lag check triggers a new check. Backends
+  that can't measure lag wait ``REPLICA_MAX_LAG`` seconds instead.
+* Inside ``use_primary()``, a context manager and decorator for code and
+  views (sync or async) that must see the latest data.
+
+Each process measures replica lag at most every
+``REPLICA_LAG_CHECK_INTERVAL`` seconds, or sooner after a catalog change
+(PostgreSQL only; other backends report none). A replica more than ``REPLICA_MAX_LAG`` seconds behind, or
+that can't be reached, is skipped until the next check; with no healthy
+replica, reads fall back to the primary.
+"""
+import contextvars
+import logging
+import random
+import threading
+import time
+from contextlib import ContextDecorator
+from dataclasses import dataclass
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core import signing
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+from products.cache import get_catalog_version
+
+logger = logging.getLogger(__name__)
+
+REPLICATED_MODELS = {
+    'products.product', 'products.category', 'products.size', 'products.color', 'products.relatedproduct',
+}
+PIN_COOKIE_NAME = 'db_pin'
+PIN_COOKIE_SALT = 'marketplace.replicas.pin'
+
+_state = contextvars.ContextVar('replica_routing', default=None)
+_forced = contextvars.ContextVar('replica_routing_forced', default=False)
+
+_health = {}
+_health_lock = threading.Lock()
+
+
+@dataclass(frozen=True)
+class Health:
+    """A replica lag check: when (monotonic and wall clock), and what it found."""
+    checked: float
+    checked_at: float
+    healthy: bool
+    lag: float = None
+
+
+class RoutingState:
+    """Routing decisions for one request."""
+
+    def __init__(self, pinned=False):
+        self.pinned = pinned
+        self.wrote = False
+        self.replica = None
+        self.catalog_changed_at = None
+        self.catalog_checked = False
+        self.replica_current = None
+
+
+def is_replicated(model):
+    opts = model._meta
+    if opts.auto_created:
+        # A many-to-many link table follows the model that declares it.
+        opts = opts.auto_created._meta
+    return opts.label_lower in REPLICATED_MODELS
+
+
+def replica_lag(alias):
+    """Seconds ``alias`` is behind its primary, or None if it can't tell."""
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        # A standby that has replayed everything it received isn't behind,
+        # however long ago the primary last wrote.
+        cursor.execute(
+            'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+            'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+        )
+        lag = cursor.fetchone()[0]
+    return None if lag is None else float(lag)
+
+
+def get_health(alias, since=None):
+    """
+    The last lag check of ``alias``, checking again if it's older than
+    ``REPLICA_LAG_CHECK_INTERVAL`` or than ``since`` (a ``time.time()``).
+    """
+    health = _health.get(alias)
+    if (health is not None and time.monotonic() - health.checked < settings.REPLICA_LAG_CHECK_INTERVAL
+            and (since is None or health.checked_at >= since)):
+        return health
+    checked, checked_at = time.monotonic(), time.time()
+    try:
+        lag = replica_lag(alias)
+    except DatabaseError:
+        logger.warning('Replica %s is unreachable; reading from the primary.', alias, exc_info=True)
+        lag, healthy = None, False
+    else:
+        healthy = lag is None or lag <= settings.REPLICA_MAX_LAG
+        if not healthy:
+            logger.warning('Replica %s is %.1fs behind; reading from the primary.', alias, lag)
+    health = Health(checked, checked_at, healthy, lag)
+    with _health_lock:
+        _health[alias] = health
+    return health
+
+
+def is_healthy(alias):
+    return get_health(alias).healthy
+
+
+def has_replayed(alias, changed_at):
+    """Whether ``alias`` holds the primary's writes up to ``changed_at`` (a ``time.time()``)."""
+    health = get_health(alias, since=changed_at)
+    if not health.healthy:
+        return False
+    if health.lag is None:
+        # Lag can't be measured here; give it the most a healthy replica may have.
+        return time.time() - changed_at >= settings.REPLICA_MAX_LAG
+    return health.checked_at - health.lag >= changed_at
+
+
+def reset_health():
+    """Forget measured replica lag, so the next read checks again."""
+    with _health_lock:
+        _health.clear()
+
+
+def _catalog_changed_at(state):
+    if state is not None and state.catalog_checked:
+        return state.catalog_changed_at
+    changed_at = get_catalog_version()[1]
+    if state is not None:
+        state.catalog_changed_at, state.catalog_checked = changed_at, True
+    return changed_at
+
+
+def _is_current(state, replica):
+    """Whether ``replica`` has the latest catalog change, once per request."""
+    if state is not None and state.replica_current is not None:
+        return state.replica_current
+    changed_at = _catalog_changed_at(state)
+    current = changed_at is None or has_replayed(replica, changed_at)
+    if state is not None:
+        state.replica_current = current
+    return current
+
+
+def _pick_replica(state):
+    if state is not None and state.replica is not None:
+        return state.replica
+    healthy = [alias for alias in settings.DATABASE_REPLICAS if is_healthy(alias)]
+    replica = random.choice(healthy) if healthy else DEFAULT_DB_ALIAS
+    if state is not None:
+        state.replica = replica
+    return replica
+
+
+def _in_transaction():
+    return connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+class UsePrimary(ContextDecorator):
+    """Read the catalog from the primary inside this block, or decorated function or view."""
+
+    def _recreate_cm(self):
+        # A fresh one per call, so a decorated view can run concurrently.
+        return type(self)()
+
+    def __enter__(self):
+        self.token = _forced.set(True)
+
+    def __exit__(self, *exc_info):
+        _forced.reset(self.token)
+
+    def __call__(self, func):
+        if not iscoroutinefunction(func):
+            return super().__call__(func)
+
+        # Entered when the coroutine runs, not when it's created.
+        @wraps(func)
+        async def inner(*args, **kwargs):
+            with self._recreate_cm():
+                return await func(*args, **kwargs)
+        return inner
+
+
+def use_primary():
+    """``with use_primary():`` or ``@use_primary()``; see ``UsePrimary``."""
+    return UsePrimary()
+
+
+def pin_to_primary():
+    """Send this request's remaining catalog reads, and the visitor's next few requests, to the primary."""
+    state = _state.get()
+    if state is not None:
+        state.wrote = True
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or not is_replicated(model):
+            return None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db and is_replicated(type(instance)):
+            # Related catalog rows come from wherever their parent did.
+            return instance._state.db
+        state = _state.get()
+        if (_forced.get() or (state is not None and (state.pinned or state.wrote))
+                or _in_transaction()):
+            return DEFAULT_DB_ALIAS
+        replica = _pick_replica(state)
+        if replica != DEFAULT_DB_ALIAS and not _is_current(state, replica):
+            return DEFAULT_DB_ALIAS
+        return replica
+
+    def db_for_write(self, model, **hints):
+        if settings.DATABASE_REPLICAS and is_replicated(model):
+            pin_to_primary()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.DATABASE_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas get their schema from the primary.
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
+
+
+class ReplicaPinningMiddleware:
+    """Track catalog writes per request and pin the visitor to the primary after one."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(state, response)
+
+    async def __acall__(self, request):
+        state = self.start(request)
+        token = _state.set(state)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _state.reset(token)
+        return self.finish(state, response)
+
+    def start(self, request):
+        pinned = False
+        if settings.DATABASE_REPLICAS and PIN_COOKIE_NAME in request.COOKIES:
+            try:
+                request.get_signed_cookie(PIN_COOKIE_NAME, salt=PIN_COOKIE_SALT,
+                                          max_age=settings.REPLICA_PIN_SECONDS)
+                pinned = True
+            except (KeyError, signing.BadSignature):
+                pass
+        return RoutingState(pinned=pinned)
+
+    def finish(self, state, response):
+        if state.wrote:
+            response.set_signed_cookie(
+                PIN_COOKIE_NAME, '1', salt=PIN_COOKIE_SALT, max_age=settings.REPLICA_PIN_SECONDS,
+                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+            )
+        return response
@@ -35,30 +35,63 @@ INSTALLED_APPS = [
     'cloudinary',
     'django.contrib.sites',
     
-    'allauth', 'allauth.account', 'allauth.socialaccount',
+    # allauth.account, minus its check for its own middleware; see marketplace.apps.
+    'allauth', 'marketplace.apps.AccountConfig', 'allauth.socialaccount',
     'tailwind', 'theme',
     
-    'products', 'users', 'orders', 'pages',
+    'products', 'users', 'orders', 'pages', 'payments',
     'marketplace',
 ]
 
 MIDDLEWARE = [
+    'marketplace.middleware.RequestMetricsMiddleware',
+    'marketplace.replicas.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'marketplace.middleware.StaticFilesMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'users.auth.SnapshotAuthenticationMiddleware',
+    'orders.cart_store.CartMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    'allauth.account.middleware.AccountMiddleware', 
+    'marketplace.middleware.AccountMiddleware',  # allauth's, async-capable
 ]
 
 ROOT_URLCONF = 'marketplace.urls'
 
+# --- Request instrumentation (marketplace.middleware.RequestMetricsMiddleware) ---
+# Fraction of requests measured; requests over either threshold are logged
+# to 'marketplace.slow_requests' with their most duplicated queries.
+REQUEST_METRICS_SAMPLE_RATE = env.float('REQUEST_METRICS_SAMPLE_RATE', default=1.0)
+REQUEST_METRICS_SLOW_MS = env.float('REQUEST_METRICS_SLOW_MS', default=500.0)
+REQUEST_METRICS_SLOW_QUERIES = env.int('REQUEST_METRICS_SLOW_QUERIES', default=50)
+REQUEST_METRICS_SERVER_TIMING = env.bool('REQUEST_METRICS_SERVER_TIMING', default=DEBUG)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'marketplace.requests': {
+            'handlers': ['console'],
+            'level': env('REQUEST_METRICS_LOG_LEVEL', default='WARNING'),
+            'propagate': False,
+        },
+        'marketplace.slow_requests': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # Django's backend, timing renders for RequestMetricsMiddleware.
+        'BACKEND': 'marketplace.middleware.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -84,6 +117,77 @@ DATABASES = {
     )
 }
 
+# Read replicas for the catalog (marketplace.replicas): comma-separated
+# database URLs, added as replica_0, replica_1, ... Visitors who changed the
+# catalog read from the primary for REPLICA_PIN_SECONDS; replicas further
+# behind than REPLICA_MAX_LAG seconds (checked every
+# REPLICA_LAG_CHECK_INTERVAL seconds per process) are skipped, and after a
+# catalog change a replica is read once its lag shows it has the change (or
+# REPLICA_MAX_LAG seconds later, where lag can't be measured).
+DATABASE_REPLICAS = []
+for index, url in enumerate(env.list('DATABASE_REPLICA_URLS', default=[])):
+    DATABASES[f'replica_{index}'] = {**env.db_url_config(url), 'TEST': {'MIRROR': 'default'}}
+    DATABASE_REPLICAS.append(f'replica_{index}')
+# Without replicas, replica_0 is the primary under a second alias. Nothing
+# is routed to it, but tests can point DATABASE_REPLICAS at it (see
+# marketplace.tests); in tests every replica mirrors the test database.
+if not DATABASE_REPLICAS:
+    DATABASES['replica_0'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+DATABASE_ROUTERS = ['marketplace.replicas.ReplicaRouter']
+REPLICA_PIN_SECONDS = env.int('REPLICA_PIN_SECONDS', default=15)
+REPLICA_MAX_LAG = env.float('REPLICA_MAX_LAG', default=5.0)
+REPLICA_LAG_CHECK_INTERVAL = env.float('REPLICA_LAG_CHECK_INTERVAL', default=5.0)
+
+# Defaults to a per-process local-memory cache; point CACHE_URL at Redis or
+# Memcached in production so the catalog cache is shared between workers.
+CACHES = {
+    'default': env.cache_url('CACHE_URL', default='locmemcache://'),
+}
+
+# Catalog response cache (products.cache). Timeouts in seconds; 0 disables it.
+CATALOG_CACHE_TIMEOUT = env.int('CATALOG_CACHE_TIMEOUT', default=10 * 60)
+CATALOG_CACHE_LOCK_TIMEOUT = env.int('CATALOG_CACHE_LOCK_TIMEOUT', default=10)
+CATALOG_CACHE_LOCK_WAIT = env.float('CATALOG_CACHE_LOCK_WAIT', default=2.0)
+
+# How long list views reuse a COUNT(*) for their page links (seconds).
+PAGINATION_COUNT_CACHE_TIMEOUT = env.int('PAGINATION_COUNT_CACHE_TIMEOUT', default=5 * 60)
+
+# Product search (products.search): how many ranked results are returned at
+# most, and the largest tier of matches (all words in the name; in the name
+# or category; anywhere) that is scored. Larger tiers are listed newest first.
+PRODUCT_SEARCH_SCORE_LIMIT = env.int('PRODUCT_SEARCH_SCORE_LIMIT', default=1000)
+PRODUCT_SEARCH_MAX_RESULTS = env.int('PRODUCT_SEARCH_MAX_RESULTS', default=1000)
+
+# Facet index (products.facets): whether each process builds it at startup,
+# seconds between journal polls when the catalog generation hasn't changed,
+# changed products held outside the price-ordered run before a rebuild, and
+# the match count up to which listings filter by id rather than repeating
+# the filters in SQL.
+PRODUCT_FACET_WARM_UP = env.bool('PRODUCT_FACET_WARM_UP', default=True)
+PRODUCT_FACET_SYNC_INTERVAL = env.int('PRODUCT_FACET_SYNC_INTERVAL', default=30)
+PRODUCT_FACET_TAIL_LIMIT = env.int('PRODUCT_FACET_TAIL_LIMIT', default=5000)
+PRODUCT_FACET_ID_FILTER_LIMIT = env.int('PRODUCT_FACET_ID_FILTER_LIMIT', default=800)
+
+# Bulk product import (products.imports): rows applied per batch, the
+# worker processes that sanitize changed descriptions (in the
+# import_products command), and the largest file the admin's import page
+# takes, which imports in the request without workers.
+PRODUCT_IMPORT_BATCH_SIZE = env.int('PRODUCT_IMPORT_BATCH_SIZE', default=1000)
+PRODUCT_IMPORT_WORKERS = env.int('PRODUCT_IMPORT_WORKERS', default=os.cpu_count() or 1)
+PRODUCT_IMPORT_ADMIN_MAX_BYTES = env.int('PRODUCT_IMPORT_ADMIN_MAX_BYTES', default=2 * 1024 * 1024)
+
+# Related products (products.related): neighbours stored per product, and
+# orders counted into the co-purchase matrix per transaction.
+RELATED_PRODUCTS_STORED = env.int('RELATED_PRODUCTS_STORED', default=12)
+RELATED_PRODUCTS_BATCH_SIZE = env.int('RELATED_PRODUCTS_BATCH_SIZE', default=1000)
+
+# Product image renditions (products.renditions): the widths generated in
+# WebP and JPEG, the width of the plain <img src> fallback, and the encoder
+# quality.
+PRODUCT_IMAGE_WIDTHS = env.list('PRODUCT_IMAGE_WIDTHS', cast=int, default=[240, 480, 720, 960, 1440])
+PRODUCT_IMAGE_DEFAULT_WIDTH = env.int('PRODUCT_IMAGE_DEFAULT_WIDTH', default=480)
+PRODUCT_IMAGE_QUALITY = env.int('PRODUCT_IMAGE_QUALITY', default=80)
+
 AUTH_PASSWORD_VALIDATORS = [
     {'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator'},
     {'NAME': 'django.contrib.auth.password_validation.MinimumLengthValidator'},
@@ -121,6 +225,17 @@ ACCOUNT_UNIQUE_EMAIL = True
 LOGIN_REDIRECT_URL = 'home'
 LOGOUT_REDIRECT_URL = 'home'
 
+# Identifies the deployed code, e.g. the git commit. Part of every ETag
+# (marketplace.conditional), so browsers revalidate pages after a deploy.
+RELEASE_VERSION = env('RELEASE_VERSION', default='')
+
+# Seconds a signed-in user's snapshot (users.auth) is served from the cache
+# instead of loading the session and user rows; 0 disables it. Sessions
+# still go to the database unless SESSION_ENGINE says otherwise, e.g.
+# 'django.contrib.sessions.backends.cached_db' with a shared CACHE_URL.
+AUTH_SNAPSHOT_TIMEOUT = env.int('AUTH_SNAPSHOT_TIMEOUT', default=15 * 60)
+SESSION_ENGINE = env('SESSION_ENGINE', default='django.contrib.sessions.backends.db')
+
 EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 TAILWIND_APP_NAME = 'theme'
 INTERNAL_IPS = ["127.0.0.1"]
@@ -131,6 +246,42 @@ STRIPE_PUBLIC_KEY = env('STRIPE_PUBLIC_KEY')
 STRIPE_SECRET_KEY = env('STRIPE_SECRET_KEY')
 STRIPE_WEBHOOK_SECRET = env('STRIPE_WEBHOOK_SECRET')
 
+# Payment gateway: 'stripe', 'fake' (in-process, for offline load tests) or
+# a dotted path to a backend class. Timeouts are in seconds.
+PAYMENTS_BACKEND = env('PAYMENTS_BACKEND', default='stripe')
+PAYMENTS_FAKE_LATENCY = env.float('PAYMENTS_FAKE_LATENCY', default=0.0)
+STRIPE_TIMEOUT = env.float('STRIPE_TIMEOUT', default=10.0)
+STRIPE_RETRIEVE_TIMEOUT = env.float('STRIPE_RETRIEVE_TIMEOUT', default=5.0)
+STRIPE_MAX_RETRIES = env.int('STRIPE_MAX_RETRIES', default=2)
+STRIPE_POOL_SIZE = env.int('STRIPE_POOL_SIZE', default=10)
+STRIPE_API_BASE = env('STRIPE_API_BASE', default='https://api.stripe.com')
+
+# Route the catalog, cart and checkout URLs to their async views. Only worth
+# it under ASGI, where marketplace.asgi turns it on; under WSGI each async
+# view would get its own event loop.
+ASYNC_VIEWS = env.bool('ASYNC_VIEWS', default=False)
+
+# Cart store: 'db', 'cache' (carts held in CACHES, e.g. for tests) or a
+# dotted path to a store class. Guest carts are found through a cookie that
+# lasts CART_COOKIE_AGE seconds; purge_guest_carts drops carts idle as long.
+CART_BACKEND = env('CART_BACKEND', default='db')
+CART_COOKIE_AGE = env.int('CART_COOKIE_AGE', default=30 * 24 * 60 * 60)
+
+# Rows fetched per round trip by the order export (orders.export).
+ORDER_EXPORT_CHUNK_SIZE = env.int('ORDER_EXPORT_CHUNK_SIZE', default=2000)
+
+# Days the staff sales dashboard (orders.rollups) shows by default.
+SALES_DASHBOARD_DAYS = env.int('SALES_DASHBOARD_DAYS', default=30)
+
+# Seconds stock stays reserved for an open checkout. Also used as the Stripe
+# session expiry, which Stripe requires to be between 30 minutes and 24 hours.
+STOCK_RESERVATION_TTL = env.int('STOCK_RESERVATION_TTL', default=30 * 60)
+
+# Retry policy for queued Stripe webhook events (see process_webhook_events).
+WEBHOOK_MAX_ATTEMPTS = env.int('WEBHOOK_MAX_ATTEMPTS', default=8)
+WEBHOOK_RETRY_BACKOFF = env.int('WEBHOOK_RETRY_BACKOFF', default=30)
+WEBHOOK_RETRY_BACKOFF_MAX = env.int('WEBHOOK_RETRY_BACKOFF_MAX', default=60 * 60)
+
 # --- SECURITY & STORAGE SETTINGS (ENVIRONMENT-DEPENDENT) ---
 CSRF_TRUSTED_ORIGINS = [f"https://{host}" for host in ALLOWED_HOSTS if host not in ['localhost', '127.0.0.1']]
 CSRF_TRUSTED_ORIGINS.extend([f"http://{host}" for host in ALLOWED_HOSTS])
@@ -0,0 +1,48 @@
+"""Helpers shared by the apps' tests."""
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from products.models import Category, Product
+
+# A local cache, so bumping the catalog generation never reaches a shared one.
+LOCAL_CACHE = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+# No SELECT may read these while answering with a 304.
+PRODUCT_TABLES = (
+    Product._meta.db_table,
+    Product.sizes.through._meta.db_table,
+    Product.colors.through._meta.db_table,
+    Category._meta.db_table,
+)
+
+
+class ConditionalGetTestsMixin:
+    """Assertions for views answering conditional GETs without reading the catalog."""
+
+    def get(self, client, url, **headers):
+        """The response and the SELECTs it ran on the product tables."""
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(url, secure=True, headers=headers)
+        selects = [
+            query['sql'] for query in queries.captured_queries
+            if query['sql'].lstrip().upper().startswith('SELECT') and any(t in query['sql'] for t in PRODUCT_TABLES)
+        ]
+        return response, selects
+
+    def assertRevalidates(self, client, url, last_modified_sent):
+        """A first request gets an ETag, which gives a 304 without reading the catalog; returns it."""
+        first, _ = self.get(client, url)
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers.get('ETag')
+        self.assertTrue(etag)
+        last_modified = first.headers.get('Last-Modified')
+        self.assertEqual(bool(last_modified), last_modified_sent)
+
+        response, selects = self.get(client, url, if_none_match=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(selects, [])
+        self.assertEqual(response.content, b'')
+        if last_modified:
+            response, selects = self.get(client, url, if_modified_since=last_modified)
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(selects, [])
+        return etag
@@ -0,0 +1,293 @@
+import json
+import logging
+from decimal import Decimal
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.core import signing
+from django.core.cache import cache
+from django.db import OperationalError, connection, connections, transaction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from orders.cart import resolve_cart
+from orders.inventory import commit_reservation, reserve_stock
+from orders.models import Cart
+from products.cache import bump_generation
+from products.facets import get_index, reset_index
+from products.models import Category, Product
+from . import replicas
+from .management.commands import check_query_plans
+from .pagination import CURSOR_SALT, CursorSerializer
+
+PRODUCT_TABLE = Product._meta.db_table
+
+
+@override_settings(REQUEST_METRICS_SAMPLE_RATE=1.0, REQUEST_METRICS_SERVER_TIMING=True)
+class RequestMetricsTests(TestCase):
+    def test_template_time_of_views_rendering_directly(self):
+        # CartView calls render() rather than returning a TemplateResponse.
+        with self.assertLogs('marketplace.requests', logging.INFO) as logs:
+            response = self.client.get(reverse('cart'), secure=True)
+        record = json.loads(logs.records[-1].getMessage())
+        self.assertEqual(record['url_name'], 'cart')
+        self.assertGreater(record['template_ms'], 0)
+        self.assertIn(f'tpl;dur={record["template_ms"]:.2f}', response['Server-Timing'])
+
+    def test_log_line_is_only_built_when_logged(self):
+        requests_logger = logging.getLogger('marketplace.requests')
+        self.addCleanup(requests_logger.setLevel, requests_logger.level)
+        requests_logger.setLevel(logging.WARNING)
+        with mock.patch('marketplace.middleware.json') as json_module:
+            self.client.get(reverse('cart'), secure=True)
+        json_module.dumps.assert_not_called()
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class KeysetPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Pots', slug='pots')
+        # Names and prices in opposite orders, so the sorts disagree.
+        Product.objects.bulk_create([
+            Product(name=f'Pot {i:02}', slug=f'pot-{i}', description='Clay pot', price=Decimal(100 - i),
+                    category=category)
+            for i in range(30)
+        ])
+
+    def setUp(self):
+        cache.clear()
+        reset_index()
+
+    def page(self, **query):
+        return self.client.get(reverse('product_list'), query, secure=True)
+
+    def names(self, response):
+        return [product.name for product in response.context['products']]
+
+    def test_cursors_match_page_numbers(self):
+        for sort in ('latest', 'price_low_to_high', 'price_high_to_low', 'name_a_to_z'):
+            with self.subTest(sort=sort):
+                response = self.page(sort=sort)
+                cursor = response.context['page_obj'].next_cursor
+                following = self.page(sort=sort, cursor=cursor)
+                self.assertEqual(self.names(following), self.names(self.page(sort=sort, page=2)))
+                previous = self.page(sort=sort, cursor=following.context['page_obj'].previous_cursor)
+                self.assertEqual(self.names(previous), self.names(response))
+
+    def test_cursor_for_another_ordering_is_not_found(self):
+        cursor = self.page(sort='price_low_to_high').context['page_obj'].next_cursor
+        for sort in ('latest', 'name_a_to_z', 'price_high_to_low'):
+            with self.subTest(sort=sort):
+                self.assertEqual(self.page(sort=sort, cursor=cursor).status_code, 404)
+
+    def test_malformed_cursor_is_not_found(self):
+        keys = [['price', False], ['pk', False]]
+        forged = [
+            'not-a-cursor',
+            signing.dumps({'k': keys, 'v': ['cheap', 1], 'n': 2, 'r': False}, salt=CURSOR_SALT,
+                          serializer=CursorSerializer),
+            signing.dumps({'v': ['10.00', 1], 'n': 2, 'r': False}, salt=CURSOR_SALT, serializer=CursorSerializer),
+        ]
+        for cursor in forged:
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.page(sort='price_low_to_high', cursor=cursor).status_code, 404)
+
+
+# Run every query: cached pages and counts would hide their plans.
+@override_settings(CATALOG_CACHE_TIMEOUT=0, PAGINATION_COUNT_CACHE_TIMEOUT=0)
+class QueryPlanTests(TestCase):
+    """The storefront paths of ``check_query_plans``, on a small catalog."""
+
+    plans = check_query_plans.Command()
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.seed = cls.plans.seed({'categories': 4, 'products': 300, 'users': 3, 'orders': 3})
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        cache.clear()
+        reset_index()
+        get_index()
+        if connection.vendor == 'postgresql':
+            # Tables this small are cheaper to scan, so PostgreSQL would
+            # rather; this way it only does when no index fits the query.
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def test_no_sequential_scans_of_watched_tables(self):
+        client = self.plans.logged_in_client(self.seed)
+        labels = []
+        for name, url in self.plans.scenarios(self.seed):
+            for label, queries in self.plans.paths(client, name, url):
+                labels.append(label)
+                for sql, params in queries:
+                    if check_query_plans.gated(sql):
+                        lines, scanned = check_query_plans.explain(sql, params)
+                        with self.subTest(label, sql=sql):
+                            self.assertFalse(scanned & check_query_plans.WATCHED_TABLES, '\n'.join(lines))
+        # Every listing was followed to its second page too.
+        self.assertIn('product_list[price_low_to_high][cursor]', labels)
+        self.assertIn('product_list_by_category[name_a_to_z][cursor]', labels)
+
+
+# Page caching would serve one request's render to the next.
+@override_settings(DATABASE_REPLICAS=['replica_0'], REPLICA_MAX_LAG=5, REPLICA_LAG_CHECK_INTERVAL=5,
+                   CATALOG_CACHE_TIMEOUT=0)
+class ReplicaRoutingTests(TestCase):
+    databases = {'default', 'replica_0'}
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # The mirror is a second connection to the test database, which
+        # can't see the rows this class writes inside its transaction. Read
+        # through the primary's instead; queries are still logged per alias.
+        replica = connections['replica_0']
+        cls.replica_connection = replica.connection
+        replica.connection = connections['default'].connection
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica_0'].connection = cls.replica_connection
+        super().tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Pots', slug='pots')
+        cls.product = Product.objects.create(name='Pot', slug='pot', description='Clay pot', price=Decimal('9.99'),
+                                             category=category, stock=10)
+
+    def setUp(self):
+        cache.clear()
+        replicas.reset_health()
+        self.addCleanup(replicas.reset_health)
+        # Only transactions opened by the test itself count, not the ones
+        # TestCase wraps it in.
+        depth = len(connections['default'].atomic_blocks)
+        patcher = mock.patch.object(replicas, '_in_transaction',
+                                    lambda: len(connections['default'].atomic_blocks) > depth)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def reads(self, action):
+        """``action()`` and the databases it read products from."""
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica_0']) as replica:
+            result = action()
+        used = {
+            alias for alias, queries in (('default', primary), ('replica_0', replica))
+            if any(query['sql'].startswith('SELECT') and PRODUCT_TABLE in query['sql'] for query in queries)
+        }
+        return result, used
+
+    def read(self):
+        """The one database a catalog read went to."""
+        found, used = self.reads(Product.objects.filter(pk=self.product.pk).exists)
+        self.assertTrue(found)
+        self.assertEqual(len(used), 1, used)
+        return used.pop()
+
+    def test_catalog_reads_go_to_the_replica(self):
+        self.assertEqual(self.read(), 'replica_0')
+        # Anything else reads the primary.
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica_0']) as replica:
+            Cart.objects.filter(pk=-1).exists()
+        self.assertEqual((len(primary), len(replica)), (1, 0))
+
+    def test_transactions_and_use_primary_read_the_primary(self):
+        with transaction.atomic():
+            self.assertEqual(self.read(), 'default')
+        with replicas.use_primary():
+            self.assertEqual(self.read(), 'default')
+        self.assertEqual(self.read(), 'replica_0')
+
+    def test_use_primary_decorates_sync_and_async_views(self):
+        @replicas.use_primary()
+        def view(request):
+            return HttpResponse(self.read())
+
+        @replicas.use_primary()
+        async def async_view(request):
+            return HttpResponse(await sync_to_async(self.read)())
+
+        request = RequestFactory().get('/')
+        self.assertEqual(view(request).content, b'default')
+        self.assertEqual(async_to_sync(async_view)(request).content, b'default')
+        self.assertEqual(self.read(), 'replica_0')
+
+    def test_unmeasured_replica_waits_out_the_max_lag_after_a_catalog_change(self):
+        bump_generation()
+        self.assertEqual(self.read(), 'default')
+        with override_settings(REPLICA_MAX_LAG=0):
+            self.assertEqual(self.read(), 'replica_0')
+
+    def test_replica_is_read_once_its_lag_shows_the_change(self):
+        with mock.patch.object(replicas, 'replica_lag', return_value=0.0):
+            self.assertEqual(self.read(), 'replica_0')
+            # A change newer than the last check is checked for at once.
+            bump_generation()
+            self.assertEqual(self.read(), 'replica_0')
+        replicas.reset_health()
+        with mock.patch.object(replicas, 'replica_lag', return_value=2.0):
+            bump_generation()
+            self.assertEqual(self.read(), 'default')
+
+    def test_sales_do_not_hold_reads_back(self):
+        lines = resolve_cart({'1': {'product_id': self.product.pk, 'quantity': 1}}).lines
+        with self.captureOnCommitCallbacks(execute=True):
+            commit_reservation(reserve_stock(lines), lines)
+        self.assertEqual(self.read(), 'replica_0')
+
+    def test_lagging_or_unreachable_replica_is_skipped(self):
+        with mock.patch.object(replicas, 'replica_lag', return_value=60.0), self.assertLogs(replicas.logger, 'WARNING'):
+            self.assertEqual(self.read(), 'default')
+        replicas.reset_health()
+        with mock.patch.object(replicas, 'replica_lag', side_effect=OperationalError('down')), \
+                self.assertLogs(replicas.logger, 'WARNING'):
+            self.assertEqual(self.read(), 'default')
+        replicas.reset_health()
+        self.assertEqual(self.read(), 'replica_0')
+
+    def write_then_read(self, model):
+        def view(request):
+            if model is Product:
+                Product.objects.filter(pk=self.product.pk).update(stock=1)
+            else:
+                Cart.objects.create()
+            return HttpResponse(self.read())
+        return view
+
+    def test_catalog_write_pins_the_visitor(self):
+        factory = RequestFactory()
+        response = replicas.ReplicaPinningMiddleware(self.write_then_read(Cart))(factory.post('/'))
+        self.assertEqual(response.content, b'replica_0')
+        self.assertNotIn(replicas.PIN_COOKIE_NAME, response.cookies)
+
+        response = replicas.ReplicaPinningMiddleware(self.write_then_read(Product))(factory.post('/'))
+        self.assertEqual(response.content, b'default')
+        cookie = response.cookies[replicas.PIN_COOKIE_NAME].value
+
+        url = reverse('product_detail', args=[self.product.slug])
+        pinned = self.client_class()
+        pinned.cookies[replicas.PIN_COOKIE_NAME] = cookie
+        self.assertEqual(self.reads(lambda: pinned.get(url, secure=True))[1], {'default'})
+        with override_settings(REPLICA_PIN_SECONDS=-1):
+            self.assertEqual(self.reads(lambda: pinned.get(url, secure=True))[1], {'replica_0'})
+        forged = self.client_class()
+        forged.cookies[replicas.PIN_COOKIE_NAME] = '1'
+        self.assertEqual(self.reads(lambda: forged.get(url, secure=True))[1], {'replica_0'})
+
+        async def read(request):
+            await Product.objects.filter(pk=self.product.pk).aexists()
+            return HttpResponse()
+
+        request = factory.get('/')
+        request.COOKIES[replicas.PIN_COOKIE_NAME] = cookie
+        self.assertEqual(self.reads(lambda: async_to_sync(replicas.ReplicaPinningMiddleware(read))(request))[1],
+                         {'default'})
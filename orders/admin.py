@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import Order, OrderItem, ShippingAddress
+from .models import Cart, CartLine, Order, OrderItem, ShippingAddress, StockReservation, WebhookEvent
 
 class OrderItemInline(admin.TabularInline):
     model = OrderItem
@@ -18,8 +18,35 @@ class OrderAdmin(admin.ModelAdmin):
     search_fields = ['email', 'full_name', 'id']
     inlines = [OrderItemInline]
 
+class CartLineInline(admin.TabularInline):
+    model = CartLine
+    raw_id_fields = ['product']
+    fields = ('item_key', 'product', 'quantity', 'size', 'color', 'updated_at')
+    readonly_fields = ('updated_at',)
+    extra = 0
+
+@admin.register(Cart)
+class CartAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'created_at', 'updated_at']
+    search_fields = ['user__username', 'user__email']
+    raw_id_fields = ['user']
+    inlines = [CartLineInline]
+
 @admin.register(ShippingAddress)
 class ShippingAddressAdmin(admin.ModelAdmin):
     list_display = ['user', 'full_name', 'city', 'default']
     list_filter = ['default', 'country', 'state']
     search_fields = ['user__username', 'full_name', 'address']
+
+@admin.register(StockReservation)
+class StockReservationAdmin(admin.ModelAdmin):
+    list_display = ['reference', 'product', 'quantity', 'created_at', 'expires_at']
+    search_fields = ['reference']
+    raw_id_fields = ['product']
+
+@admin.register(WebhookEvent)
+class WebhookEventAdmin(admin.ModelAdmin):
+    list_display = ['stripe_event_id', 'type', 'status', 'attempts', 'created_at', 'processed_at']
+    list_filter = ['status', 'type']
+    search_fields = ['stripe_event_id']
+    readonly_fields = ['payload', 'last_error']
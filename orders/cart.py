@@ -0,0 +1,118 @@
+"""
+Cart resolution shared by the cart, checkout and payment views.
+
+A cart's contents (as returned by the cart store, see ``orders.cart_store``,
+and as sent to Stripe in the checkout metadata) are a dict of
+``item_key -> {'product_id', 'quantity', 'size', 'color'}``.
+``resolve_cart`` turns it into priced lines with a single ``in_bulk`` query
+(joined to the category the cart page shows), however many lines the cart
+holds.
+"""
+from dataclasses import dataclass, field
+from decimal import Decimal
+
+from products.models import Product
+
+
+@dataclass
+class PricedLine:
+    item_key: str
+    product: Product
+    quantity: int
+    price: Decimal
+    size: str = None
+    color: str = None
+
+    @property
+    def total(self):
+        return self.price * self.quantity
+
+
+@dataclass
+class ResolvedCart:
+    lines: list = field(default_factory=list)
+    invalid_keys: list = field(default_factory=list)
+
+    @property
+    def total(self):
+        return sum((line.total for line in self.lines), Decimal('0.00'))
+
+    def __bool__(self):
+        return bool(self.lines)
+
+    def __iter__(self):
+        return iter(self.lines)
+
+    def __len__(self):
+        return len(self.lines)
+
+
+def normalize_cart(cart):
+    """
+    Upgrade legacy ``{product_id: quantity}`` entries to the dict format.
+    Returns ``(cart, changed)``; entries that cannot be upgraded are dropped.
+    """
+    changed = False
+    normalized = {}
+    for item_key, item_data in cart.items():
+        if isinstance(item_data, dict):
+            normalized[item_key] = item_data
+            continue
+        changed = True
+        try:
+            product_id = int(item_key)
+            quantity = int(item_data)
+        except (ValueError, TypeError):
+            continue
+        normalized[str(product_id)] = {
+            'product_id': product_id,
+            'quantity': quantity,
+            'size': None,
+            'color': None,
+        }
+    return normalized, changed
+
+
+def _parse_cart(cart):
+    resolved, parsed = ResolvedCart(), []
+    for item_key, item_data in cart.items():
+        try:
+            parsed.append((item_key, int(item_data['product_id']), int(item_data['quantity']), item_data))
+        except (KeyError, TypeError, ValueError):
+            resolved.invalid_keys.append(item_key)
+    return resolved, parsed
+
+
+def _price_lines(resolved, parsed, products, user):
+    for item_key, product_id, quantity, item_data in parsed:
+        product = products.get(product_id)
+        if product is None:
+            resolved.invalid_keys.append(item_key)
+            continue
+        resolved.lines.append(PricedLine(
+            item_key=item_key,
+            product=product,
+            quantity=quantity,
+            price=product.get_price(user),
+            size=item_data.get('size'),
+            color=item_data.get('color'),
+        ))
+    return resolved
+
+
+def resolve_cart(cart, user=None):
+    """
+    Resolve every line of a cart in one query and price it for ``user``.
+    Keys whose data is malformed or whose product no longer exists are
+    reported in ``invalid_keys`` so the caller can purge them.
+    """
+    resolved, parsed = _parse_cart(cart)
+    products = Product.objects.select_related('category').in_bulk({product_id for _, product_id, _, _ in parsed})
+    return _price_lines(resolved, parsed, products, user)
+
+
+async def aresolve_cart(cart, user=None):
+    """``resolve_cart`` for async views; ``user`` must already be resolved."""
+    resolved, parsed = _parse_cart(cart)
+    products = await Product.objects.select_related('category').ain_bulk({product_id for _, product_id, _, _ in parsed})
+    return _price_lines(resolved, parsed, products, user)
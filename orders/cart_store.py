@@ -0,0 +1,393 @@
+"""
+Cart persistence outside the session.
+
+Carts used to live in ``request.session['cart']``, so every click rewrote
+and re-serialized the whole session row. They are now kept by a cart store,
+chosen by ``CART_BACKEND``:
+
+* ``'db'``: ``Cart``/``CartLine`` rows. Adding is one ``INSERT ... ON
+  CONFLICT DO UPDATE`` on the line, and changing or removing a line touches
+  that row only.
+* ``'cache'``: whole carts in the Django cache, for tests and load tests.
+* A dotted path to a class with the same methods.
+
+Signed-in users' carts are found by user; guests' through a signed cookie
+holding the cart id, so reading a cart never loads the session. A guest
+cart is merged into the user's cart when they log in (see
+``orders.signals``).
+
+``CartMiddleware`` sets ``request.cart``, a ``RequestCart`` that resolves
+the cart on first use.
+"""
+import datetime
+import threading
+import uuid
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core import signing
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .cart import normalize_cart
+from .models import Cart, CartLine
+
+COOKIE_NAME = 'cart'
+COOKIE_SALT = 'orders.cart_store.cookie'
+LINE_FIELDS = ('product_id', 'quantity', 'size', 'color')
+
+
+class CartNotFound(Exception):
+    pass
+
+
+class DatabaseCartStore:
+
+    def cart_for_user(self, user_id, create=False):
+        if create:
+            return Cart.objects.get_or_create(user_id=user_id)[0].pk
+        return Cart.objects.filter(user_id=user_id).values_list('pk', flat=True).first()
+
+    def new_guest_cart(self):
+        return Cart.objects.create().pk
+
+    def lines(self, cart_id):
+        rows = CartLine.objects.filter(cart_id=cart_id).order_by('id').values_list('item_key', *LINE_FIELDS)
+        return {item_key: dict(zip(LINE_FIELDS, values)) for item_key, *values in rows}
+
+    def count(self, cart_id):
+        return CartLine.objects.filter(cart_id=cart_id).count()
+
+    def add(self, cart_id, item_key, product_id, quantity, size=None, color=None):
+        """Add ``quantity`` to a line, creating it if needed."""
+        try:
+            if connection.vendor in ('postgresql', 'sqlite'):
+                self._upsert(int(cart_id), item_key, product_id, quantity, size, color)
+                return
+            with transaction.atomic():
+                updated = CartLine.objects.filter(cart_id=cart_id, item_key=item_key).update(
+                    quantity=F('quantity') + quantity, updated_at=timezone.now())
+                if not updated:
+                    CartLine.objects.create(cart_id=cart_id, item_key=item_key, product_id=product_id,
+                                            quantity=quantity, size=size, color=color)
+        except IntegrityError:
+            if not Cart.objects.filter(pk=cart_id).exists():
+                raise CartNotFound(cart_id)
+            raise
+
+    def _upsert(self, cart_id, item_key, product_id, quantity, size, color):
+        table = connection.ops.quote_name(CartLine._meta.db_table)
+        now = connection.ops.adapt_datetimefield_value(timezone.now())
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'INSERT INTO {table} (cart_id, item_key, product_id, quantity, size, color, updated_at) '
+                f'VALUES (%s, %s, %s, %s, %s, %s, %s) '
+                f'ON CONFLICT (cart_id, item_key) DO UPDATE SET '
+                f'quantity = {table}.quantity + EXCLUDED.quantity, updated_at = EXCLUDED.updated_at',
+                [cart_id, item_key, product_id, quantity, size, color, now],
+            )
+
+    def set_quantity(self, cart_id, item_key, quantity):
+        return bool(CartLine.objects.filter(cart_id=cart_id, item_key=item_key).update(
+            quantity=quantity, updated_at=timezone.now()))
+
+    def remove(self, cart_id, item_keys):
+        return CartLine.objects.filter(cart_id=cart_id, item_key__in=item_keys).delete()[0] > 0
+
+    def clear(self, cart_id):
+        CartLine.objects.filter(cart_id=cart_id).delete()
+
+    def merge(self, source_id, target_id):
+        """Move the lines of ``source_id`` into ``target_id``, adding up quantities, and drop the source cart."""
+        source_id, target_id = int(source_id), int(target_id)
+        if source_id == target_id:
+            return
+        with transaction.atomic():
+            if connection.vendor in ('postgresql', 'sqlite'):
+                table = connection.ops.quote_name(CartLine._meta.db_table)
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f'INSERT INTO {table} (cart_id, item_key, product_id, quantity, size, color, updated_at) '
+                        f'SELECT %s, item_key, product_id, quantity, size, color, updated_at FROM {table} '
+                        f'WHERE cart_id = %s '
+                        f'ON CONFLICT (cart_id, item_key) DO UPDATE SET '
+                        f'quantity = {table}.quantity + EXCLUDED.quantity, updated_at = EXCLUDED.updated_at',
+                        [target_id, source_id],
+                    )
+            else:
+                for item_key, line in self.lines(source_id).items():
+                    self.add(target_id, item_key, **line)
+            Cart.objects.filter(pk=source_id, user=None).delete()
+
+
+class CacheCartStore:
+    """Whole carts as cache entries. Not safe for concurrent writes to one cart."""
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def _key(self, cart_id):
+        return f'cart:{cart_id}'
+
+    def _save(self, cart_id, lines):
+        cache.set(self._key(cart_id), lines, self.timeout)
+
+    def cart_for_user(self, user_id, create=False):
+        key = f'cart:user:{user_id}'
+        cart_id = cache.get(key)
+        if cart_id is None and create:
+            cart_id = self.new_guest_cart()
+            cache.set(key, cart_id, self.timeout)
+        return cart_id
+
+    def new_guest_cart(self):
+        cart_id = uuid.uuid4().hex
+        self._save(cart_id, {})
+        return cart_id
+
+    def lines(self, cart_id):
+        return dict(cache.get(self._key(cart_id)) or {})
+
+    def count(self, cart_id):
+        return len(self.lines(cart_id))
+
+    def add(self, cart_id, item_key, product_id, quantity, size=None, color=None):
+        lines = cache.get(self._key(cart_id))
+        if lines is None:
+            raise CartNotFound(cart_id)
+        if item_key in lines:
+            lines[item_key]['quantity'] += quantity
+        else:
+            lines[item_key] = {'product_id': product_id, 'quantity': quantity, 'size': size, 'color': color}
+        self._save(cart_id, lines)
+
+    def set_quantity(self, cart_id, item_key, quantity):
+        lines = self.lines(cart_id)
+        if item_key not in lines:
+            return False
+        lines[item_key]['quantity'] = quantity
+        self._save(cart_id, lines)
+        return True
+
+    def remove(self, cart_id, item_keys):
+        lines = self.lines(cart_id)
+        removed = [lines.pop(item_key) for item_key in item_keys if item_key in lines]
+        if removed:
+            self._save(cart_id, lines)
+        return bool(removed)
+
+    def clear(self, cart_id):
+        self._save(cart_id, {})
+
+    def merge(self, source_id, target_id):
+        if source_id == target_id:
+            return
+        for item_key, line in self.lines(source_id).items():
+            self.add(target_id, item_key, **line)
+        cache.delete(self._key(source_id))
+
+
+def purge_guest_carts():
+    """Delete guest carts untouched for ``CART_COOKIE_AGE``, whose cookies have expired."""
+    cutoff = timezone.now() - datetime.timedelta(seconds=settings.CART_COOKIE_AGE)
+    idle = Cart.objects.filter(user=None, created_at__lt=cutoff).exclude(lines__updated_at__gte=cutoff)
+    return Cart.objects.filter(pk__in=list(idle.values_list('pk', flat=True))).delete()[1].get(Cart._meta.label, 0)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def build_store():
+    backend = settings.CART_BACKEND
+    if backend == 'db':
+        return DatabaseCartStore()
+    if backend == 'cache':
+        return CacheCartStore(timeout=settings.CART_COOKIE_AGE)
+    return import_string(backend)()
+
+
+def get_store():
+    """Return the process-wide cart store, building it on first use."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = build_store()
+    return _store
+
+
+def set_store(store):
+    """Replace the process-wide cart store, e.g. with the cache store in tests."""
+    global _store
+    _store = store
+
+
+_UNRESOLVED = object()
+UNCHANGED = object()
+
+
+class RequestCart:
+    """
+    The visitor's cart for one request. Nothing is looked up until the cart
+    is used. ``cookie`` is what ``CartMiddleware`` should do with the guest
+    cookie: ``UNCHANGED``, ``None`` to delete it, or the value to set.
+    """
+
+    def __init__(self, request, store=None):
+        self.request = request
+        self.store = store or get_store()
+        self.cookie = UNCHANGED
+        self._id = _UNRESOLVED
+        self._lines = None
+
+    def _guest_id(self):
+        try:
+            value = self.request.get_signed_cookie(COOKIE_NAME, salt=COOKIE_SALT, max_age=settings.CART_COOKIE_AGE)
+        except (KeyError, signing.BadSignature):
+            return None
+        return value or None
+
+    @property
+    def id(self):
+        if self._id is _UNRESOLVED:
+            if self.request.user.is_authenticated:
+                self._id = self.store.cart_for_user(self.request.user.pk)
+            else:
+                self._id = self._guest_id()
+            self._import_session_cart()
+        return self._id
+
+    def _import_session_cart(self):
+        """
+        Move a cart left in the session by earlier versions into the store.
+        The session is only consulted when it is loaded anyway (signed-in
+        users) or for a guest who has never been given a cart cookie; such
+        a guest gets an empty cookie so it happens once.
+        """
+        request = self.request
+        if request.user.is_authenticated:
+            legacy = request.session.pop('cart', None)
+        elif COOKIE_NAME not in request.COOKIES and settings.SESSION_COOKIE_NAME in request.COOKIES:
+            legacy = request.session.pop('cart', None)
+            self.cookie = ''
+        else:
+            return
+        if legacy:
+            cart, _ = normalize_cart(legacy)
+            for item_key, line in cart.items():
+                try:
+                    self.add(item_key, int(line['product_id']), int(line['quantity']),
+                             line.get('size'), line.get('color'))
+                except (KeyError, TypeError, ValueError):
+                    continue
+
+    def _ensure(self):
+        if self.id is None:
+            if self.request.user.is_authenticated:
+                self._id = self.store.cart_for_user(self.request.user.pk, create=True)
+            else:
+                self._id = self.store.new_guest_cart()
+                self.cookie = str(self._id)
+        return self._id
+
+    def lines(self):
+        """``item_key -> {'product_id', 'quantity', 'size', 'color'}``, as ``resolve_cart`` takes it."""
+        if self._lines is None:
+            self._lines = {} if self.id is None else self.store.lines(self.id)
+        return self._lines
+
+    def __len__(self):
+        if self._lines is not None:
+            return len(self._lines)
+        return 0 if self.id is None else self.store.count(self.id)
+
+    @property
+    def count(self):
+        return len(self)
+
+    def add(self, item_key, product_id, quantity, size=None, color=None):
+        self._lines = None
+        try:
+            self.store.add(self._ensure(), item_key, product_id, quantity, size, color)
+        except CartNotFound:
+            # The guest cart was purged while its cookie lived on.
+            self._id = None
+            self.store.add(self._ensure(), item_key, product_id, quantity, size, color)
+
+    def set_quantity(self, item_key, quantity):
+        self._lines = None
+        return self.id is not None and self.store.set_quantity(self.id, item_key, quantity)
+
+    def remove(self, *item_keys):
+        self._lines = None
+        return self.id is not None and self.store.remove(self.id, item_keys)
+
+    def clear(self):
+        self._lines = None
+        if self.id is not None:
+            self.store.clear(self.id)
+
+    # For async views. Stores (and the lazy request.user) are synchronous.
+    async def alines(self):
+        return await sync_to_async(self.lines)()
+
+    async def acount(self):
+        return await sync_to_async(len)(self)
+
+    async def aadd(self, item_key, product_id, quantity, size=None, color=None):
+        await sync_to_async(self.add)(item_key, product_id, quantity, size, color)
+
+    async def aset_quantity(self, item_key, quantity):
+        return await sync_to_async(self.set_quantity)(item_key, quantity)
+
+    async def aremove(self, *item_keys):
+        return await sync_to_async(self.remove)(*item_keys)
+
+    async def aclear(self):
+        await sync_to_async(self.clear)()
+
+    def merge_guest_cart(self, user):
+        """On login: fold the guest cart from the cookie into ``user``'s cart."""
+        guest_id = self._guest_id()
+        if guest_id is not None:
+            self.store.merge(guest_id, self.store.cart_for_user(user.pk, create=True))
+        if COOKIE_NAME in self.request.COOKIES:
+            self.cookie = None
+        self._id = _UNRESOLVED
+        self._lines = None
+
+
+class CartMiddleware:
+    """Set ``request.cart`` and keep the guest cart cookie in step with it."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        request.cart = RequestCart(request)
+        return self.set_cookie(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        request.cart = RequestCart(request)
+        return self.set_cookie(request, await self.get_response(request))
+
+    def set_cookie(self, request, response):
+        cookie = request.cart.cookie
+        if cookie is None:
+            response.delete_cookie(COOKIE_NAME)
+        elif cookie is not UNCHANGED:
+            response.set_signed_cookie(
+                COOKIE_NAME, cookie, salt=COOKIE_SALT, max_age=settings.CART_COOKIE_AGE,
+                secure=settings.SESSION_COOKIE_SECURE, httponly=True, samesite='Lax',
+            )
+        return response
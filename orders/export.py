@@ -0,0 +1,129 @@
+"""
+Order export for accounting, as CSV or JSON Lines.
+
+One row per order item, with the order's fields repeated and the product's
+current name; orders without items get one row with empty item columns.
+Rows come from a single ``values_list`` query read through
+``.iterator(chunk_size=ORDER_EXPORT_CHUNK_SIZE)`` (a server-side cursor on
+PostgreSQL) and are encoded into chunks of about ``BATCH_BYTES``, so memory
+stays flat however many orders match. Used by ``OrderExportView`` and the
+``export_orders`` command.
+
+``aencode`` serves the same chunks to ``AsyncOrderExportView`` under ASGI.
+Django reads a synchronous iterator into memory before sending any of it
+from an async response, so the async view hands it an async iterator that
+produces one chunk at a time in a thread.
+"""
+import csv
+import datetime
+import io
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Order
+
+FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+GUEST = 'guest'
+COLUMNS = (
+    'order_id', 'created_at', 'status', 'user_id', 'user_type', 'email', 'full_name', 'city', 'state',
+    'postal_code', 'country', 'order_total', 'stripe_payment_id', 'item_id', 'product_id', 'product_name',
+    'unit_price', 'quantity', 'size', 'color', 'line_total',
+)
+_FIELDS = (
+    'id', 'created_at', 'status', 'user_id', 'user__user_type', 'email', 'full_name', 'city', 'state',
+    'postal_code', 'country', 'total_amount', 'stripe_payment_id', 'items__id', 'items__product_id',
+    'items__product__name', 'items__price', 'items__quantity', 'items__size', 'items__color',
+)
+# Size of the chunks handed to the response (or file), in characters.
+BATCH_BYTES = 64 * 1024
+# Spreadsheet apps run cells starting with these as formulas, so customer
+# supplied text starting with one is quoted in CSV.
+_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+_TEXT_COLUMNS = [COLUMNS.index(name) for name in (
+    'email', 'full_name', 'city', 'state', 'postal_code', 'country', 'product_name', 'size', 'color',
+)]
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def export_queryset(created_from=None, created_to=None, statuses=(), user_types=()):
+    """Rows to export; dates are inclusive, in the current time zone."""
+    orders = Order.objects.all()
+    if created_from:
+        orders = orders.filter(created_at__gte=_day_start(created_from))
+    if created_to:
+        orders = orders.filter(created_at__lt=_day_start(created_to + datetime.timedelta(days=1)))
+    if statuses:
+        orders = orders.filter(status__in=statuses)
+    if user_types:
+        condition = Q(user__user_type__in=[t for t in user_types if t != GUEST])
+        if GUEST in user_types:
+            condition |= Q(user__isnull=True)
+        orders = orders.filter(condition)
+    return orders.order_by('id', 'items__id').values_list(*_FIELDS)
+
+
+def export_rows(chunk_size=None, **filters):
+    """Export rows as tuples in ``COLUMNS`` order, with decimals and dates as strings."""
+    chunk_size = chunk_size or settings.ORDER_EXPORT_CHUNK_SIZE
+    for row in export_queryset(**filters).iterator(chunk_size=chunk_size):
+        (order_id, created_at, status, user_id, user_type, email, full_name, city, state, postal_code, country,
+         total, payment_id, item_id, product_id, product_name, price, quantity, size, color) = row
+        yield (
+            order_id, created_at.isoformat(), status, user_id, user_type or GUEST, email, full_name, city,
+            state, postal_code, country, str(total), payment_id, item_id, product_id, product_name,
+            None if price is None else str(price), quantity, size, color,
+            None if item_id is None else str(price * quantity),
+        )
+
+
+def _csv_row(row):
+    row = list(row)
+    for index in _TEXT_COLUMNS:
+        value = row[index]
+        if value and value.startswith(_FORMULA_PREFIXES):
+            row[index] = "'" + value
+    return row
+
+
+def encode(rows, format='csv'):
+    """Yield ``rows`` encoded as CSV (with a header) or JSON Lines, in chunks of about ``BATCH_BYTES``."""
+    buffer = io.StringIO()
+    if format == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(COLUMNS)
+
+        def write(row):
+            writer.writerow(_csv_row(row))
+    elif format == 'jsonl':
+        def write(row):
+            buffer.write(json.dumps(dict(zip(COLUMNS, row))))
+            buffer.write('\n')
+    else:
+        raise ValueError(f'Unknown export format {format!r}.')
+    for row in rows:
+        write(row)
+        if buffer.tell() >= BATCH_BYTES:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def aencode(rows, format='csv'):
+    """``encode``, as an async iterator; each chunk (and its queries) is produced by ``sync_to_async``."""
+    chunks = encode(rows, format)
+    next_chunk = sync_to_async(next)
+    try:
+        while (chunk := await next_chunk(chunks, None)) is not None:
+            yield chunk
+    finally:
+        # Closes the database cursor, in the thread that opened it.
+        await sync_to_async(chunks.close)()
@@ -1,4 +1,6 @@
 from django import forms
+from users.models import CustomUser
+from .export import FORMATS, GUEST
 from .models import ShippingAddress, Order
 
 class ShippingAddressForm(forms.ModelForm):
@@ -25,4 +27,30 @@ class OrderCreateForm(forms.Form):
     country = forms.CharField(max_length=100)
     phone = forms.CharField(max_length=20)
     save_address = forms.BooleanField(required=False, initial=False)
-    set_default = forms.BooleanField(required=False, initial=False)
\ No newline at end of file
+    set_default = forms.BooleanField(required=False, initial=False)
+
+
+class OrderExportForm(forms.Form):
+    format = forms.ChoiceField(choices=[(name, name) for name in FORMATS], required=False)
+    created_from = forms.DateField(required=False)
+    created_to = forms.DateField(required=False)
+    status = forms.MultipleChoiceField(choices=Order.ORDER_STATUS_CHOICES, required=False)
+    user_type = forms.MultipleChoiceField(choices=((GUEST, 'Guest'), *CustomUser.USER_TYPE_CHOICES), required=False)
+
+    def filters(self):
+        data = self.cleaned_data
+        return {'created_from': data['created_from'], 'created_to': data['created_to'],
+                'statuses': data['status'], 'user_types': data['user_type']}
+
+
+class SalesDashboardForm(forms.Form):
+    day_from = forms.DateField(required=False)
+    day_to = forms.DateField(required=False)
+    status = forms.MultipleChoiceField(choices=Order.ORDER_STATUS_CHOICES, required=False)
+    user_type = forms.MultipleChoiceField(choices=((GUEST, 'Guest'), *CustomUser.USER_TYPE_CHOICES), required=False)
+
+    def clean(self):
+        data = super().clean()
+        if data.get('day_from') and data.get('day_to') and data['day_from'] > data['day_to']:
+            raise forms.ValidationError('The first day must not be after the last.')
+        return data
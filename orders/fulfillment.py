@@ -0,0 +1,75 @@
+"""
+Turns a paid Stripe Checkout session into an ``Order``.
+
+Used by the payment success page and the Stripe webhook. The whole order is
+written with a fixed number of statements: one ``INSERT`` for the order, one
+``bulk_create`` for its items and one ``UPDATE`` for the stock, however many
+lines the cart has, plus the sales rollup upserts (see ``orders.rollups``).
+"""
+import json
+from decimal import Decimal
+
+from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+
+from . import rollups
+from .cart import resolve_cart
+from .inventory import commit_reservation
+from .models import Order, OrderItem
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def materialize_order(session, user=None):
+    """Create the order, its items and the stock decrements for ``session``."""
+    order_data = json.loads(session.metadata.get('order_data', '{}'))
+    cart_data = json.loads(session.metadata.get('cart', '{}'))
+    resolved = resolve_cart(cart_data, user)
+    if resolved.invalid_keys:
+        logger.warning(f"Cart items {resolved.invalid_keys} could not be resolved during order creation.")
+
+    with transaction.atomic():
+        order = Order.objects.create(
+            user=user if user is not None and user.is_authenticated else None,
+            email=order_data['email'], full_name=order_data['full_name'],
+            address=order_data['address'], city=order_data.get('city', ''),
+            state=order_data.get('state', ''), postal_code=order_data.get('postal_code', ''),
+            country=order_data.get('country', ''), phone=order_data.get('phone', ''),
+            status='processing', total_amount=Decimal(session.amount_total) / 100,
+            stripe_payment_id=session.payment_intent, stripe_session_id=session.id,
+        )
+        items = OrderItem.objects.bulk_create([
+            OrderItem(
+                order=order, product=line.product,
+                price=line.price,
+                quantity=line.quantity,
+                size=line.size,
+                color=line.color,
+            )
+            for line in resolved
+        ])
+        commit_reservation(session.metadata.get('reservation'), resolved.lines)
+        # Last, so the rollup rows shared with other orders are locked briefly.
+        rollups.add_items(order, items)
+    return order
+
+
+def fulfill_checkout_session(session):
+    """
+    Create the order for a paid Checkout session exactly once.
+    Safe to call for duplicate or concurrent webhook deliveries; returns
+    ``(order, created)``.
+    """
+    order = Order.objects.filter(stripe_session_id=session.id).first()
+    if order is not None:
+        return order, False
+
+    user_id = session.metadata.get('user_id')
+    user = get_user_model().objects.filter(pk=user_id).first() if user_id else None
+    try:
+        return materialize_order(session, user), True
+    except IntegrityError:
+        # A concurrent delivery of the same session won the unique index.
+        return Order.objects.get(stripe_session_id=session.id), False
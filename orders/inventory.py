@@ -0,0 +1,153 @@
+"""
+Stock reservations held while a customer is on the Stripe checkout page.
+
+``Product.reserved`` counts units promised to open checkouts; a product can
+be reserved while ``stock - reserved`` covers the request. Every change to
+the counters is a single conditional ``UPDATE`` using ``F()`` expressions, so
+concurrent buyers of the same SKU never read-modify-write the product row.
+
+Reservations aren't shown anywhere. A sale changes the stock shown on the
+products' own pages, whose cache versions it bumps, and the catalog as a
+whole (the in-stock facet) only for products it sells out.
+"""
+import uuid
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, When
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from products.cache import bump_stock_on_commit
+from products.facets import record_changes
+from products.models import Product
+from .models import StockReservation
+
+
+class InsufficientStock(Exception):
+    def __init__(self, product):
+        self.product = product
+        super().__init__(f"Not enough stock for {product.name}.")
+
+
+def _quantities_by_product(lines):
+    quantities = Counter()
+    for line in lines:
+        quantities[line.product.id] += line.quantity
+    return quantities
+
+
+def _claim(reservations):
+    """Lock and return reservation rows, skipping rows another worker holds."""
+    if connection.features.has_select_for_update_skip_locked:
+        reservations = reservations.select_for_update(skip_locked=True)
+    return list(reservations)
+
+
+def _try_reserve(product_id, quantity):
+    return Product.objects.filter(
+        id=product_id, stock__gte=F('reserved') + quantity,
+    ).update(reserved=F('reserved') + quantity)
+
+
+def reserve_stock(lines, ttl=None):
+    """
+    Reserve stock for resolved cart lines, all or nothing.
+    Returns the reservation reference; raises ``InsufficientStock``.
+    """
+    ttl = settings.STOCK_RESERVATION_TTL if ttl is None else ttl
+    reference = uuid.uuid4().hex
+    expires_at = timezone.now() + timedelta(seconds=ttl)
+    products = {line.product.id: line.product for line in lines}
+    quantities = _quantities_by_product(lines)
+
+    with transaction.atomic():
+        # Fixed order so two carts sharing products cannot deadlock.
+        for product_id in sorted(quantities):
+            quantity = quantities[product_id]
+            if not _try_reserve(product_id, quantity):
+                # Expired reservations may still be holding the units.
+                release_expired_reservations(product_ids=[product_id])
+                if not _try_reserve(product_id, quantity):
+                    raise InsufficientStock(products[product_id])
+
+        StockReservation.objects.bulk_create([
+            StockReservation(
+                reference=reference, product_id=product_id,
+                quantity=quantity, expires_at=expires_at,
+            )
+            for product_id, quantity in quantities.items()
+        ])
+    return reference
+
+
+def _release(reservations):
+    quantities = Counter()
+    for reservation in reservations:
+        quantities[reservation.product_id] += reservation.quantity
+    if not quantities:
+        return 0
+    StockReservation.objects.filter(pk__in=[r.pk for r in reservations]).delete()
+    Product.objects.filter(id__in=quantities).update(reserved=Case(
+        *[When(id=product_id, then=F('reserved') - quantity) for product_id, quantity in quantities.items()],
+        default=F('reserved'), output_field=PositiveIntegerField(),
+    ))
+    return len(reservations)
+
+
+def release_reservation(reference):
+    """Return the units held by a reservation to the sellable stock."""
+    if not reference:
+        return 0
+    with transaction.atomic():
+        return _release(_claim(StockReservation.objects.filter(reference=reference)))
+
+
+def release_expired_reservations(product_ids=None):
+    """Release every reservation past its TTL, optionally for some products only."""
+    expired = StockReservation.objects.filter(expires_at__lte=timezone.now())
+    if product_ids is not None:
+        expired = expired.filter(product_id__in=product_ids)
+    with transaction.atomic():
+        return _release(_claim(expired))
+
+
+def commit_reservation(reference, lines):
+    """
+    Turn a reservation into sold stock for the ordered lines with a single
+    ``UPDATE``. Lines whose reservation already lapsed are taken from stock
+    directly; stock is clamped at zero rather than failing a paid order.
+    """
+    quantities = _quantities_by_product(lines)
+
+    with transaction.atomic():
+        reservations = _claim(StockReservation.objects.filter(reference=reference)) if reference else []
+        reserved = Counter()
+        for reservation in reservations:
+            reserved[reservation.product_id] += reservation.quantity
+        if reservations:
+            StockReservation.objects.filter(pk__in=[r.pk for r in reservations]).delete()
+
+        product_ids = set(quantities) | set(reserved)
+        if not product_ids:
+            return 0
+        # update() bypasses post_save. Product pages show stock levels, and
+        # listings only whether a product is in stock.
+        bump_stock_on_commit(line.product.slug for line in lines)
+        sold_out = Q()
+        for product_id, quantity in quantities.items():
+            sold_out |= Q(id=product_id, stock__gt=0, stock__lte=quantity)
+        if sold_out:
+            record_changes(Product.objects.filter(sold_out).values_list('id', flat=True))
+        return Product.objects.filter(id__in=product_ids).update(
+            stock=Case(
+                *[When(id=product_id, then=Greatest(F('stock') - quantity, 0)) for product_id, quantity in quantities.items()],
+                default=F('stock'), output_field=PositiveIntegerField(),
+            ),
+            reserved=Case(
+                *[When(id=product_id, then=F('reserved') - quantity) for product_id, quantity in reserved.items()],
+                default=F('reserved'), output_field=PositiveIntegerField(),
+            ),
+        )
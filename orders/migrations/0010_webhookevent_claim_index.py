@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('orders', '0009_sales_rollups'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhookevent',
+            name='claim',
+            field=models.CharField(blank=True, db_index=True, max_length=32),
+        ),
+    ]
@@ -1,5 +1,6 @@
 from django.db import models
 from django.conf import settings
+from django.utils import timezone
 from products.models import Product
 from users.models import CustomUser
 
@@ -28,10 +29,12 @@ class Order(models.Model):
     status = models.CharField(max_length=20, choices=ORDER_STATUS_CHOICES, default='pending')
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
     stripe_payment_id = models.CharField(max_length=150, blank=True, null=True)
-    stripe_session_id = models.CharField(max_length=150, blank=True, null=True)
+    stripe_session_id = models.CharField(max_length=150, blank=True, null=True, unique=True)
     
     class Meta:
         ordering = ['-created_at']
+        # "My orders": filter by user, newest first, id as the keyset tiebreaker.
+        indexes = [models.Index(fields=['user', 'created_at', 'id'], name='order_user_created_idx')]
         
     def __str__(self):
         return f'Order {self.id}'
@@ -44,6 +47,14 @@ class OrderItem(models.Model):
     size = models.CharField(max_length=50, blank=True, null=True)
     color = models.CharField(max_length=50, blank=True, null=True)
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # What the sales rollups counted, to apply edits as deltas.
+        instance._rolled_up = (instance.__dict__.get('product_id'), instance.__dict__.get('quantity'),
+                               instance.__dict__.get('price'))
+        return instance
+
     def __str__(self):
         return f'{self.quantity} x {self.product.name}'
     
@@ -62,4 +73,108 @@ class ShippingAddress(models.Model):
     default = models.BooleanField(default=False)
     
     def __str__(self):
-        return f"{self.user.username}'s address: {self.address}"
\ No newline at end of file
+        return f"{self.user.username}'s address: {self.address}"
+
+class Cart(models.Model):
+    # Signed-in users have one cart; guest carts have no user and are found
+    # through a signed cookie holding their id (see orders.cart_store).
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
+                                null=True, blank=True, related_name='cart')
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'Cart {self.id}'
+
+class CartLine(models.Model):
+    cart = models.ForeignKey(Cart, on_delete=models.CASCADE, related_name='lines')
+    item_key = models.CharField(max_length=200)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='+')
+    quantity = models.PositiveIntegerField()
+    size = models.CharField(max_length=50, blank=True, null=True)
+    color = models.CharField(max_length=50, blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['cart', 'item_key'], name='cartline_cart_item_key_uniq')]
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} ({self.item_key})'
+
+class StockReservation(models.Model):
+    reference = models.CharField(max_length=32, db_index=True)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    quantity = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return f'{self.quantity} x {self.product_id} ({self.reference})'
+
+class WebhookEvent(models.Model):
+    STATUS_CHOICES = (
+        ('pending', 'Pending'),
+        ('processing', 'Processing'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+
+    stripe_event_id = models.CharField(max_length=255, unique=True)
+    type = models.CharField(max_length=100)
+    payload = models.JSONField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claim = models.CharField(max_length=32, blank=True, db_index=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    last_error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    processed_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'next_attempt_at'])]
+
+    def __str__(self):
+        return f'{self.type} ({self.stripe_event_id})'
+
+
+class RolledUpOrder(models.Model):
+    """
+    The key an order's items are counted under in ``SalesRollup``: its day,
+    the customer type when it was placed and the status last rolled up.
+    Orders without one aren't counted yet; see orders.rollups.
+    """
+    order = models.OneToOneField(Order, on_delete=models.CASCADE, primary_key=True, related_name='rollup')
+    day = models.DateField(db_index=True)
+    user_type = models.CharField(max_length=20)
+    status = models.CharField(max_length=20, choices=Order.ORDER_STATUS_CHOICES)
+
+    def __str__(self):
+        return f'Order {self.order_id} @ {self.day} {self.user_type} {self.status}'
+
+
+class SalesRollup(models.Model):
+    """
+    Order item totals per day, product, customer type and order status,
+    kept up to date by orders.rollups. ``category_id`` is the product's
+    category when the row was last written. Not foreign keys, so rollups
+    outlive deleted products and categories.
+    """
+    day = models.DateField()
+    product_id = models.BigIntegerField()
+    category_id = models.BigIntegerField(null=True)
+    user_type = models.CharField(max_length=20)
+    status = models.CharField(max_length=20, choices=Order.ORDER_STATUS_CHOICES)
+    lines = models.IntegerField(default=0)
+    units = models.IntegerField(default=0)
+    revenue = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            # Also the index dashboard queries use for their day range.
+            models.UniqueConstraint(fields=['day', 'product_id', 'user_type', 'status'],
+                                    name='salesrollup_key_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.day} product {self.product_id} {self.user_type} {self.status}'
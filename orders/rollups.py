@@ -0,0 +1,294 @@
+"""
+Sales rollups: order item totals per day, product, customer type and order
+status in ``SalesRollup``, so reports (``SalesDashboardView``) read a row
+per key instead of aggregating orders.
+
+An order counted in the rollups has a ``RolledUpOrder`` holding the key its
+items are counted under: its day, the customer type when it was placed and
+the status last rolled up. Changes are applied as deltas in the transaction
+that makes them:
+
+* Saving an order whose status differs from its rolled-up status moves its
+  items from the old key to the new one (``sync_order``). The first save
+  creates the ``RolledUpOrder``.
+* Items saved or deleted one at a time (the admin) are applied by signals.
+  ``materialize_order`` bulk-creates items and calls ``add_items``.
+* Deleting an order takes its items out first (``remove_order``).
+
+A delta is an upsert that adds to the row's totals (``INSERT ... ON CONFLICT
+DO UPDATE SET units = units + excluded.units`` on PostgreSQL and SQLite), so
+concurrent orders for the same product and day don't overwrite each other.
+Rows are written in key order, keeping lock order the same everywhere.
+
+Orders from before the rollups existed, or written with ``QuerySet.update``
+or ``bulk_create`` without calling in here, are counted by ``backfill`` (the
+``backfill_sales_rollups`` command). ``reset`` followed by a backfill
+recounts a day range, e.g. after products moved category.
+"""
+import datetime
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, F, Sum
+from django.utils import timezone
+
+from products.models import Product
+from .export import GUEST
+from .models import Order, OrderItem, RolledUpOrder, SalesRollup
+
+# Statuses that count as sales by default: paid and not cancelled.
+SALES_STATUSES = ('processing', 'shipped', 'delivered')
+_KEY = ('day', 'product_id', 'user_type', 'status')
+_MEASURES = ('lines', 'units', 'revenue')
+# Keeps SQLite under its bound-parameter limit.
+BATCH_SIZE = 100
+
+
+def _day_start(day):
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+def _order_items(order_ids):
+    """``{order id: [(product id, category id, quantity, price)]}``."""
+    items = defaultdict(list)
+    for order_id, *item in OrderItem.objects.filter(order_id__in=order_ids).values_list(
+            'order_id', 'product_id', 'product__category_id', 'quantity', 'price'):
+        items[order_id].append(tuple(item))
+    return items
+
+
+def _with_categories(items):
+    """``(product id, quantity, price)`` tuples with the product's category added."""
+    categories = dict(Product.objects.filter(pk__in={item[0] for item in items}).values_list('pk', 'category_id'))
+    return [(product_id, categories.get(product_id), quantity, price) for product_id, quantity, price in items]
+
+
+def _locked_state(order_id):
+    return RolledUpOrder.objects.select_for_update().filter(order_id=order_id).first()
+
+
+class _Deltas:
+    """Rollup changes to write together: ``{key: [category id, lines, units, revenue]}``."""
+
+    def __init__(self):
+        self.rows = {}
+
+    def add(self, state, items, sign=1):
+        for product_id, category_id, quantity, price in items:
+            row = self.rows.setdefault((state.day, product_id, state.user_type, state.status),
+                                       [None, 0, 0, Decimal(0)])
+            row[0] = category_id if category_id is not None else row[0]
+            row[1] += sign
+            row[2] += sign * quantity
+            row[3] += sign * quantity * price
+
+    def apply(self):
+        rows = sorted((key, values) for key, values in self.rows.items() if any(values[1:]))
+        self.rows = {}
+        if connection.vendor not in ('postgresql', 'sqlite'):
+            for key, values in rows:
+                _apply_row(dict(zip(_KEY, key)), *values)
+            return
+        qn = connection.ops.quote_name
+        table = qn(SalesRollup._meta.db_table)
+        columns = [*_KEY, 'category_id', *_MEASURES]
+        updates = ', '.join([
+            f'{qn("category_id")} = COALESCE(excluded.{qn("category_id")}, {table}.{qn("category_id")})',
+            *(f'{qn(name)} = {table}.{qn(name)} + excluded.{qn(name)}' for name in _MEASURES),
+        ])
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), BATCH_SIZE):
+                batch = rows[start:start + BATCH_SIZE]
+                values = ', '.join(['(' + ', '.join(['%s'] * len(columns)) + ')'] * len(batch))
+                params = [
+                    param
+                    for (day, *key), (category_id, lines, units, revenue) in batch
+                    for param in (connection.ops.adapt_datefield_value(day), *key, category_id, lines, units, revenue)
+                ]
+                cursor.execute(
+                    f'INSERT INTO {table} ({", ".join(map(qn, columns))}) VALUES {values} '
+                    f'ON CONFLICT ({", ".join(map(qn, _KEY))}) DO UPDATE SET {updates}',
+                    params,
+                )
+
+
+def _apply_row(key, category_id, lines, units, revenue):
+    increments = {'lines': F('lines') + lines, 'units': F('units') + units, 'revenue': F('revenue') + revenue}
+    if category_id is not None:
+        increments['category_id'] = category_id
+    if SalesRollup.objects.filter(**key).update(**increments):
+        return
+    try:
+        with transaction.atomic():
+            SalesRollup.objects.create(**key, category_id=category_id, lines=lines, units=units, revenue=revenue)
+    except IntegrityError:
+        # Another transaction created the row first.
+        SalesRollup.objects.filter(**key).update(**increments)
+
+
+def sync_order(order):
+    """Count ``order``'s items under its current status, moving them from the status they were counted under."""
+    with transaction.atomic():
+        state = _locked_state(order.pk)
+        if state is not None and state.status == order.status:
+            return
+        deltas = _Deltas()
+        items = _order_items([order.pk])[order.pk]
+        if state is None:
+            state = RolledUpOrder(
+                order_id=order.pk, day=timezone.localdate(order.created_at), status=order.status,
+                user_type=order.user.user_type if order.user_id else GUEST,
+            )
+            state.save(force_insert=True)
+        else:
+            deltas.add(state, items, -1)
+            state.status = order.status
+            state.save(update_fields=['status'])
+        deltas.add(state, items)
+        deltas.apply()
+
+
+def add_items(order, items):
+    """Count ``items`` just bulk-created for ``order``, which sends no signals."""
+    with transaction.atomic():
+        state = _locked_state(order.pk)
+        if state is None:
+            # Not counted yet; backfill counts all its items.
+            return
+        deltas = _Deltas()
+        deltas.add(state, _with_categories([(item.product_id, item.quantity, item.price) for item in items]))
+        deltas.apply()
+    for item in items:
+        item._rolled_up = (item.product_id, item.quantity, item.price)
+
+
+def item_saved(item, created):
+    old = None if created else getattr(item, '_rolled_up', None)
+    new = (item.product_id, item.quantity, item.price)
+    if old == new:
+        return
+    with transaction.atomic():
+        state = _locked_state(item.order_id)
+        if state is not None:
+            deltas = _Deltas()
+            if old is not None:
+                deltas.add(state, _with_categories([old]), -1)
+            deltas.add(state, _with_categories([new]))
+            deltas.apply()
+    item._rolled_up = new
+
+
+def item_deleted(item):
+    counted = getattr(item, '_rolled_up', None) or (item.product_id, item.quantity, item.price)
+    with transaction.atomic():
+        state = _locked_state(item.order_id)
+        if state is not None:
+            deltas = _Deltas()
+            deltas.add(state, _with_categories([counted]), -1)
+            deltas.apply()
+
+
+def remove_order(order):
+    """Take a deleted order's items out of the rollups."""
+    with transaction.atomic():
+        state = _locked_state(order.pk)
+        if state is None:
+            return
+        deltas = _Deltas()
+        deltas.add(state, _order_items([order.pk])[order.pk], -1)
+        deltas.apply()
+        state.delete()
+
+
+def _orders_in(orders, day_from=None, day_to=None):
+    if day_from:
+        orders = orders.filter(created_at__gte=_day_start(day_from))
+    if day_to:
+        orders = orders.filter(created_at__lt=_day_start(day_to + datetime.timedelta(days=1)))
+    return orders
+
+
+def backfill(batch_size=1000, day_from=None, day_to=None):
+    """
+    Count the next ``batch_size`` orders (oldest first, in the optional day
+    range) that aren't in the rollups yet; returns how many were counted.
+    Orders other transactions hold are skipped where the database allows.
+    """
+    orders = _orders_in(Order.objects.filter(rollup__isnull=True), day_from, day_to)
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            orders = orders.select_for_update(skip_locked=True, of=('self',))
+        batch = list(orders.order_by('id').values_list('id', 'created_at', 'status', 'user__user_type')[:batch_size])
+        if not batch:
+            return 0
+        states = RolledUpOrder.objects.bulk_create([
+            RolledUpOrder(order_id=order_id, day=timezone.localdate(created_at), status=status,
+                          user_type=user_type or GUEST)
+            for order_id, created_at, status, user_type in batch
+        ])
+        items = _order_items([state.order_id for state in states])
+        deltas = _Deltas()
+        for state in states:
+            deltas.add(state, items[state.order_id])
+        deltas.apply()
+    return len(states)
+
+
+def reset(day_from=None, day_to=None):
+    """Forget the rollups of a day range (everything by default), so backfill counts its orders again."""
+    rollups, states = SalesRollup.objects.all(), RolledUpOrder.objects.all()
+    if day_from:
+        rollups, states = rollups.filter(day__gte=day_from), states.filter(day__gte=day_from)
+    if day_to:
+        rollups, states = rollups.filter(day__lte=day_to), states.filter(day__lte=day_to)
+    with transaction.atomic():
+        rollups.delete()
+        return states.delete()[0]
+
+
+def pending(day_from=None, day_to=None):
+    """Orders backfill hasn't counted yet."""
+    return _orders_in(Order.objects.filter(rollup__isnull=True), day_from, day_to).count()
+
+
+def _totals(rows):
+    return rows.annotate(lines_=Sum('lines'), units_=Sum('units'), revenue_=Sum('revenue'))
+
+
+def report(day_from, day_to, statuses=SALES_STATUSES, user_types=()):
+    """
+    Sales between two days (inclusive) from the rollups alone: totals, and
+    revenue by day and customer type, by category, by customer type, by
+    status and for the top products. Reads rows for the range's keys, not
+    its orders.
+    """
+    rows = SalesRollup.objects.filter(day__range=(day_from, day_to))
+    if statuses:
+        rows = rows.filter(status__in=statuses)
+    if user_types:
+        rows = rows.filter(user_type__in=user_types)
+
+    def grouped(*fields, limit=None):
+        result = list(_totals(rows.values(*fields)).order_by('-revenue_', *fields)[:limit])
+        return [{**{name: row[name] for name in fields}, 'lines': row['lines_'], 'units': row['units_'],
+                 'revenue': row['revenue_']} for row in result]
+
+    totals = rows.aggregate(lines=Sum('lines'), units=Sum('units'), revenue=Sum('revenue'), rows=Count('id'))
+    by_day = defaultdict(dict)
+    for row in grouped('day', 'user_type'):
+        by_day[row['day']][row['user_type']] = row['revenue']
+    days = []
+    day = day_from
+    while day <= day_to:
+        revenue = by_day.get(day, {})
+        days.append({'day': day, 'by_user_type': revenue, 'revenue': sum(revenue.values(), Decimal(0))})
+        day += datetime.timedelta(days=1)
+    return {
+        'totals': {name: value or 0 for name, value in totals.items()},
+        'days': days,
+        'categories': grouped('category_id'),
+        'user_types': grouped('user_type'),
+        'statuses': grouped('status'),
+        'products': grouped('product_id', limit=10),
+    }
@@ -0,0 +1,35 @@
+from allauth.account.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from . import rollups
+from .models import Order, OrderItem
+
+
+@receiver(user_logged_in)
+def merge_guest_cart(sender, request, user, **kwargs):
+    cart = getattr(request, 'cart', None)
+    if cart is not None:
+        cart.merge_guest_cart(user)
+
+
+@receiver(post_save, sender=Order)
+def roll_up_order(sender, instance, raw=False, **kwargs):
+    if not raw:
+        rollups.sync_order(instance)
+
+
+@receiver(pre_delete, sender=Order)
+def unroll_order(sender, instance, **kwargs):
+    rollups.remove_order(instance)
+
+
+@receiver(post_save, sender=OrderItem)
+def roll_up_item(sender, instance, created, raw=False, **kwargs):
+    if not raw:
+        rollups.item_saved(instance, created)
+
+
+@receiver(post_delete, sender=OrderItem)
+def unroll_item(sender, instance, **kwargs):
+    rollups.item_deleted(instance)
@@ -0,0 +1,708 @@
+import hashlib
+import hmac
+import io
+import json
+import threading
+import time
+import uuid
+from collections import defaultdict
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+import stripe
+from allauth.account.signals import user_logged_in
+from asgiref.sync import async_to_sync
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core import signing
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import OperationalError, connection
+from django.db.models import Sum
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from django.utils import timezone
+
+from marketplace.testing import LOCAL_CACHE, ConditionalGetTestsMixin
+from products.cache import get_generation
+from products.facets import reset_index
+from products.models import Category, FacetChange, Product
+from . import export, rollups, views
+from .cart import resolve_cart
+from .cart_store import (
+    COOKIE_NAME, COOKIE_SALT, CacheCartStore, DatabaseCartStore, RequestCart, set_store,
+)
+from .fulfillment import materialize_order
+from .inventory import InsufficientStock, commit_reservation, reserve_stock
+from .models import Cart, Order, OrderItem, SalesRollup, StockReservation, WebhookEvent
+from .webhooks import claim_batch, process
+
+# The async export view, routed as ASYNC_VIEWS would (see AsyncOrderExportTests).
+urlpatterns = [
+    path('orders/export/', views.AsyncOrderExportView.as_view(), name='order_export'),
+    path('', include('marketplace.urls')),
+]
+
+
+def make_products(count, **fields):
+    category = Category.objects.create(name='Pots', slug='pots')
+    return Product.objects.bulk_create([
+        Product(name=f'Pot {i}', slug=f'pot-{i}', description='Clay pot', price=Decimal('10.00') + i,
+                category=category, **{'stock': 100, **fields})
+        for i in range(count)
+    ])
+
+
+def cart_of(products, quantity=1):
+    return {
+        str(product.pk): {'product_id': product.pk, 'quantity': quantity, 'size': None, 'color': None}
+        for product in products
+    }
+
+
+class ResolveCartTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_products(40)
+
+    def test_one_query_whatever_the_cart_size(self):
+        for size in (1, 40):
+            with self.subTest(lines=size), self.assertNumQueries(1):
+                resolved = resolve_cart(cart_of(self.products[:size], quantity=2))
+            self.assertEqual(len(resolved), size)
+            self.assertEqual(resolved.total, sum(product.get_price(None) * 2 for product in self.products[:size]))
+
+    def test_invalid_lines_are_reported(self):
+        cart = cart_of(self.products[:2])
+        cart['missing'] = {'product_id': 0, 'quantity': 1}
+        cart['broken'] = {'quantity': 'x'}
+        resolved = resolve_cart(cart)
+        self.assertEqual(len(resolved), 2)
+        self.assertCountEqual(resolved.invalid_keys, ['missing', 'broken'])
+
+    def test_cart_page_query_count_does_not_grow_with_lines(self):
+        counts = {}
+        for size in (1, 20):
+            client = self.client_class()
+            for product in self.products[:size]:
+                client.post(reverse('add_to_cart', args=[product.pk]), {'quantity': 1}, secure=True)
+            client.get(reverse('cart'), secure=True)  # Consume the "added" messages.
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(reverse('cart'), secure=True)
+            self.assertEqual(len(response.context['cart_items']), size)
+            counts[size] = len(queries)
+        self.assertEqual(counts[1], counts[20])
+
+
+def line(product, quantity, size=None, color=None):
+    return {'product_id': product.pk, 'quantity': quantity, 'size': size, 'color': color}
+
+
+def sign_cart_cookie(cart_id):
+    return signing.get_cookie_signer(salt=COOKIE_NAME + COOKIE_SALT).sign(str(cart_id))
+
+
+class CartStoreTestsMixin:
+    """A cart store on its own and behind RequestCart and CartMiddleware, as the views use it."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.products = make_products(3)
+        cls.user = get_user_model().objects.create_user(username='shopper', password=None)
+
+    def setUp(self):
+        cache.clear()
+        set_store(self.store)
+        self.addCleanup(set_store, None)
+
+    def request(self, user=None, cookies=None, session=None):
+        request = RequestFactory().get('/')
+        request.user = user or AnonymousUser()
+        request.COOKIES.update(cookies or {})
+        request.session = session or SessionStore()
+        return request
+
+    def test_add_sums_quantities_per_line(self):
+        pot, tray = self.products[:2]
+        cart_id = self.store.new_guest_cart()
+        self.store.add(cart_id, 'pot', pot.pk, 1)
+        self.store.add(cart_id, 'tray-m', tray.pk, 2, 'M', 'Red')
+        self.store.add(cart_id, 'pot', pot.pk, 3)
+        self.assertEqual(self.store.lines(cart_id), {'pot': line(pot, 4), 'tray-m': line(tray, 2, 'M', 'Red')})
+        self.assertEqual(self.store.count(cart_id), 2)
+
+    def test_set_quantity_remove_and_clear(self):
+        pot, tray, bag = self.products
+        cart_id = self.store.new_guest_cart()
+        for product in self.products:
+            self.store.add(cart_id, str(product.pk), product.pk, 1)
+        self.assertTrue(self.store.set_quantity(cart_id, str(pot.pk), 5))
+        self.assertFalse(self.store.set_quantity(cart_id, 'missing', 5))
+        self.assertTrue(self.store.remove(cart_id, [str(tray.pk), 'missing']))
+        self.assertFalse(self.store.remove(cart_id, ['missing']))
+        self.assertEqual(self.store.lines(cart_id), {str(pot.pk): line(pot, 5), str(bag.pk): line(bag, 1)})
+        self.store.clear(cart_id)
+        self.assertEqual(self.store.count(cart_id), 0)
+
+    def test_users_have_one_cart(self):
+        self.assertIsNone(self.store.cart_for_user(self.user.pk))
+        cart_id = self.store.cart_for_user(self.user.pk, create=True)
+        self.assertEqual(self.store.cart_for_user(self.user.pk, create=True), cart_id)
+        self.assertEqual(self.store.cart_for_user(self.user.pk), cart_id)
+
+    def test_guest_cart_lives_in_a_signed_cookie(self):
+        pot, tray = self.products[:2]
+        response = self.client.post(reverse('add_to_cart', args=[pot.pk]), {'quantity': 2}, secure=True)
+        cookie = response.cookies[COOKIE_NAME]
+        self.assertTrue(cookie['httponly'])
+        cart_id = signing.get_cookie_signer(salt=COOKIE_NAME + COOKIE_SALT).unsign(cookie.value)
+        self.assertEqual(list(self.store.lines(cart_id).values()), [line(pot, 2)])
+        # The cart is found through the cookie, which isn't sent again.
+        response = self.client.post(reverse('add_to_cart', args=[tray.pk]), {'quantity': 1}, secure=True)
+        self.assertNotIn(COOKIE_NAME, response.cookies)
+        self.assertEqual(self.store.count(cart_id), 2)
+        # Nor is a guest's cart read from the session.
+        request = self.request(cookies={COOKIE_NAME: sign_cart_cookie(cart_id), settings.SESSION_COOKIE_NAME: 'key'},
+                               session=SessionStore('key'))
+        cart = RequestCart(request, self.store)
+        with mock.patch.object(SessionStore, 'load', side_effect=AssertionError('session loaded')):
+            self.assertEqual(len(cart.lines()), 2)
+        # A cookie that doesn't verify is ignored.
+        self.client.cookies[COOKIE_NAME] = cart_id
+        response = self.client.get(reverse('cart'), secure=True)
+        self.assertEqual(len(response.context['cart_items']), 0)
+
+    def test_guest_cart_is_merged_into_the_users_on_login(self):
+        pot, tray = self.products[:2]
+        user_cart = self.store.cart_for_user(self.user.pk, create=True)
+        self.store.add(user_cart, 'pot', pot.pk, 1)
+        guest_cart = self.store.new_guest_cart()
+        self.store.add(guest_cart, 'pot', pot.pk, 2)
+        self.store.add(guest_cart, 'tray', tray.pk, 1)
+        request = self.request(cookies={COOKIE_NAME: sign_cart_cookie(guest_cart)})
+        request.cart = RequestCart(request, self.store)
+        self.assertEqual(len(request.cart), 2)
+
+        user_logged_in.send(sender=type(self.user), request=request, user=self.user)
+        request.user = self.user
+        self.assertEqual(request.cart.lines(), {'pot': line(pot, 3), 'tray': line(tray, 1)})
+        self.assertEqual(self.store.lines(guest_cart), {})
+        # CartMiddleware deletes the cookie.
+        self.assertIsNone(request.cart.cookie)
+
+    def test_legacy_session_cart_is_imported_once(self):
+        pot, tray = self.products[:2]
+        for user in (None, self.user):
+            with self.subTest(signed_in=user is not None):
+                session = SessionStore()
+                session['cart'] = {str(pot.pk): 2, str(tray.pk): 'many'}
+                session.save()
+                request = self.request(user, {settings.SESSION_COOKIE_NAME: session.session_key},
+                                       SessionStore(session.session_key))
+                cart = RequestCart(request, self.store)
+                self.assertEqual(cart.lines(), {str(pot.pk): line(pot, 2)})
+                self.assertNotIn('cart', request.session)
+                if user is None:
+                    # The new cookie tells the next request not to look again.
+                    self.assertEqual(cart.cookie, str(cart.id))
+                else:
+                    self.assertEqual(cart.id, self.store.cart_for_user(user.pk))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class DatabaseCartStoreTests(CartStoreTestsMixin, TestCase):
+    store = DatabaseCartStore()
+
+    @skipUnless(connection.vendor in ('postgresql', 'sqlite'), 'upserts with ON CONFLICT')
+    def test_add_is_one_upsert(self):
+        pot = self.products[0]
+        cart_id = self.store.new_guest_cart()
+        for quantity in (1, 2):
+            with CaptureQueriesContext(connection) as queries:
+                self.store.add(cart_id, 'pot', pot.pk, quantity)
+            self.assertEqual(len(queries), 1)
+            self.assertIn('ON CONFLICT', queries[0]['sql'])
+        self.assertEqual(self.store.lines(cart_id), {'pot': line(pot, 3)})
+
+    @skipUnless(connection.vendor in ('postgresql', 'sqlite'), 'upserts with ON CONFLICT')
+    def test_merge_moves_every_line_in_one_statement(self):
+        pot, tray, bag = self.products
+        user_cart = self.store.cart_for_user(self.user.pk, create=True)
+        self.store.add(user_cart, 'pot', pot.pk, 1)
+        guest_cart = self.store.new_guest_cart()
+        for product in self.products:
+            self.store.add(guest_cart, product.name, product.pk, 2)
+        with CaptureQueriesContext(connection) as queries:
+            self.store.merge(guest_cart, user_cart)
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 1)
+        self.assertIn('SELECT', inserts[0])
+        self.assertEqual(self.store.lines(user_cart), {
+            'pot': line(pot, 1), pot.name: line(pot, 2), tray.name: line(tray, 2), bag.name: line(bag, 2),
+        })
+        self.assertFalse(Cart.objects.filter(pk=guest_cart).exists())
+        # A user's cart is never dropped, even as the source.
+        self.store.merge(user_cart, self.store.new_guest_cart())
+        self.assertTrue(Cart.objects.filter(pk=user_cart).exists())
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CacheCartStoreTests(CartStoreTestsMixin, TestCase):
+    store = CacheCartStore()
+
+    def test_purged_guest_cart_is_replaced(self):
+        pot = self.products[0]
+        request = self.request(cookies={COOKIE_NAME: sign_cart_cookie('expired')})
+        cart = RequestCart(request, self.store)
+        cart.add('pot', pot.pk, 1)
+        self.assertNotEqual(cart.id, 'expired')
+        self.assertEqual(cart.cookie, cart.id)
+        self.assertEqual(self.store.lines(cart.id), {'pot': line(pot, 1)})
+
+
+class ReservationTests(TestCase):
+    def test_saving_a_product_keeps_concurrent_reservations(self):
+        product = make_products(1, stock=5)[0]
+        stale = Product.objects.get(pk=product.pk)
+        reserve_stock(resolve_cart(cart_of([product], quantity=2)).lines)
+        stale.name = 'Renamed pot'
+        stale.save()
+        product.refresh_from_db()
+        self.assertEqual((product.name, product.reserved), ('Renamed pot', 2))
+
+    def test_commit_turns_the_reservation_into_sold_stock(self):
+        product = make_products(1, stock=5)[0]
+        lines = resolve_cart(cart_of([product], quantity=2)).lines
+        commit_reservation(reserve_stock(lines), lines)
+        product.refresh_from_db()
+        self.assertEqual((product.stock, product.reserved), (3, 0))
+        self.assertFalse(StockReservation.objects.exists())
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=300)
+class SaleCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        reset_index()
+
+    def etag(self, url):
+        return self.client.get(url, secure=True)['ETag']
+
+    def sell(self, product, quantity):
+        lines = resolve_cart(cart_of([product], quantity=quantity)).lines
+        with self.captureOnCommitCallbacks(execute=True):
+            commit_reservation(reserve_stock(lines), lines)
+
+    def test_sale_only_changes_the_sold_product_page(self):
+        sold, other = make_products(2, stock=5)
+        urls = [reverse('product_list'), reverse('product_detail', args=[sold.slug]),
+                reverse('product_detail', args=[other.slug])]
+        before = [self.etag(url) for url in urls]
+        generation = get_generation()
+        self.sell(sold, 2)
+        self.assertEqual(get_generation(), generation)
+        self.assertFalse(FacetChange.objects.exists())
+        after = [self.etag(url) for url in urls]
+        self.assertEqual((after[0], after[2]), (before[0], before[2]))
+        self.assertNotEqual(after[1], before[1])
+        self.assertContains(self.client.get(urls[1], secure=True), '3 available')
+
+    def test_selling_out_changes_the_catalog(self):
+        product = make_products(1, stock=2)[0]
+        before = self.etag(reverse('product_list'))
+        generation = get_generation()
+        self.sell(product, 2)
+        self.assertNotEqual(get_generation(), generation)
+        self.assertEqual(list(FacetChange.objects.values_list('product_id', flat=True)), [product.pk])
+        self.assertNotEqual(self.etag(reverse('product_list')), before)
+
+
+class ConcurrentReservationTests(TransactionTestCase):
+    BUYERS = 20
+    STOCK = 10
+
+    def test_concurrent_buyers_never_oversell(self):
+        product = make_products(1, stock=self.STOCK)[0]
+        lines = resolve_cart(cart_of([product])).lines
+        barrier = threading.Barrier(self.BUYERS)
+        outcomes = []
+
+        def buy():
+            try:
+                barrier.wait()
+                for _ in range(100):
+                    try:
+                        reserve_stock(lines)
+                    except InsufficientStock:
+                        outcomes.append('sold out')
+                    except OperationalError:
+                        # SQLite's shared in-memory test database locks
+                        # tables instead of waiting; try again.
+                        time.sleep(0.01)
+                        continue
+                    else:
+                        outcomes.append('reserved')
+                    return
+            finally:
+                connection.close()
+
+        buyers = [threading.Thread(target=buy) for _ in range(self.BUYERS)]
+        for buyer in buyers:
+            buyer.start()
+        for buyer in buyers:
+            buyer.join()
+
+        product.refresh_from_db()
+        held = StockReservation.objects.filter(product=product).aggregate(units=Sum('quantity'))['units']
+        self.assertEqual(len(outcomes), self.BUYERS)
+        self.assertEqual(outcomes.count('reserved'), self.STOCK)
+        self.assertEqual(product.reserved, self.STOCK)
+        self.assertEqual(held, self.STOCK)
+        self.assertLessEqual(product.reserved, product.stock)
+
+
+WEBHOOK_SECRET = 'whsec_test'
+
+
+@override_settings(STRIPE_WEBHOOK_SECRET=WEBHOOK_SECRET)
+class StripeWebhookTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.product = make_products(1, stock=5)[0]
+
+    def session(self, payment_status='paid'):
+        lines = resolve_cart(cart_of([self.product], quantity=2)).lines
+        return {
+            'id': 'cs_test_1', 'object': 'checkout.session', 'payment_status': payment_status,
+            'amount_total': 2200, 'payment_intent': 'pi_test_1',
+            'metadata': {
+                'order_data': json.dumps({'email': 'buyer@example.com', 'full_name': 'Buyer', 'address': 'Street 1'}),
+                'cart': json.dumps(cart_of([self.product], quantity=2)),
+                'reservation': reserve_stock(lines),
+            },
+        }
+
+    def deliver(self, event_id, event_type, session, secret=WEBHOOK_SECRET):
+        payload = json.dumps({'id': event_id, 'object': 'event', 'type': event_type, 'data': {'object': session}})
+        timestamp = int(time.time())
+        signature = hmac.new(secret.encode(), f'{timestamp}.{payload}'.encode(), hashlib.sha256).hexdigest()
+        return self.client.post(reverse('stripe_webhook'), payload, content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=f't={timestamp},v1={signature}', secure=True)
+
+    def drain(self):
+        for event in claim_batch(100, 300):
+            self.assertTrue(process(event), event.last_error)
+
+    def assertSold(self, orders):
+        self.product.refresh_from_db()
+        self.assertEqual(Order.objects.filter(stripe_session_id='cs_test_1').count(), orders)
+        self.assertEqual((self.product.stock, self.product.reserved), (5 - 2 * orders, 2 - 2 * orders))
+
+    def test_redelivered_event_creates_one_order(self):
+        session = self.session()
+        for _ in range(2):
+            self.assertEqual(self.deliver('evt_1', 'checkout.session.completed', session).status_code, 200)
+        self.assertEqual(WebhookEvent.objects.count(), 1)
+        self.drain()
+        # Replayed after processing, and as a separate event for the same session.
+        self.deliver('evt_1', 'checkout.session.completed', session)
+        self.deliver('evt_2', 'checkout.session.async_payment_succeeded', session)
+        self.drain()
+        self.assertSold(1)
+        self.assertEqual(Order.objects.get().total_amount, Decimal('22.00'))
+
+    def test_unpaid_session_waits_for_async_payment(self):
+        session = self.session(payment_status='unpaid')
+        self.deliver('evt_1', 'checkout.session.completed', session)
+        self.drain()
+        self.assertFalse(Order.objects.exists())
+        self.deliver('evt_2', 'checkout.session.async_payment_succeeded', {**session, 'payment_status': 'paid'})
+        self.drain()
+        self.assertSold(1)
+
+    def test_bad_signature_is_rejected(self):
+        response = self.deliver('evt_1', 'checkout.session.completed', self.session(), secret='whsec_other')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(reverse('stripe_webhook'), '{}', content_type='application/json', secure=True)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(WebhookEvent.objects.exists())
+
+
+@override_settings(WEBHOOK_MAX_ATTEMPTS=3)
+class WebhookClaimTests(TestCase):
+    def stale_event(self, attempts=0):
+        return WebhookEvent.objects.create(
+            stripe_event_id=f'evt_stale_{attempts}', type='customer.created', payload={}, status='processing',
+            attempts=attempts, claim='dead-worker', claimed_at=timezone.now() - timedelta(hours=1),
+        )
+
+    def test_reclaiming_a_stale_event_counts_an_attempt(self):
+        event = self.stale_event()
+        [claimed] = claim_batch(10, stale_after=60)
+        self.assertEqual(claimed.pk, event.pk)
+        self.assertEqual(claimed.attempts, 1)
+        self.assertNotEqual(claimed.claim, 'dead-worker')
+
+    def test_event_that_keeps_killing_workers_fails(self):
+        event = self.stale_event(attempts=2)
+        with self.assertLogs('orders.webhooks', 'ERROR'):
+            self.assertEqual(claim_batch(10, stale_after=60), [])
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('failed', 3))
+
+    def test_outcome_is_not_recorded_over_a_newer_claim(self):
+        self.stale_event()
+        [slow] = claim_batch(10, stale_after=60)
+        WebhookEvent.objects.filter(pk=slow.pk).update(claimed_at=timezone.now() - timedelta(hours=1))
+        [fast] = claim_batch(10, stale_after=60)
+        with self.assertLogs('orders.webhooks', 'WARNING'):
+            process(slow)
+        event = WebhookEvent.objects.get(pk=slow.pk)
+        self.assertEqual((event.status, event.claim, event.processed_at), ('processing', fast.claim, None))
+        process(fast)
+        event.refresh_from_db()
+        self.assertEqual((event.status, event.attempts), ('done', 2))
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class OrderConditionalGetTests(ConditionalGetTestsMixin, TestCase):
+    def test_order_detail_revalidates_until_the_order_changes(self):
+        product = make_products(1)[0]
+        user = get_user_model().objects.create_user(username='buyer', password=None)
+        order = Order.objects.create(user=user, email='buyer@example.com', full_name='Buyer', address='Street 1',
+                                     status='processing', total_amount=Decimal('42.00'))
+        OrderItem.objects.create(order=order, product=product, price=Decimal('21.00'), quantity=2)
+        self.client.force_login(user)
+        url = reverse('order_detail', args=[order.pk])
+        etag = self.assertRevalidates(self.client, url, last_modified_sent=False)
+        order.status = 'shipped'
+        order.save(update_fields=['status', 'updated_at'])
+        response, _ = self.get(self.client, url, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class AsyncOrderExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        product = make_products(1)[0]
+        for i in range(50):
+            order = Order.objects.create(email=f'customer{i}@example.com', full_name=f'Customer {i}',
+                                         address='Street 1', status='processing', total_amount=Decimal('20.00'))
+            OrderItem.objects.create(order=order, product=product, price=Decimal('10.00'), quantity=2)
+        cls.staff = get_user_model().objects.create_user(username='staff', password=None, is_staff=True)
+
+    def get(self, **params):
+        # Through the ASGI handler, like the async client; queries stay on this thread.
+        return async_to_sync(self.async_client.get)('/orders/export/', params, secure=True)
+
+    @staticmethod
+    @async_to_sync
+    async def read(response):
+        return [chunk async for chunk in response.streaming_content]
+
+    @mock.patch.object(export, 'BATCH_BYTES', 1024)
+    def test_streams_the_export_one_chunk_at_a_time(self):
+        self.async_client.force_login(self.staff)
+        for format in export.FORMATS:
+            with self.subTest(format):
+                response = self.get(format=format)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.is_async)
+                chunks = self.read(response)
+                expected = list(export.encode(export.export_rows(), format))
+                self.assertGreater(len(expected), 1)
+                self.assertEqual(chunks, [chunk.encode() for chunk in expected])
+
+    def test_staff_only(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(response['Location'].startswith(reverse('admin:login')))
+        self.async_client.force_login(get_user_model().objects.create_user(username='buyer', password=None))
+        self.assertEqual(self.get().status_code, 302)
+
+    def test_invalid_filters(self):
+        self.async_client.force_login(self.staff)
+        self.assertEqual(self.get(created_from='yesterday').status_code, 400)
+
+
+class SalesRollupTests(TestCase):
+    """The sales rollups against totals computed from the orders themselves."""
+    DAYS = 7
+    # Orders bulk_orders needs to cover every rollup key: days x customer
+    # types x sales statuses, for each of the three product pairs.
+    KEYS = DAYS * 3 * 3
+
+    @classmethod
+    def setUpTestData(cls):
+        categories = [Category.objects.create(name=f'Rollup {i}', slug=f'rollup-{i}') for i in range(2)]
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Rollup product {i}', slug=f'rollup-{i}', description='Lorem ipsum',
+                    price=Decimal('10.00') + i, category=categories[i % 2], stock=10000)
+            for i in range(6)
+        ])
+        User = get_user_model()
+        cls.users = [None] + [
+            User.objects.create_user(username=f'rollup-{user_type}', email=f'rollup-{user_type}@example.com',
+                                     password=None, user_type=user_type)
+            for user_type in ('normal', 'business')
+        ]
+        cls.staff = User.objects.create_user(username='rollup-staff', password=None, is_staff=True)
+        cls.day_to = timezone.localdate()
+        cls.day_from = cls.day_to - timedelta(days=cls.DAYS - 1)
+
+    def live(self):
+        """Totals per rollup key computed from the orders."""
+        totals = defaultdict(lambda: [0, 0, Decimal(0)])
+        items = OrderItem.objects.values_list(
+            'order__created_at', 'product_id', 'order__user__user_type', 'order__status', 'quantity', 'price')
+        for created_at, product_id, user_type, status, quantity, price in items:
+            row = totals[(timezone.localdate(created_at), product_id, user_type or export.GUEST, status)]
+            row[0] += 1
+            row[1] += quantity
+            row[2] += quantity * price
+        return {key: tuple(values) for key, values in totals.items()}
+
+    def assertRollupsMatch(self, label):
+        rows = SalesRollup.objects.values_list('day', 'product_id', 'user_type', 'status', 'lines', 'units', 'revenue')
+        rolled_up = {tuple(row[:4]): tuple(row[4:]) for row in rows if any(row[4:])}
+        self.assertEqual(rolled_up, self.live(), label)
+
+    def checkout(self, user, lines):
+        tag = uuid.uuid4().hex[:12]
+        cart = {str(product.pk): {'product_id': product.pk, 'quantity': quantity, 'size': None, 'color': None}
+                for product, quantity in lines}
+        session = stripe.checkout.Session.construct_from({
+            'id': f'cs_rollup_{tag}', 'amount_total': 1000, 'payment_intent': f'pi_rollup_{tag}',
+            'metadata': {'order_data': json.dumps({'email': 'rollup@example.com', 'full_name': 'Rollup',
+                                                   'address': 'Street 1'}),
+                         'cart': json.dumps(cart)},
+        }, key=None)
+        return materialize_order(session, user)
+
+    def bulk_orders(self, count):
+        """
+        Orders and items created without signals. Every ``KEYS`` orders
+        cover each day, customer type, sales status and pair of products once.
+        """
+        users, products, statuses = self.users, self.products, rollups.SALES_STATUSES
+        orders = Order.objects.bulk_create([
+            Order(user=users[i // self.DAYS % len(users)], email='rollup@example.com', full_name='Rollup',
+                  address='Street 1', status=statuses[i // (self.DAYS * len(users)) % len(statuses)],
+                  total_amount=Decimal('10.00'))
+            for i in range(count)
+        ])
+        for day in range(self.DAYS):
+            Order.objects.filter(pk__in=[order.pk for order in orders[day::self.DAYS]]).update(
+                created_at=rollups._day_start(self.day_from + timedelta(days=day)) + timedelta(hours=12))
+        pairs = len(products) // 2
+        OrderItem.objects.bulk_create([
+            OrderItem(order=order, product=product, price=product.price, quantity=1 + j)
+            for i, order in enumerate(orders)
+            for j, product in enumerate(products[i // self.KEYS * 2 % (pairs * 2):][:2])
+        ])
+        return orders
+
+    def backfill(self, *args):
+        call_command('backfill_sales_rollups', '--from', self.day_from.isoformat(), *args, stdout=io.StringIO())
+
+    def dashboard(self):
+        """The dashboard for the whole range, its query count and its reads of the order tables."""
+        order_tables = (Order._meta.db_table, OrderItem._meta.db_table)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('sales_dashboard'), {
+                'day_from': self.day_from.isoformat(), 'day_to': self.day_to.isoformat(),
+            }, secure=True)
+        self.assertEqual(response.status_code, 200)
+        order_reads = [q['sql'] for q in queries.captured_queries if any(t in q['sql'] for t in order_tables)]
+        return response, len(queries), order_reads
+
+    def test_signals_keep_the_rollups_current(self):
+        products, normal, business = self.products, self.users[1], self.users[2]
+        self.checkout(normal, [(products[0], 2), (products[1], 1)])
+        self.checkout(None, [(products[0], 1)])
+        self.assertRollupsMatch('checkout')
+
+        order = Order.objects.create(user=business, email=business.email, full_name='Rollup', address='Street 1',
+                                     status='pending', total_amount=Decimal('50.00'))
+        OrderItem.objects.create(order=order, product=products[2], price=products[2].price, quantity=3)
+        OrderItem.objects.create(order=order, product=products[3], price=products[3].price, quantity=1)
+        self.assertRollupsMatch('pending order with per-item creates')
+
+        order.status = 'processing'
+        order.save()
+        self.assertRollupsMatch('status change')
+        order.save()
+        self.assertRollupsMatch('save without a status change')
+
+        item = OrderItem.objects.filter(order=order).order_by('id').first()
+        item.quantity = 5
+        item.price = Decimal('7.00')
+        item.save()
+        self.assertRollupsMatch('item edit')
+        item.product = products[4]
+        item.save()
+        self.assertRollupsMatch('item moved to another product')
+        OrderItem.objects.filter(order=order).order_by('-id').first().delete()
+        self.assertRollupsMatch('item delete')
+        Order.objects.get(pk=order.pk).delete()
+        self.assertRollupsMatch('order delete')
+
+    def test_backfill_counts_bulk_created_orders_and_resumes(self):
+        self.bulk_orders(50)
+        self.assertEqual(rollups.pending(self.day_from), 50)
+        self.backfill('--batch-size', '20', '--max-batches', '1')
+        self.assertEqual(rollups.pending(self.day_from), 30)
+        self.backfill('--batch-size', '20')
+        self.assertEqual(rollups.pending(self.day_from), 0)
+        self.assertRollupsMatch('backfill')
+
+    def test_rebuild_picks_up_category_moves(self):
+        self.bulk_orders(self.KEYS)
+        self.backfill()
+        moved = self.products[0]
+        Product.objects.filter(pk=moved.pk).update(category=self.products[1].category)
+        self.backfill('--rebuild')
+        self.assertRollupsMatch('rebuild')
+        self.assertEqual(set(SalesRollup.objects.filter(product_id=moved.pk).values_list('category_id', flat=True)),
+                         {self.products[1].category_id})
+
+    def test_dashboard_is_staff_only(self):
+        self.assertEqual(self.client.get(reverse('sales_dashboard'), secure=True).status_code, 302)
+        self.client.force_login(self.staff)
+        # Defaults to the last SALES_DASHBOARD_DAYS days.
+        self.assertEqual(self.client.get(reverse('sales_dashboard'), secure=True).status_code, 200)
+
+    def test_dashboard_reads_only_the_rollups(self):
+        self.checkout(self.users[1], [(self.products[0], 2), (self.products[1], 1)])
+        self.bulk_orders(self.KEYS)
+        self.backfill()
+        self.client.force_login(self.staff)
+        response, _, order_reads = self.dashboard()
+        self.assertEqual(order_reads, [])
+        report = rollups.report(self.day_from, self.day_to)
+        revenue = sum((values[2] for key, values in self.live().items() if key[3] in rollups.SALES_STATUSES),
+                      Decimal(0))
+        self.assertEqual(report['totals']['revenue'], revenue)
+        self.assertContains(response, f'Revenue {revenue:.2f} ')
+        self.assertEqual(len(report['days']), self.DAYS)
+
+    def test_dashboard_cost_does_not_grow_with_orders(self):
+        # Fill every key, then add ten times as many orders.
+        self.bulk_orders(self.KEYS * 3)
+        self.backfill()
+        self.client.force_login(self.staff)
+        self.dashboard()  # Caches the session's user (AUTH_SNAPSHOT_TIMEOUT).
+        _, queries, _ = self.dashboard()
+        rows = rollups.report(self.day_from, self.day_to)['totals']['rows']
+        self.bulk_orders(self.KEYS * 30)
+        self.backfill()
+        self.assertRollupsMatch('tenfold orders')
+        _, grown_queries, order_reads = self.dashboard()
+        self.assertEqual(rollups.report(self.day_from, self.day_to)['totals']['rows'], rows)
+        self.assertEqual(grown_queries, queries)
+        self.assertEqual(order_reads, [])
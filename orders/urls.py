@@ -1,15 +1,27 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+
+def view(name):
+    # The cart, checkout and export views have async twins for ASGI deployments.
+    if settings.ASYNC_VIEWS:
+        name = f'Async{name}'
+    return getattr(views, name).as_view()
+
+
 urlpatterns = [
-    path('cart/', views.CartView.as_view(), name='cart'),
-    path('add/<int:product_id>/', views.AddToCartView.as_view(), name='add_to_cart'),
-    path('remove/<str:item_key>/', views.RemoveFromCartView.as_view(), name='remove_from_cart'),
-    path('update/<str:item_key>/', views.UpdateCartView.as_view(), name='update_cart'),
-    path('checkout/', views.CheckoutView.as_view(), name='checkout'),
-    path('payment/success/', views.PaymentSuccessView.as_view(), name='payment_success'),
+    path('cart/', view('CartView'), name='cart'),
+    path('add/<int:product_id>/', view('AddToCartView'), name='add_to_cart'),
+    path('remove/<str:item_key>/', view('RemoveFromCartView'), name='remove_from_cart'),
+    path('update/<str:item_key>/', view('UpdateCartView'), name='update_cart'),
+    path('checkout/', view('CheckoutView'), name='checkout'),
+    path('payment/success/', view('PaymentSuccessView'), name='payment_success'),
+    path('payment/status/', views.PaymentStatusView.as_view(), name='payment_status'),
     path('payment/cancel/', views.PaymentCancelView.as_view(), name='payment_cancel'),
     path('webhook/stripe/', views.StripeWebhookView.as_view(), name='stripe_webhook'),
+    path('export/', view('OrderExportView'), name='order_export'),
+    path('sales/', views.SalesDashboardView.as_view(), name='sales_dashboard'),
     path('my-orders/', views.OrderListView.as_view(), name='order_list'),
     path('my-orders/<int:pk>/', views.OrderDetailView.as_view(), name='order_detail'),
 ]
\ No newline at end of file
@@ -1,29 +1,114 @@
 
-from django.shortcuts import render, redirect, get_object_or_404
+from django.shortcuts import aget_object_or_404, render, redirect, get_object_or_404
 from django.views.generic import View
 from django.contrib import messages
 from django.conf import settings
 from django.urls import reverse
-from django.http import JsonResponse, HttpResponse
+from django.http import JsonResponse, HttpResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.utils.decorators import method_decorator
 from django.db import transaction
 from django.core.exceptions import ObjectDoesNotExist
 from django.views.generic import ListView, DetailView
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.contrib.admin.views.decorators import staff_member_required
+from django.contrib.auth.views import redirect_to_login
+from django.utils import timezone
 
+from asgiref.sync import sync_to_async
 import stripe
+import datetime
 import json
+import time
 from decimal import Decimal
 
 from .models import Order, OrderItem, ShippingAddress
-from .forms import OrderCreateForm
-from products.models import Product
+from .webhooks import enqueue
+from .cart import aresolve_cart, resolve_cart
+from .inventory import InsufficientStock, release_reservation, reserve_stock
+from .forms import OrderCreateForm, OrderExportForm, SalesDashboardForm
+from . import export, rollups
+from payments.gateway import get_gateway
+from marketplace.conditional import ConditionalGetMixin
+from marketplace.pagination import KeysetPaginationMixin
+from products.cache import get_catalog_version
+from products.models import Category, Product
 
 import logging
 
 logger = logging.getLogger(__name__)
 stripe.api_key = settings.STRIPE_SECRET_KEY
+# Template rendering may hit the database (the layout's cart badge, lazy
+# relations), so async views render in a thread.
+arender = sync_to_async(render)
+
+
+def _item_key(product, size, color):
+    item_key = f"{product.id}"
+    if size:
+        item_key += f"_{size}"
+    if color:
+        item_key += f"_{color}"
+    return item_key
+
+
+def _user_type(user):
+    return 'guest' if not user.is_authenticated else user.user_type
+
+
+def _checkout_initial(user, shipping_address):
+    initial_data = {'email': user.email} if user.is_authenticated else {}
+    if shipping_address:
+        initial_data.update({
+            'full_name': shipping_address.full_name, 'address': shipping_address.address,
+            'city': shipping_address.city, 'state': shipping_address.state,
+            'postal_code': shipping_address.postal_code, 'country': shipping_address.country,
+            'phone': shipping_address.phone
+        })
+    return initial_data
+
+
+def _line_items(resolved):
+    return [{
+        'price_data': {
+            'currency': 'usd',
+            'product_data': {'name': line.product.name},
+            'unit_amount': int(line.price * 100),
+        },
+        'quantity': line.quantity,
+    } for line in resolved]
+
+
+def _checkout_session_params(request, user, data, cart, reservation, line_items):
+    return {
+        'idempotency_key': reservation,
+        'payment_method_types': ['card'],
+        'line_items': line_items, 'mode': 'payment',
+        'success_url': request.build_absolute_uri(reverse('payment_success')),
+        'cancel_url': request.build_absolute_uri(reverse('payment_cancel')),
+        'customer_email': data.get('email'),
+        'metadata': {
+            'order_data': json.dumps(data),
+            'cart': json.dumps(cart),
+            'reservation': reservation,
+            'user_id': str(user.pk) if user.is_authenticated else '',
+        },
+        'expires_at': int(time.time()) + settings.STOCK_RESERVATION_TTL,
+    }
+
+
+def _release_previous_reservation(session):
+    release_reservation(session.pop('stock_reservation', None))
+
+
+def _remember_checkout(session, reservation, session_id):
+    session['stock_reservation'] = reservation
+    session['stripe_checkout_session_id'] = session_id
+
+
+def _forget_checkout(session):
+    for key in ('stripe_checkout_session_id', 'stock_reservation'):
+        session.pop(key, None)
 
 
 class AddToCartView(View):
@@ -32,26 +117,8 @@ class AddToCartView(View):
         quantity = int(request.POST.get('quantity', 1))
         size = request.POST.get('size')
         color = request.POST.get('color')
-        
-        cart = request.session.get('cart', {})
-        
-        item_key = f"{product.id}"
-        if size:
-            item_key += f"_{size}"
-        if color:
-            item_key += f"_{color}"
-
-        if item_key in cart:
-            cart[item_key]['quantity'] += quantity
-        else:
-            cart[item_key] = {
-                'product_id': product.id,
-                'quantity': quantity,
-                'size': size,
-                'color': color,
-            }
-
-        request.session['cart'] = cart
+
+        request.cart.add(_item_key(product, size, color), product.id, quantity, size, color)
         messages.success(request, f"Added {product.name} to your cart.")
         
         return redirect('cart')
@@ -61,78 +128,23 @@ class CartView(View):
     template_name = 'orders/cart.html'
     
     def get(self, request):
-        cart = request.session.get('cart', {})
-        cart_items = []
-        total = Decimal('0.00')
-        keys_to_delete = []
-        cart_needs_update = False
-
-        updated_cart = {}
-        for item_key, item_data in cart.items():
-            if not isinstance(item_data, dict):
-                cart_needs_update = True
-                try:
-                    product_id = int(item_key)
-                    quantity = int(item_data)
-                    new_key = str(product_id)
-                    updated_cart[new_key] = {
-                        'product_id': product_id,
-                        'quantity': quantity,
-                        'size': None,
-                        'color': None,
-                    }
-                except (ValueError, TypeError):
-                    keys_to_delete.append(item_key)
-            else:
-                updated_cart[item_key] = item_data
-        
-        if cart_needs_update:
-            cart = updated_cart
-            request.session['cart'] = cart
+        resolved = resolve_cart(request.cart.lines(), request.user)
 
-        for item_key, item_data in cart.items():
-            try:
-                product_id = item_data['product_id']
-                product = Product.objects.get(id=product_id)
-                price = product.get_price(request.user)
-                quantity = item_data['quantity']
-                item_total = price * quantity
-                
-                cart_items.append({
-                    'item_key': item_key,
-                    'product': product,
-                    'quantity': quantity,
-                    'price': price,
-                    'total': item_total,
-                    'size': item_data.get('size'),
-                    'color': item_data.get('color'),
-                })
-                total += item_total
-            except (Product.DoesNotExist, KeyError, TypeError) as e:
-                logger.warning(f"Removing invalid item {item_key} from cart. Reason: {e}")
-                keys_to_delete.append(item_key)
-
-        if keys_to_delete:
-            for key in keys_to_delete:
-                if key in cart:
-                    del cart[key]
-            request.session['cart'] = cart
+        if resolved.invalid_keys:
+            logger.warning(f"Removing invalid items {resolved.invalid_keys} from cart.")
+            request.cart.remove(*resolved.invalid_keys)
         
         context = {
-            'cart_items': cart_items,
-            'total': total,
-            'user_type': 'guest' if not request.user.is_authenticated else request.user.user_type
+            'cart_items': resolved.lines,
+            'total': resolved.total,
+            'user_type': _user_type(request.user),
         }
         return render(request, self.template_name, context)
 
 
 class RemoveFromCartView(View):
     def post(self, request, item_key):
-        cart = request.session.get('cart', {})
-        
-        if item_key in cart:
-            del cart[item_key]
-            request.session['cart'] = cart
+        if request.cart.remove(item_key):
             messages.success(request, "Item removed from your cart.")
         
         return redirect('cart')
@@ -140,16 +152,12 @@ class RemoveFromCartView(View):
 
 class UpdateCartView(View):
     def post(self, request, item_key):
-        cart = request.session.get('cart', {})
         quantity = int(request.POST.get('quantity', 1))
         
-        if item_key in cart and quantity > 0:
-            cart[item_key]['quantity'] = quantity
-            request.session['cart'] = cart
-            messages.success(request, "Cart updated.")
-        elif item_key in cart and quantity <= 0:
-            del cart[item_key]
-            request.session['cart'] = cart
+        if quantity > 0:
+            if request.cart.set_quantity(item_key, quantity):
+                messages.success(request, "Cart updated.")
+        elif request.cart.remove(item_key):
             messages.success(request, "Item removed from your cart.")
             
         return redirect('cart')
@@ -159,91 +167,55 @@ class CheckoutView(View):
     template_name = 'orders/checkout.html'
     
     def get(self, request):
-        cart = request.session.get('cart', {})
+        cart = request.cart.lines()
         if not cart:
             messages.warning(request, "Your cart is empty.")
             return redirect('product_list')
 
-        cart_items = []
-        total = Decimal('0.00')
-        for item_key, item_data in cart.items():
-            try:
-                product = Product.objects.get(id=item_data['product_id'])
-                price = product.get_price(request.user)
-                cart_items.append({
-                    'product': product,
-                    'quantity': item_data['quantity'],
-                    'price': price,
-                    'total': price * item_data['quantity'],
-                    'size': item_data.get('size'),
-                    'color': item_data.get('color'),
-                })
-                total += price * item_data['quantity']
-            except (Product.DoesNotExist, KeyError, TypeError):
-                continue
-
-        initial_data = {'email': request.user.email} if request.user.is_authenticated else {}
+        resolved = resolve_cart(cart, request.user)
+
+        shipping_address = None
         if request.user.is_authenticated:
             shipping_address = ShippingAddress.objects.filter(user=request.user, default=True).first()
-            if shipping_address:
-                initial_data.update({
-                    'full_name': shipping_address.full_name, 'address': shipping_address.address,
-                    'city': shipping_address.city, 'state': shipping_address.state,
-                    'postal_code': shipping_address.postal_code, 'country': shipping_address.country,
-                    'phone': shipping_address.phone
-                })
         
-        form = OrderCreateForm(initial=initial_data)
+        form = OrderCreateForm(initial=_checkout_initial(request.user, shipping_address))
         context = {
-            'form': form, 'cart_items': cart_items, 'total': total,
+            'form': form, 'cart_items': resolved.lines, 'total': resolved.total,
             'stripe_public_key': settings.STRIPE_PUBLIC_KEY,
             'shipping_addresses': ShippingAddress.objects.filter(user=request.user) if request.user.is_authenticated else None,
-            'user_type': 'guest' if not request.user.is_authenticated else request.user.user_type
+            'user_type': _user_type(request.user),
         }
         return render(request, self.template_name, context)
 
     def post(self, request):
         try:
             data = json.loads(request.body)
-            cart = request.session.get('cart', {})
+            cart = request.cart.lines()
             if not cart:
                 return JsonResponse({'error': 'Cart is empty'}, status=400)
 
-            line_items = []
-            for item_key, item_data in cart.items():
-                try:
-                    product = Product.objects.get(id=item_data['product_id'])
-                    price = product.get_price(request.user)
-                    product_name = product.name
-
-                    line_items.append({
-                        'price_data': {
-                            'currency': 'usd',
-                            'product_data': {'name': product_name},
-                            'unit_amount': int(price * 100),
-                        },
-                        'quantity': item_data['quantity'],
-                    })
-                except (Product.DoesNotExist, KeyError, TypeError):
-                    continue
+            resolved = resolve_cart(cart, request.user)
+            line_items = _line_items(resolved)
             
             if not line_items:
                 return JsonResponse({'error': 'No valid items in cart to process.'}, status=400)
+
+            # A new checkout replaces whatever the previous attempt was holding.
+            _release_previous_reservation(request.session)
+            try:
+                reservation = reserve_stock(resolved.lines)
+            except InsufficientStock as e:
+                return JsonResponse({'error': str(e)}, status=409)
             
-            metadata = {
-                'order_data': json.dumps(data),
-                'cart': json.dumps(cart)
-            }
-            
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=line_items, mode='payment',
-                success_url=request.build_absolute_uri(reverse('payment_success')),
-                cancel_url=request.build_absolute_uri(reverse('payment_cancel')),
-                customer_email=data.get('email'), metadata=metadata
-            )
+            try:
+                checkout_session = get_gateway().create_checkout_session(
+                    **_checkout_session_params(request, request.user, data, cart, reservation, line_items)
+                )
+            except Exception:
+                release_reservation(reservation)
+                raise
             
-            request.session['stripe_checkout_session_id'] = checkout_session.id
+            _remember_checkout(request.session, reservation, checkout_session.id)
 
             return JsonResponse({'session_id': checkout_session.id})
 
@@ -253,70 +225,41 @@ class CheckoutView(View):
 
 
 class PaymentSuccessView(View):
+    """
+    Orders are created by the Stripe webhook; this page only reads the
+    finished order, showing a holding page until the webhook has run.
+    """
     template_name = 'orders/payment_success.html'
+    processing_template_name = 'orders/payment_processing.html'
 
-    @transaction.atomic
     def get(self, request):
-        session_id = request.session.pop('stripe_checkout_session_id', None)
+        session_id = request.session.get('stripe_checkout_session_id')
         
         if not session_id:
             messages.error(request, "Could not find payment session. If payment was made, please check your orders.")
             return redirect('order_list')
-        
-        try:
-            session = stripe.checkout.Session.retrieve(session_id)
-            order_data = json.loads(session.metadata.get('order_data', '{}'))
-            cart_data = json.loads(session.metadata.get('cart', '{}'))
-
-            if Order.objects.filter(stripe_session_id=session.id).exists():
-                messages.info(request, "This order has already been processed.")
-                order = Order.objects.get(stripe_session_id=session.id)
-                return render(request, self.template_name, {'order': order})
-
-            order = Order.objects.create(
-                user=request.user if request.user.is_authenticated else None,
-                email=order_data['email'], full_name=order_data['full_name'],
-                address=order_data['address'], city=order_data.get('city', ''),
-                state=order_data.get('state', ''), postal_code=order_data.get('postal_code', ''),
-                country=order_data.get('country', ''), phone=order_data.get('phone', ''),
-                status='processing', total_amount=Decimal(session.amount_total) / 100,
-                stripe_payment_id=session.payment_intent, stripe_session_id=session.id,
-            )
 
-            for item_key, item_data in cart_data.items():
-                try:
-                    product = Product.objects.get(id=item_data['product_id'])
-                    OrderItem.objects.create(
-                        order=order, product=product,
-                        price=product.get_price(request.user),
-                        quantity=item_data['quantity'],
-                        size=item_data.get('size'),
-                        color=item_data.get('color'),
-                    )
-                    product.stock -= item_data['quantity']
-                    product.save()
-                except Product.DoesNotExist:
-                    logger.warning(f"Product with id {item_data['product_id']} not found during order creation.")
-                    continue
-            
-            if 'cart' in request.session:
-                del request.session['cart']
+        order = Order.objects.filter(stripe_session_id=session_id).first()
+        if order is None:
+            return render(request, self.processing_template_name)
 
-            messages.success(request, "Your payment was successful and your order has been placed!")
-            return render(request, self.template_name, {'order': order})
+        _forget_checkout(request.session)
+        request.cart.clear()
 
-        except stripe.error.StripeError as e:
-            messages.error(request, "Payment verification failed. Please contact support.")
-            logger.error(f"Stripe Error on success page: {str(e)}")
-            return redirect('checkout')
-        except Exception as e:
-            messages.error(request, "An unexpected error occurred while creating your order.")
-            logger.error(f"Error in PaymentSuccessView: {str(e)}")
-            return redirect('checkout')
+        messages.success(request, "Your payment was successful and your order has been placed!")
+        return render(request, self.template_name, {'order': order})
+
+
+class PaymentStatusView(View):
+    def get(self, request):
+        session_id = request.session.get('stripe_checkout_session_id')
+        ready = bool(session_id) and Order.objects.filter(stripe_session_id=session_id).exists()
+        return JsonResponse({'ready': ready})
 
 
 class PaymentCancelView(View):
     def get(self, request):
+        release_reservation(request.session.pop('stock_reservation', None))
         messages.warning(request, "Your payment was cancelled.")
         return redirect('checkout')
 
@@ -325,7 +268,7 @@ class PaymentCancelView(View):
 class StripeWebhookView(View):
     def post(self, request):
         payload = request.body
-        sig_header = request.META['HTTP_STRIPE_SIGNATURE']
+        sig_header = request.META.get('HTTP_STRIPE_SIGNATURE', '')
         event = None
         try:
             event = stripe.Webhook.construct_event(
@@ -336,16 +279,84 @@ class StripeWebhookView(View):
         except stripe.error.SignatureVerificationError as e:
             return HttpResponse(status=400)
         
-        if event['type'] == 'checkout.session.completed':
-            self.handle_checkout_session(event['data']['object'])
-            
+        # Handled asynchronously by the process_webhook_events command.
+        enqueue(event)
         return HttpResponse(status=200)
-    
-    def handle_checkout_session(self, session):
-        pass
 
 
-class OrderListView(LoginRequiredMixin, ListView):
+@method_decorator(staff_member_required, name='dispatch')
+class OrderExportView(View):
+    """
+    Streams orders and their items as CSV or JSON Lines for accounting,
+    filtered by ``created_from``/``created_to`` (inclusive dates),
+    ``status`` and ``user_type`` (both repeatable).
+    """
+
+    def get(self, request):
+        return _export_response(request, export.encode)
+
+
+def _export_response(request, encode):
+    form = OrderExportForm(request.GET)
+    if not form.is_valid():
+        return JsonResponse({'errors': form.errors}, status=400)
+    format = form.cleaned_data['format'] or 'csv'
+    response = StreamingHttpResponse(
+        encode(export.export_rows(**form.filters()), format),
+        content_type=export.FORMATS[format],
+    )
+    response['Content-Disposition'] = (
+        f'attachment; filename="orders-{timezone.localtime():%Y%m%d-%H%M%S}.{format}"'
+    )
+    return response
+
+
+@method_decorator(staff_member_required, name='dispatch')
+class SalesDashboardView(View):
+    """
+    Revenue by day, category, customer type, status and product, read from
+    the sales rollups only (``orders.rollups``). Defaults to the last
+    ``SALES_DASHBOARD_DAYS`` days and the statuses that count as sales.
+    Orders the rollups haven't counted (see ``backfill_sales_rollups``)
+    are missing from it.
+    """
+    template_name = 'orders/sales_dashboard.html'
+
+    def get(self, request):
+        form = SalesDashboardForm(request.GET)
+        if not form.is_valid():
+            return render(request, self.template_name, {'form': form}, status=400)
+        data = form.cleaned_data
+        day_to = data['day_to'] or timezone.localdate()
+        day_from = data['day_from'] or day_to - datetime.timedelta(days=settings.SALES_DASHBOARD_DAYS - 1)
+        statuses = data['status'] or rollups.SALES_STATUSES
+        report = rollups.report(day_from, day_to, statuses=statuses, user_types=data['user_type'])
+        categories = dict(Category.objects.filter(
+            pk__in=[row['category_id'] for row in report['categories']]).values_list('pk', 'name'))
+        products = dict(Product.objects.filter(
+            pk__in=[row['product_id'] for row in report['products']]).values_list('pk', 'name'))
+        for row in report['categories']:
+            row['name'] = categories.get(row['category_id'], 'No category' if row['category_id'] is None
+                                         else f'Category {row["category_id"]}')
+        for row in report['products']:
+            row['name'] = products.get(row['product_id'], f'Product {row["product_id"]}')
+        for row in report['user_types']:
+            row['name'] = row['user_type']
+        for row in report['statuses']:
+            row['name'] = row['status']
+        user_types = [value for value, _ in form.fields['user_type'].choices
+                      if not data['user_type'] or value in data['user_type']]
+        for day in report['days']:
+            day['columns'] = [day['by_user_type'].get(user_type, 0) for user_type in user_types]
+        return render(request, self.template_name, {
+            'form': form, 'report': report, 'day_from': day_from, 'day_to': day_to,
+            'statuses': statuses, 'user_types': user_types,
+            'sections': [('By category', report['categories']), ('By customer type', report['user_types']),
+                         ('By status', report['statuses']), ('Top products', report['products'])],
+        })
+
+
+class OrderListView(LoginRequiredMixin, KeysetPaginationMixin, ListView):
     model = Order
     template_name = 'orders/order_list.html'
     context_object_name = 'orders'
@@ -355,7 +366,7 @@ class OrderListView(LoginRequiredMixin, ListView):
         return Order.objects.filter(user=self.request.user).order_by('-created_at')
 
 
-class OrderDetailView(LoginRequiredMixin, DetailView):
+class OrderDetailView(LoginRequiredMixin, ConditionalGetMixin, DetailView):
     model = Order
     template_name = 'orders/order_detail.html'
     context_object_name = 'order'
@@ -363,7 +374,170 @@ class OrderDetailView(LoginRequiredMixin, DetailView):
     def get_queryset(self):
         return Order.objects.filter(user=self.request.user)
 
+    def get_validators(self):
+        updated_at = self.get_queryset().filter(pk=self.kwargs['pk']).values_list('updated_at', flat=True).first()
+        if updated_at is None:
+            return None
+        # Items show their product's current name and image.
+        generation, changed_at = get_catalog_version()
+        return [updated_at.isoformat(), generation], max(updated_at.timestamp(), changed_at or 0)
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['items'] = self.object.items.all()
         return context
+
+
+# Async variants of the cart, checkout and export views, routed instead of
+# the ones above when ASYNC_VIEWS is on (see marketplace.asgi). Under ASGI
+# they wait on Stripe without holding a worker thread; sessions, stock
+# reservations and template rendering are still synchronous and run in a
+# thread.
+
+class AsyncAddToCartView(View):
+    async def post(self, request, product_id):
+        product = await aget_object_or_404(Product, id=product_id, available=True)
+        quantity = int(request.POST.get('quantity', 1))
+        size = request.POST.get('size')
+        color = request.POST.get('color')
+
+        await request.cart.aadd(_item_key(product, size, color), product.id, quantity, size, color)
+        messages.success(request, f"Added {product.name} to your cart.")
+
+        return redirect('cart')
+
+
+class AsyncCartView(View):
+    template_name = 'orders/cart.html'
+
+    async def get(self, request):
+        user = await request.auser()
+        resolved = await aresolve_cart(await request.cart.alines(), user)
+
+        if resolved.invalid_keys:
+            logger.warning(f"Removing invalid items {resolved.invalid_keys} from cart.")
+            await request.cart.aremove(*resolved.invalid_keys)
+
+        context = {
+            'cart_items': resolved.lines,
+            'total': resolved.total,
+            'user_type': _user_type(user),
+        }
+        return await arender(request, self.template_name, context)
+
+
+class AsyncRemoveFromCartView(View):
+    async def post(self, request, item_key):
+        if await request.cart.aremove(item_key):
+            messages.success(request, "Item removed from your cart.")
+
+        return redirect('cart')
+
+
+class AsyncUpdateCartView(View):
+    async def post(self, request, item_key):
+        quantity = int(request.POST.get('quantity', 1))
+
+        if quantity > 0:
+            if await request.cart.aset_quantity(item_key, quantity):
+                messages.success(request, "Cart updated.")
+        elif await request.cart.aremove(item_key):
+            messages.success(request, "Item removed from your cart.")
+
+        return redirect('cart')
+
+
+class AsyncCheckoutView(View):
+    template_name = 'orders/checkout.html'
+
+    async def get(self, request):
+        cart = await request.cart.alines()
+        if not cart:
+            messages.warning(request, "Your cart is empty.")
+            return redirect('product_list')
+
+        user = await request.auser()
+        resolved = await aresolve_cart(cart, user)
+
+        shipping_address = None
+        if user.is_authenticated:
+            shipping_address = await ShippingAddress.objects.filter(user=user, default=True).afirst()
+
+        form = OrderCreateForm(initial=_checkout_initial(user, shipping_address))
+        context = {
+            'form': form, 'cart_items': resolved.lines, 'total': resolved.total,
+            'stripe_public_key': settings.STRIPE_PUBLIC_KEY,
+            'shipping_addresses': ShippingAddress.objects.filter(user=user) if user.is_authenticated else None,
+            'user_type': _user_type(user),
+        }
+        return await arender(request, self.template_name, context)
+
+    async def post(self, request):
+        try:
+            data = json.loads(request.body)
+            cart = await request.cart.alines()
+            if not cart:
+                return JsonResponse({'error': 'Cart is empty'}, status=400)
+
+            user = await request.auser()
+            resolved = await aresolve_cart(cart, user)
+            line_items = _line_items(resolved)
+
+            if not line_items:
+                return JsonResponse({'error': 'No valid items in cart to process.'}, status=400)
+
+            # A new checkout replaces whatever the previous attempt was holding.
+            await sync_to_async(_release_previous_reservation)(request.session)
+            try:
+                reservation = await sync_to_async(reserve_stock)(resolved.lines)
+            except InsufficientStock as e:
+                return JsonResponse({'error': str(e)}, status=409)
+
+            try:
+                checkout_session = await get_gateway().acreate_checkout_session(
+                    **_checkout_session_params(request, user, data, cart, reservation, line_items)
+                )
+            except Exception:
+                await sync_to_async(release_reservation)(reservation)
+                raise
+
+            await sync_to_async(_remember_checkout)(request.session, reservation, checkout_session.id)
+
+            return JsonResponse({'session_id': checkout_session.id})
+
+        except Exception as e:
+            logger.error(f"Error creating Stripe session: {str(e)}")
+            return JsonResponse({'error': str(e)}, status=500)
+
+
+class AsyncPaymentSuccessView(View):
+    template_name = PaymentSuccessView.template_name
+    processing_template_name = PaymentSuccessView.processing_template_name
+
+    async def get(self, request):
+        session_id = await sync_to_async(request.session.get)('stripe_checkout_session_id')
+
+        if not session_id:
+            messages.error(request, "Could not find payment session. If payment was made, please check your orders.")
+            return redirect('order_list')
+
+        order = await Order.objects.filter(stripe_session_id=session_id).afirst()
+        if order is None:
+            return await arender(request, self.processing_template_name)
+
+        await sync_to_async(_forget_checkout)(request.session)
+        await request.cart.aclear()
+
+        messages.success(request, "Your payment was successful and your order has been placed!")
+        return await arender(request, self.template_name, {'order': order})
+
+
+class AsyncOrderExportView(View):
+    """``OrderExportView`` for ASGI, streaming one chunk at a time (see ``export.aencode``)."""
+
+    async def get(self, request):
+        # staff_member_required only runs synchronous checks.
+        user = await request.auser()
+        if not (user.is_active and user.is_staff):
+            return redirect_to_login(request.get_full_path(), reverse('admin:login'))
+        return _export_response(request, export.aencode)
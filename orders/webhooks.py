@@ -0,0 +1,129 @@
+"""
+Durable processing of Stripe webhook events.
+
+``StripeWebhookView`` only verifies the signature and stores the event as a
+``WebhookEvent``; the ``process_webhook_events`` command drains the table
+and calls the handler registered for each event type.
+"""
+import uuid
+from datetime import timedelta
+
+import stripe
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, F, PositiveIntegerField, Q, When
+from django.utils import timezone
+
+from .fulfillment import fulfill_checkout_session
+from .inventory import release_reservation
+from .models import WebhookEvent
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+_handlers = {}
+
+
+def register(*event_types):
+    """Register a handler for one or more Stripe event types."""
+    def decorator(func):
+        for event_type in event_types:
+            _handlers[event_type] = func
+        return func
+    return decorator
+
+
+def enqueue(event):
+    """Store a verified Stripe event; redeliveries of the same event are ignored."""
+    _, created = WebhookEvent.objects.get_or_create(
+        stripe_event_id=event['id'],
+        defaults={'type': event['type'], 'payload': event.to_dict_recursive()},
+    )
+    return created
+
+
+def claim_batch(batch_size, stale_after):
+    """
+    Claim up to ``batch_size`` due events for this worker. On PostgreSQL the
+    candidates are picked with ``FOR UPDATE SKIP LOCKED``; elsewhere the
+    conditional ``UPDATE`` on ``status`` alone keeps two workers from
+    claiming the same row. Reclaiming an event from a worker that died
+    counts as an attempt, so an event that keeps killing its worker fails
+    after ``WEBHOOK_MAX_ATTEMPTS`` like one whose handler raises.
+    """
+    now = timezone.now()
+    due = WebhookEvent.objects.filter(
+        Q(status='pending', next_attempt_at__lte=now)
+        | Q(status='processing', claimed_at__lte=now - timedelta(seconds=stale_after))
+    )
+    claim = uuid.uuid4().hex
+    with transaction.atomic():
+        candidates = due.order_by('next_attempt_at')
+        if connection.features.has_select_for_update_skip_locked:
+            candidates = candidates.select_for_update(skip_locked=True)
+        ids = list(candidates.values_list('id', flat=True)[:batch_size])
+        due.filter(id__in=ids).update(
+            status='processing', claim=claim, claimed_at=now,
+            attempts=Case(When(status='processing', then=F('attempts') + 1), default=F('attempts'),
+                          output_field=PositiveIntegerField()),
+        )
+        claimed = WebhookEvent.objects.filter(claim=claim)
+        abandoned = claimed.filter(attempts__gte=settings.WEBHOOK_MAX_ATTEMPTS)
+        for stripe_event_id in abandoned.values_list('stripe_event_id', flat=True):
+            logger.error(f"Giving up on Stripe event {stripe_event_id}: its worker stopped before finishing it.")
+        abandoned.update(status='failed', last_error='Worker stopped while processing the event.')
+    return list(claimed.filter(status='processing').order_by('next_attempt_at'))
+
+
+def backoff(attempts):
+    return min(settings.WEBHOOK_RETRY_BACKOFF * 2 ** (attempts - 1), settings.WEBHOOK_RETRY_BACKOFF_MAX)
+
+
+def _record(event, **fields):
+    """
+    Save the outcome of processing ``event``, unless another worker has
+    reclaimed it since (its claim changed), in which case that worker owns it.
+    """
+    for name, value in fields.items():
+        setattr(event, name, value)
+    if not WebhookEvent.objects.filter(pk=event.pk, claim=event.claim).update(**fields):
+        logger.warning(f"Stripe event {event.stripe_event_id} was reclaimed by another worker; not recording.")
+
+
+def process(event):
+    """Run the handler for a claimed event and record the outcome."""
+    handler = _handlers.get(event.type)
+    now = timezone.now()
+    try:
+        if handler is not None:
+            handler(stripe.Event.construct_from(event.payload, stripe.api_key).data.object)
+    except Exception as e:
+        attempts = event.attempts + 1
+        if attempts >= settings.WEBHOOK_MAX_ATTEMPTS:
+            _record(event, attempts=attempts, last_error=str(e), status='failed')
+            logger.error(f"Giving up on Stripe event {event.stripe_event_id} after {attempts} attempts: {e}")
+        else:
+            _record(event, attempts=attempts, last_error=str(e), status='pending',
+                    next_attempt_at=now + timedelta(seconds=backoff(attempts)))
+            logger.warning(f"Stripe event {event.stripe_event_id} failed, retrying: {e}")
+        return False
+
+    _record(event, status='done', processed_at=now)
+    return True
+
+
+@register('checkout.session.completed', 'checkout.session.async_payment_succeeded')
+def handle_checkout_session(session):
+    # Delayed payment methods complete the session unpaid and follow up
+    # with checkout.session.async_payment_succeeded.
+    if session.payment_status == 'unpaid':
+        return
+    order, created = fulfill_checkout_session(session)
+    if not created:
+        logger.info(f"Checkout session {session.id} already fulfilled as order {order.id}.")
+
+
+@register('checkout.session.expired')
+def handle_expired_session(session):
+    release_reservation(session.metadata.get('reservation'))
@@ -1,28 +1,20 @@
 from django.shortcuts import render
 from django.views.generic import TemplateView, ListView
+from products.cache import CatalogCacheMixin
 from products.models import Product, Category
 
-class HomeView(ListView):
+class HomeView(CatalogCacheMixin, ListView):
     model = Product
     template_name = 'pages/home.html'
     context_object_name = 'products'
     
     def get_queryset(self):
-        return Product.objects.filter(available=True)[:8]
+        return Product.objects.filter(available=True).for_listing().with_price_for(self.request.user)[:8]
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['categories'] = Category.objects.all()[:6]
         
-        # Process pricing based on user authentication status
-        products_with_prices = []
-        for product in context['products']:
-            products_with_prices.append({
-                'product': product,
-                'price': product.get_price(self.request.user)
-            })
-        context['products_with_prices'] = products_with_prices
-        
         # Add user type info for price display explanation
         user = self.request.user
         if user.is_authenticated:
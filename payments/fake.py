@@ -0,0 +1,78 @@
+"""
+In-process stand-in for the Stripe Checkout API, for offline load tests.
+
+Sessions are kept in memory and returned as real ``stripe`` objects, so the
+views handle them exactly like API responses. ``latency`` (seconds) is slept
+on every call to simulate the network round trip; the async methods await
+it instead, like a non-blocking HTTP call.
+"""
+import asyncio
+import threading
+import time
+import uuid
+
+import stripe
+
+
+class FakeStripeBackend:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.sessions = {}
+        self.idempotent = {}
+        self.lock = threading.Lock()
+
+    def create_checkout_session(self, idempotency_key=None, **params):
+        time.sleep(self.latency)
+        return self._create(idempotency_key, params)
+
+    async def acreate_checkout_session(self, idempotency_key=None, **params):
+        await asyncio.sleep(self.latency)
+        return self._create(idempotency_key, params)
+
+    def _create(self, idempotency_key, params):
+        with self.lock:
+            if idempotency_key and idempotency_key in self.idempotent:
+                return self.sessions[self.idempotent[idempotency_key]]
+            session_id = f'cs_test_{uuid.uuid4().hex}'
+            amount_total = sum(
+                item['price_data']['unit_amount'] * item['quantity'] for item in params.get('line_items', [])
+            )
+            session = stripe.checkout.Session.construct_from({
+                'id': session_id,
+                'object': 'checkout.session',
+                'url': f'https://checkout.stripe.test/pay/{session_id}',
+                'status': 'open',
+                'payment_status': 'unpaid',
+                'amount_total': amount_total,
+                'payment_intent': f'pi_test_{uuid.uuid4().hex}',
+                'customer_email': params.get('customer_email'),
+                'expires_at': params.get('expires_at'),
+                'metadata': params.get('metadata', {}),
+            }, None)
+            self.sessions[session_id] = session
+            if idempotency_key:
+                self.idempotent[idempotency_key] = session_id
+            return session
+
+    def retrieve_checkout_session(self, session_id):
+        time.sleep(self.latency)
+        return self._retrieve(session_id)
+
+    async def aretrieve_checkout_session(self, session_id):
+        await asyncio.sleep(self.latency)
+        return self._retrieve(session_id)
+
+    def _retrieve(self, session_id):
+        with self.lock:
+            try:
+                return self.sessions[session_id]
+            except KeyError:
+                raise stripe.error.InvalidRequestError(f'No such checkout.session: {session_id}', 'id')
+
+    def complete(self, session_id):
+        """Mark a session paid, as Stripe does when the customer pays."""
+        with self.lock:
+            session = self.sessions[session_id]
+            session['status'] = 'complete'
+            session['payment_status'] = 'paid'
+            return session
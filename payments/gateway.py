@@ -0,0 +1,276 @@
+"""
+Payment gateway used by the checkout views instead of the module-level
+``stripe`` SDK.
+
+The gateway delegates to a backend (the real Stripe API or an in-process
+fake, chosen by ``PAYMENTS_BACKEND``) and records per-operation latency
+histograms. The Stripe backend keeps a pooled keep-alive HTTP session,
+gives every call a timeout and retries network failures a bounded number of
+times under an idempotency key.
+
+Every operation also has an ``a``-prefixed coroutine for the async views.
+The Stripe backend serves those with an ``httpx.AsyncClient`` speaking the
+Stripe REST API directly (the ``stripe`` SDK has no async support), so a
+checkout waiting on Stripe holds no thread.
+"""
+import asyncio
+import bisect
+import threading
+import time
+import uuid
+import weakref
+from urllib.parse import urlencode
+
+import httpx
+import requests
+import stripe
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+class LatencyHistogram:
+    """Cumulative latency histogram with fixed bucket bounds in seconds."""
+    BOUNDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.errors = 0
+        self.total = 0.0
+
+    def observe(self, seconds, error=False):
+        with self.lock:
+            self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+            self.total += seconds
+            self.errors += error
+
+    def percentile(self, p):
+        """Upper bucket bound containing the ``p``-th percentile (``None`` when empty)."""
+        with self.lock:
+            count = sum(self.counts)
+            if not count:
+                return None
+            threshold, seen = count * p / 100, 0
+            for bound, bucket in zip(self.BOUNDS + (float('inf'),), self.counts):
+                seen += bucket
+                if seen >= threshold:
+                    return bound
+
+    def snapshot(self):
+        with self.lock:
+            count = sum(self.counts)
+            return {
+                'count': count,
+                'errors': self.errors,
+                'mean': self.total / count if count else None,
+                'buckets': dict(zip([str(b) for b in self.BOUNDS] + ['+Inf'], self.counts)),
+            }
+
+
+def _form_encode(params, prefix=None):
+    """Flatten nested params into Stripe's ``a[b][0][c]=v`` form encoding."""
+    pairs = []
+    items = params.items() if isinstance(params, dict) else enumerate(params)
+    for key, value in items:
+        name = f'{prefix}[{key}]' if prefix else str(key)
+        if value is None:
+            continue
+        if isinstance(value, (dict, list, tuple)):
+            pairs.extend(_form_encode(value, name))
+        elif isinstance(value, bool):
+            pairs.append((name, 'true' if value else 'false'))
+        else:
+            pairs.append((name, str(value)))
+    return pairs
+
+
+def _error_from_response(response):
+    try:
+        body = response.json()
+        error = body.get('error', {})
+    except ValueError:
+        body, error = None, {}
+    message = error.get('message') or f'Stripe returned HTTP {response.status_code}'
+    details = {'http_body': response.text, 'http_status': response.status_code,
+               'json_body': body, 'headers': dict(response.headers)}
+    if response.status_code == 401:
+        return stripe.error.AuthenticationError(message, code=error.get('code'), **details)
+    if response.status_code == 429:
+        return stripe.error.RateLimitError(message, code=error.get('code'), **details)
+    if response.status_code in (400, 404):
+        return stripe.error.InvalidRequestError(message, error.get('param'), code=error.get('code'), **details)
+    return stripe.error.APIError(message, code=error.get('code'), **details)
+
+
+class StripeBackend:
+    RETRY_STATUSES = (409, 429, 500, 502, 503, 504)
+
+    def __init__(self, api_key, timeout=10, retrieve_timeout=5, max_retries=2, pool_size=10,
+                 api_base='https://api.stripe.com'):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        # Same connection pool, separate timeout budgets.
+        self.client = stripe.StripeClient(
+            api_key, max_network_retries=max_retries, base_addresses={'api': api_base},
+            http_client=stripe.RequestsClient(timeout=timeout, session=session),
+        )
+        self.retrieve_client = stripe.StripeClient(
+            api_key, max_network_retries=max_retries, base_addresses={'api': api_base},
+            http_client=stripe.RequestsClient(timeout=retrieve_timeout, session=session),
+        )
+        self.api_key = api_key
+        self.api_base = api_base
+        self.timeout = timeout
+        self.retrieve_timeout = retrieve_timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._async_clients = weakref.WeakKeyDictionary()
+
+    def create_checkout_session(self, idempotency_key=None, **params):
+        options = {'idempotency_key': idempotency_key} if idempotency_key else {}
+        return self.client.checkout.sessions.create(params=params, options=options)
+
+    def retrieve_checkout_session(self, session_id):
+        return self.retrieve_client.checkout.sessions.retrieve(session_id)
+
+    def _async_client(self):
+        # An AsyncClient's connections belong to the event loop that opened them.
+        loop = asyncio.get_running_loop()
+        client = self._async_clients.get(loop)
+        if client is None:
+            client = self._async_clients[loop] = httpx.AsyncClient(
+                base_url=self.api_base,
+                headers={'Authorization': f'Bearer {self.api_key}', 'Stripe-Version': stripe.api_version},
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=self.pool_size),
+            )
+        return client
+
+    async def _arequest(self, method, path, timeout, params=None, idempotency_key=None):
+        headers, content = {}, None
+        if method == 'POST':
+            # As the SDK does, so retried creates can't be applied twice.
+            headers['Idempotency-Key'] = idempotency_key or str(uuid.uuid4())
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+            content = urlencode(_form_encode(params or {}))
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._async_client().request(
+                    method, path, content=content, headers=headers, timeout=timeout,
+                )
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise stripe.error.APIConnectionError(f'Could not reach Stripe: {e}') from e
+            else:
+                if response.is_success:
+                    return response.json()
+                retry = response.headers.get('Stripe-Should-Retry')
+                if attempt == self.max_retries or retry == 'false' or (
+                        retry != 'true' and response.status_code not in self.RETRY_STATUSES):
+                    raise _error_from_response(response)
+            await asyncio.sleep(min(0.5 * 2 ** attempt, 2.0))
+
+    async def acreate_checkout_session(self, idempotency_key=None, **params):
+        data = await self._arequest('POST', '/v1/checkout/sessions', self.timeout, params, idempotency_key)
+        return stripe.checkout.Session.construct_from(data, self.api_key)
+
+    async def aretrieve_checkout_session(self, session_id):
+        data = await self._arequest('GET', f'/v1/checkout/sessions/{session_id}', self.retrieve_timeout)
+        return stripe.checkout.Session.construct_from(data, self.api_key)
+
+
+class PaymentGateway:
+    def __init__(self, backend):
+        self.backend = backend
+        self.latency = {}
+        self.lock = threading.Lock()
+
+    def _histogram(self, operation):
+        with self.lock:
+            return self.latency.setdefault(operation, LatencyHistogram())
+
+    def _timed(self, operation, func, *args, **kwargs):
+        histogram = self._histogram(operation)
+        start = time.perf_counter()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            histogram.observe(time.perf_counter() - start, error=True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return result
+
+    async def _atimed(self, operation, func, *args, **kwargs):
+        histogram = self._histogram(operation)
+        start = time.perf_counter()
+        try:
+            result = await func(*args, **kwargs)
+        except Exception:
+            histogram.observe(time.perf_counter() - start, error=True)
+            raise
+        histogram.observe(time.perf_counter() - start)
+        return result
+
+    def _async(self, name):
+        """The backend's coroutine ``name``, or its sync method run in a thread."""
+        method = getattr(self.backend, f'a{name}', None)
+        return method or sync_to_async(getattr(self.backend, name), thread_sensitive=False)
+
+    def create_checkout_session(self, idempotency_key=None, **params):
+        return self._timed('checkout.session.create', self.backend.create_checkout_session,
+                           idempotency_key=idempotency_key, **params)
+
+    def retrieve_checkout_session(self, session_id):
+        return self._timed('checkout.session.retrieve', self.backend.retrieve_checkout_session, session_id)
+
+    async def acreate_checkout_session(self, idempotency_key=None, **params):
+        return await self._atimed('checkout.session.create', self._async('create_checkout_session'),
+                                  idempotency_key=idempotency_key, **params)
+
+    async def aretrieve_checkout_session(self, session_id):
+        return await self._atimed('checkout.session.retrieve', self._async('retrieve_checkout_session'),
+                                  session_id)
+
+    def stats(self):
+        with self.lock:
+            operations = dict(self.latency)
+        return {operation: histogram.snapshot() for operation, histogram in operations.items()}
+
+
+_gateway = None
+_gateway_lock = threading.Lock()
+
+
+def build_backend():
+    backend = settings.PAYMENTS_BACKEND
+    if backend == 'stripe':
+        return StripeBackend(
+            settings.STRIPE_SECRET_KEY,
+            timeout=settings.STRIPE_TIMEOUT,
+            retrieve_timeout=settings.STRIPE_RETRIEVE_TIMEOUT,
+            max_retries=settings.STRIPE_MAX_RETRIES,
+            pool_size=settings.STRIPE_POOL_SIZE,
+            api_base=settings.STRIPE_API_BASE,
+        )
+    if backend == 'fake':
+        from .fake import FakeStripeBackend
+        return FakeStripeBackend(latency=settings.PAYMENTS_FAKE_LATENCY)
+    return import_string(backend)()
+
+
+def get_gateway():
+    """Return the process-wide gateway, building it on first use."""
+    global _gateway
+    if _gateway is None:
+        with _gateway_lock:
+            if _gateway is None:
+                _gateway = PaymentGateway(build_backend())
+    return _gateway
+
+
+def set_gateway(gateway):
+    """Replace the process-wide gateway, e.g. with a fake for load tests."""
+    global _gateway
+    _gateway = gateway
@@ -1,4 +1,14 @@
-from django.contrib import admin
+import os
+
+from django import forms
+from django.conf import settings
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.template.defaultfilters import filesizeformat
+from django.template.response import TemplateResponse
+from django.urls import path
+
+from .imports import FORMATS, import_products
 from .models import Category, Product, Size, Color
 
 @admin.register(Category)
@@ -14,10 +24,61 @@ class SizeAdmin(admin.ModelAdmin):
 class ColorAdmin(admin.ModelAdmin):
     list_display = ['name']
 
+class ProductImportForm(forms.Form):
+    file = forms.FileField(help_text='CSV with a header row, or JSON Lines (.jsonl).')
+    dry_run = forms.BooleanField(required=False, initial=True,
+                                 help_text='Report what would change without saving anything.')
+
+    def clean_file(self):
+        upload = self.cleaned_data['file']
+        extension = os.path.splitext(upload.name)[1].lower().lstrip('.')
+        self.format = 'jsonl' if extension in ('jsonl', 'ndjson') else extension
+        if self.format not in FORMATS:
+            raise forms.ValidationError('Upload a .csv or .jsonl file.')
+        # The import runs in the request; larger files go through the command.
+        if upload.size > settings.PRODUCT_IMPORT_ADMIN_MAX_BYTES:
+            raise forms.ValidationError(
+                f'Files over {filesizeformat(settings.PRODUCT_IMPORT_ADMIN_MAX_BYTES)} are imported with '
+                f'manage.py import_products.'
+            )
+        return upload
+
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
     list_display = ['name', 'slug', 'price', 'stock', 'available', 'created_at']
     list_filter = ['available', 'created_at', 'updated_at', 'category']
     list_editable = ['price', 'stock', 'available']
     prepopulated_fields = {'slug': ('name',)}
-    filter_horizontal = ('sizes', 'colors',)
\ No newline at end of file
+    filter_horizontal = ('sizes', 'colors',)
+
+    def get_urls(self):
+        return [
+            path('import/', self.admin_site.admin_view(self.import_view), name='products_product_import'),
+            *super().get_urls(),
+        ]
+
+    def import_view(self, request):
+        """Bulk create and update products from an uploaded file; see products.imports."""
+        if not (self.has_add_permission(request) and self.has_change_permission(request)):
+            raise PermissionDenied
+        report = None
+        form = ProductImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            try:
+                # Sanitized in this process: a request shouldn't spawn a pool.
+                report = import_products(form.cleaned_data['file'], form.format,
+                                         dry_run=form.cleaned_data['dry_run'], workers=1)
+            except ValueError as e:
+                form.add_error('file', str(e))
+            else:
+                messages.success(request, report.summary())
+        return TemplateResponse(request, 'admin/products/product/import.html', {
+            **self.admin_site.each_context(request),
+            'opts': self.model._meta,
+            'title': 'Import products',
+            'form': form,
+            'max_size': settings.PRODUCT_IMPORT_ADMIN_MAX_BYTES,
+            'report': report,
+            'errors': report.errors[:100] if report else (),
+            'changes': report.changes[:100] if report else (),
+        })
@@ -0,0 +1,232 @@
+"""
+Response cache for the catalog pages (home, product list, product detail).
+
+Those pages only differ between visitors by pricing tier, so their title
+and content blocks are cached per (URL, sort, page or cursor, filters,
+tier) instead of per user. The surrounding layout (user menu, cart badge,
+flash messages) is still rendered for every request, and CSRF tokens are
+swapped in on the way out, so cached fragments never carry anyone's
+personal data.
+
+Entries are versioned by a catalog generation counter that is bumped after
+any committed change to products, categories, sizes or colors; old entries
+simply stop being read. After a bump, one request per page re-renders it
+while concurrent ones are served the previous version.
+
+Sales are not catalog edits: checkout only bumps the stock version of the
+products sold (``bump_stock_on_commit``), which is part of the version of
+the pages showing their stock (``stock_slug_kwarg``), so a sale re-renders
+those product pages and leaves every other cached page and ETag alone.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from marketplace.conditional import ConditionalGetMixin
+
+from .models import get_price_tier
+
+GENERATION_KEY = 'catalog:generation'
+CHANGED_AT_KEY = 'catalog:changed_at'
+STOCK_KEY = 'catalog:stock:{}'
+STATS_KEYS = ('hits', 'stale_hits', 'misses', 'saved_ms')
+CSRF_SENTINEL = 'CATALOGCACHECSRFTOKEN'
+
+
+def get_generation():
+    generation = cache.get(GENERATION_KEY)
+    if generation is None:
+        # Start from the clock so a lost counter never reuses an old version.
+        cache.add(GENERATION_KEY, time.time_ns(), None)
+        generation = cache.get(GENERATION_KEY)
+    return generation
+
+
+def bump_generation():
+    try:
+        cache.incr(GENERATION_KEY)
+    except ValueError:
+        cache.set(GENERATION_KEY, time.time_ns(), None)
+    cache.set(CHANGED_AT_KEY, time.time(), None)
+
+
+def get_catalog_version(slug=None):
+    """
+    ``(version, time of the last change or None)``, in one cache round trip.
+    The version is the catalog generation, plus the stock version of the
+    product ``slug`` when given.
+    """
+    stock_key = STOCK_KEY.format(slug) if slug else None
+    values = cache.get_many([GENERATION_KEY, CHANGED_AT_KEY, *filter(None, [stock_key])])
+    if GENERATION_KEY not in values:
+        generation, changed_at = get_generation(), None
+    else:
+        generation, changed_at = values[GENERATION_KEY], values.get(CHANGED_AT_KEY)
+    stock = values.get(stock_key)
+    if stock is None:
+        return generation, changed_at
+    return f'{generation}.{stock}', max(changed_at or 0, stock / 1e9)
+
+
+def bump_stock(slugs):
+    """Mark the stock shown on these products' pages as changed; the rest of the catalog is untouched."""
+    now = time.time_ns()
+    cache.set_many({STOCK_KEY.format(slug): now for slug in slugs}, None)
+
+
+def bump_stock_on_commit(slugs):
+    slugs = set(slugs)
+    if slugs:
+        transaction.on_commit(lambda: bump_stock(slugs))
+
+
+def bump_generation_on_commit():
+    """Bump once the current transaction commits, so no request can cache pre-commit data under the new version."""
+    transaction.on_commit(bump_generation)
+
+
+def _count(name, amount=1):
+    key = f'catalog:stats:{name}'
+    cache.add(key, 0, None)
+    try:
+        cache.incr(key, amount)
+    except ValueError:
+        pass
+
+
+def get_stats():
+    stats = {name: cache.get(f'catalog:stats:{name}', 0) for name in STATS_KEYS}
+    served = stats['hits'] + stats['stale_hits']
+    total = served + stats['misses']
+    stats['hit_rate'] = served / total if total else 0.0
+    return stats
+
+
+def reset_stats():
+    cache.delete_many([f'catalog:stats:{name}' for name in STATS_KEYS])
+
+
+class CatalogPage:
+    """The cache state of one catalog request, shared by the view and the template tag."""
+
+    def __init__(self, page_key, generation):
+        self.key = f'catalog:v{generation}:{page_key}'
+        self.stale_key = f'catalog:stale:{page_key}'
+        self.lock_key = f'catalog:lock:{page_key}'
+        self.fragments = None
+        self.rendered = {}
+        self.started = time.perf_counter()
+        self.leader = False
+
+    @property
+    def hit(self):
+        return self.fragments is not None
+
+    def fetch(self):
+        entry = cache.get(self.key)
+        if entry is None:
+            if cache.add(self.lock_key, True, settings.CATALOG_CACHE_LOCK_TIMEOUT):
+                self.leader = True
+                _count('misses')
+                return
+            entry = cache.get(self.stale_key)
+            if entry is not None:
+                _count('stale_hits')
+            else:
+                entry = self.wait()
+                if entry is None:
+                    _count('misses')
+                    return
+                _count('hits')
+        else:
+            _count('hits')
+        self.fragments = entry['fragments']
+        _count('saved_ms', int(entry['cost_ms']))
+
+    def wait(self):
+        """Give the request holding the lock a moment to fill the entry."""
+        deadline = time.monotonic() + settings.CATALOG_CACHE_LOCK_WAIT
+        while time.monotonic() < deadline:
+            time.sleep(0.05)
+            entry = cache.get(self.key)
+            if entry is not None:
+                return entry
+        return None
+
+    def store(self, response):
+        if response.status_code == 200 and self.rendered:
+            entry = {
+                'fragments': self.rendered,
+                'cost_ms': (time.perf_counter() - self.started) * 1000,
+            }
+            cache.set(self.key, entry, settings.CATALOG_CACHE_TIMEOUT)
+            cache.set(self.stale_key, entry, settings.CATALOG_CACHE_TIMEOUT)
+        self.release()
+
+    def release(self):
+        if self.leader:
+            cache.delete(self.lock_key)
+            self.leader = False
+
+
+def lookup(request, params=('sort', 'page', 'cursor'), slug=None):
+    """
+    Return the ``CatalogPage`` for a cacheable request, or ``None``. ``params``
+    are the query parameters the page varies on, ``slug`` the product whose
+    stock it shows.
+    """
+    if request.method not in ('GET', 'HEAD') or settings.CATALOG_CACHE_TIMEOUT <= 0:
+        return None
+    page_key = '|'.join([
+        request.path,
+        *(','.join(sorted(request.GET.getlist(name))) for name in params),
+        get_price_tier(request.user),
+    ])
+    page = CatalogPage(hashlib.md5(page_key.encode()).hexdigest(), get_catalog_version(slug)[0])
+    page.fetch()
+    return page
+
+
+def _stock_slug(view):
+    kwarg = getattr(view, 'stock_slug_kwarg', None)
+    return view.kwargs.get(kwarg) if kwarg else None
+
+
+class CatalogCacheMixin:
+    """Serve a catalog view's ``catalog_fragment`` blocks from the cache."""
+    catalog_cache_params = ('sort', 'page', 'cursor')
+    # URL keyword argument holding the slug of the product whose stock the
+    # page shows, if any; see ``bump_stock``.
+    stock_slug_kwarg = None
+
+    def get(self, request, *args, **kwargs):
+        page = self.catalog_page = lookup(request, self.catalog_cache_params, _stock_slug(self))
+        if page is None:
+            return super().get(request, *args, **kwargs)
+        if page.hit:
+            self.object = self.object_list = None
+            return self.render_to_response({'catalog_page': page})
+        try:
+            response = super().get(request, *args, **kwargs)
+        except Exception:
+            page.release()
+            raise
+        response.add_post_render_callback(page.store)
+        return response
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['catalog_page'] = getattr(self, 'catalog_page', None)
+        return context
+
+
+class CatalogConditionalGetMixin(ConditionalGetMixin):
+    """Conditional GET for pages that only change with the catalog version."""
+    stock_slug_kwarg = None
+
+    def get_validators(self):
+        version, changed_at = get_catalog_version(_stock_slug(self))
+        return [version], changed_at
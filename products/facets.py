@@ -0,0 +1,463 @@
+"""
+Faceted filtering for the product listing: size and color (multi-select),
+category, a price range on the visitor's tier price, and in-stock only, with
+a live count next to every option.
+
+Each process keeps an in-memory index of the available products, built by
+``warm_up`` when the WSGI/ASGI application loads, before the process serves
+requests (the first request builds it otherwise). Every product has a bit
+position, and every facet value (each category, size and color, plus "in
+stock") is a bitmap of positions held in a Python ``int``. Filters combine with ``&``/``|`` and counts are
+``int.bit_count()``, so a filter plus all its facet counts costs a few dozen
+big-int operations instead of a ``GROUP BY`` over the join tables.
+
+Positions are assigned in price order, which makes a price range one run of
+bits found by bisection. Tier prices are the base price times a constant, so
+that order holds for every tier.
+
+The index follows the database through the ``FacetChange`` journal. Product
+saves, deletes, size/color changes and sales that sell a product out record
+the product id once they commit, then bump the catalog generation. A process
+that sees a new generation, or hasn't looked for
+``PRODUCT_FACET_SYNC_INTERVAL`` seconds, reloads just the journaled
+products: their old positions leave the ``live`` bitmap and they are
+re-added past the price-ordered run, in a tail whose prices are checked one
+by one. When the tail outgrows ``PRODUCT_FACET_TAIL_LIMIT`` the index is
+rebuilt in price order.
+
+Writes that bypass signals (``QuerySet.update``, ``bulk_create``) must call
+``record_changes`` themselves.
+"""
+import datetime
+import json
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from dataclasses import dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import Exists, Max, OuterRef
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Now
+from django.utils.http import urlencode
+
+from .cache import bump_generation, get_generation
+from .models import FacetChange, Product
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+FACETS = ('category', 'size', 'color')
+# Query parameters read by FacetFilters.from_query.
+FILTER_PARAMS = ('size', 'color', 'min_price', 'max_price', 'in_stock')
+# Journal rows are re-read for this long after they are first seen, in case
+# an earlier-stamped row committed late.
+SYNC_SLACK = datetime.timedelta(seconds=5)
+# Journal rows older than this are pruned; a process idle for half as long
+# rebuilds instead of syncing.
+JOURNAL_RETENTION = datetime.timedelta(days=1)
+# Keeps SQLite under its bound-parameter limit.
+BATCH_SIZE = 500
+
+
+def _bitmap(positions, size):
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(bits, 'little')
+
+
+def _positions(bitmap):
+    """Set bit positions of ``bitmap``, lowest first."""
+    digits = bin(bitmap)[:1:-1]
+    position = digits.find('1')
+    while position != -1:
+        yield position
+        position = digits.find('1', position + 1)
+
+
+def _run(start, stop):
+    """Bitmap with positions ``start`` to ``stop - 1`` set."""
+    return (1 << stop) - (1 << start)
+
+
+def _id_list(ids):
+    """
+    An ``id__in`` value for a long list of ids. Passed as a single parameter
+    where the backend can unpack one, which saves compiling and binding a
+    placeholder per id.
+    """
+    if connection.vendor == 'postgresql':
+        return RawSQL('SELECT unnest(%s::bigint[])', [ids])
+    if connection.vendor == 'sqlite':
+        return RawSQL('SELECT value FROM json_each(%s)', [json.dumps(ids)])
+    return ids
+
+
+def _load(product_ids=None):
+    """
+    ``(id, price, category_id, stock)`` of available products in price order,
+    and ``{facet: [(product_id, value id), ...]}`` for sizes and colors.
+    """
+    products = Product.objects.filter(available=True)
+    # Links of unavailable products are loaded too but never looked up;
+    # joining to filter them out costs more.
+    links = {'size': Product.sizes.through.objects.all(), 'color': Product.colors.through.objects.all()}
+    if product_ids is not None:
+        products = products.filter(id__in=product_ids)
+        links = {facet: through.filter(product_id__in=product_ids) for facet, through in links.items()}
+    rows = list(products.order_by('price', 'id').values_list('id', 'price', 'category_id', 'stock'))
+    values = {facet: list(through.values_list('product_id', f'{facet}_id')) for facet, through in links.items()}
+    return rows, values
+
+
+@dataclass
+class FacetFilters:
+    category: int = None
+    sizes: list = field(default_factory=list)
+    colors: list = field(default_factory=list)
+    min_price: Decimal = None
+    max_price: Decimal = None
+    in_stock: bool = False
+
+    @classmethod
+    def from_query(cls, params, category=None):
+        """Read filters from a ``QueryDict``, ignoring malformed values."""
+        def ids(name):
+            return sorted({int(value) for value in params.getlist(name) if value.isdigit()})
+
+        def price(name):
+            try:
+                value = Decimal(params.get(name, ''))
+            except InvalidOperation:
+                return None
+            return value if value.is_finite() and value >= 0 else None
+
+        return cls(
+            category=category, sizes=ids('size'), colors=ids('color'),
+            min_price=price('min_price'), max_price=price('max_price'),
+            in_stock=params.get('in_stock') == '1',
+        )
+
+    @property
+    def active(self):
+        """Whether anything beyond the category is filtered on."""
+        return bool(self.sizes or self.colors or self.in_stock
+                    or self.min_price is not None or self.max_price is not None)
+
+    def query_string(self):
+        """The filters (not the category, which is in the path) as URL parameters."""
+        params = [('size', value) for value in self.sizes] + [('color', value) for value in self.colors]
+        for name in ('min_price', 'max_price'):
+            if getattr(self, name) is not None:
+                params.append((name, getattr(self, name)))
+        if self.in_stock:
+            params.append(('in_stock', 1))
+        return urlencode(params)
+
+    def apply(self, queryset):
+        """The same filters in SQL, for a ``with_price_for`` product queryset."""
+        if self.category is not None:
+            queryset = queryset.filter(category_id=self.category)
+        if self.sizes:
+            queryset = queryset.filter(Exists(Product.sizes.through.objects.filter(
+                product_id=OuterRef('pk'), size_id__in=self.sizes)))
+        if self.colors:
+            queryset = queryset.filter(Exists(Product.colors.through.objects.filter(
+                product_id=OuterRef('pk'), color_id__in=self.colors)))
+        if self.min_price is not None:
+            queryset = queryset.filter(tier_price__gte=self.min_price)
+        if self.max_price is not None:
+            queryset = queryset.filter(tier_price__lte=self.max_price)
+        if self.in_stock:
+            queryset = queryset.filter(stock__gt=0)
+        return queryset
+
+
+@dataclass
+class FacetResult:
+    index: 'FacetIndex'
+    filters: FacetFilters
+    matches: int
+    total: int
+    # {facet: {value id: count}}, each counted with every other filter
+    # applied but not the facet's own, so options stay selectable.
+    counts: dict
+    in_stock_count: int
+    # Lowest and highest tier price with every filter but the price range.
+    price_range: tuple
+
+    def product_ids(self):
+        ids = self.index.ids
+        return [ids[position] for position in _positions(self.matches)]
+
+    def filter(self, queryset):
+        """
+        Restrict a listing queryset to the matches: by id when there are few
+        of them, otherwise with the same filters in SQL, where the listing
+        indexes find the first page without visiting every match.
+        """
+        if not self.filters.active:
+            return queryset
+        if self.total <= settings.PRODUCT_FACET_ID_FILTER_LIMIT:
+            return queryset.filter(id__in=_id_list(self.product_ids()))
+        return self.filters.apply(queryset)
+
+
+class FacetIndex:
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.synced_at = time.monotonic()
+        self.since = None
+        self.applied = {}
+        self.ids = []
+        self.positions = {}
+        # Base prices of the price-ordered run, then {position: price} for
+        # products added since. Both are replaced, never mutated, so readers
+        # can iterate them while a sync runs.
+        self.prices = []
+        self.tail = {}
+        self.live = 0
+        self.in_stock = 0
+        # {facet: {value id: bitmap}}, replaced per facet on sync like the above.
+        self.values = {facet: {} for facet in FACETS}
+
+    @classmethod
+    def build(cls, generation):
+        index = cls(generation)
+        latest = FacetChange.objects.aggregate(latest=Max('changed_at'))['latest']
+        index.since = latest and latest - SYNC_SLACK
+        rows, values = _load()
+        size = len(rows)
+        members = {facet: defaultdict(list) for facet in FACETS}
+        stocked = []
+        for position, (product_id, price, category_id, stock) in enumerate(rows):
+            index.ids.append(product_id)
+            index.prices.append(price)
+            members['category'][category_id].append(position)
+            if stock > 0:
+                stocked.append(position)
+        index.positions = positions = {product_id: position for position, product_id in enumerate(index.ids)}
+        for facet in ('size', 'color'):
+            for product_id, value in values[facet]:
+                position = positions.get(product_id)
+                if position is not None:
+                    members[facet][value].append(position)
+        index.live = _run(0, size)
+        index.in_stock = _bitmap(stocked, size)
+        for facet, by_value in members.items():
+            index.values[facet] = {value: _bitmap(found, size) for value, found in by_value.items()}
+        return index
+
+    def is_expired(self):
+        return time.monotonic() - self.synced_at > JOURNAL_RETENTION.total_seconds() / 2
+
+    def is_due(self, generation):
+        return (generation != self.generation
+                or time.monotonic() - self.synced_at > settings.PRODUCT_FACET_SYNC_INTERVAL)
+
+    def sync(self, generation):
+        """Apply journaled changes; returns this index, or a rebuilt one."""
+        changes = FacetChange.objects.all()
+        if self.since is not None:
+            changes = changes.filter(changed_at__gte=self.since)
+        rows = list(changes.values_list('product_id', 'changed_at'))
+        self.generation = generation
+        self.synced_at = time.monotonic()
+        if not rows:
+            return self
+        product_ids = [product_id for product_id, changed_at in rows
+                       if self.applied.get(product_id) != changed_at]
+        if len(self.tail) + len(product_ids) > settings.PRODUCT_FACET_TAIL_LIMIT:
+            return FacetIndex.build(generation)
+        for start in range(0, len(product_ids), BATCH_SIZE):
+            self.apply(product_ids[start:start + BATCH_SIZE])
+        self.since = max(changed_at for product_id, changed_at in rows) - SYNC_SLACK
+        self.applied = dict(rows)
+        return self
+
+    def apply(self, product_ids):
+        """Reload the given products, dropping those no longer available."""
+        rows, values = _load(product_ids)
+        tail = dict(self.tail)
+        removed = []
+        for product_id in product_ids:
+            position = self.positions.pop(product_id, None)
+            if position is not None:
+                removed.append(position)
+                tail.pop(position, None)
+
+        added = defaultdict(list)
+        for product_id, price, category_id, stock in rows:
+            position = len(self.ids)
+            self.ids.append(product_id)
+            self.positions[product_id] = position
+            tail[position] = price
+            added['live', None].append(position)
+            added['category', category_id].append(position)
+            if stock > 0:
+                added['in_stock', None].append(position)
+        for facet in ('size', 'color'):
+            for product_id, value in values[facet]:
+                position = self.positions.get(product_id)
+                if position is not None:
+                    added[facet, value].append(position)
+
+        size = len(self.ids)
+        bitmaps = {key: _bitmap(positions, size) for key, positions in added.items()}
+        for facet in FACETS:
+            values = dict(self.values[facet])
+            for key, bitmap in bitmaps.items():
+                if key[0] == facet:
+                    values[key[1]] = values.get(key[1], 0) | bitmap
+            self.values[facet] = values
+        self.in_stock |= bitmaps.get(('in_stock', None), 0)
+        self.tail = tail
+        self.live = (self.live & ~_bitmap(removed, size)) | bitmaps.get(('live', None), 0)
+
+    def price_mask(self, low, high, multiplier):
+        """Positions whose base price times ``multiplier`` is within ``[low, high]``."""
+        def key(price):
+            return price * multiplier
+
+        start = 0 if low is None else bisect_left(self.prices, low, key=key)
+        stop = len(self.prices) if high is None else bisect_right(self.prices, high, key=key)
+        in_tail = [position for position, price in self.tail.items()
+                   if (low is None or price * multiplier >= low) and (high is None or price * multiplier <= high)]
+        return _run(start, stop) | _bitmap(in_tail, len(self.ids))
+
+    def price_range(self, mask, multiplier):
+        run = len(self.prices)
+        prices = []
+        in_run = mask & _run(0, run)
+        if in_run:
+            prices += [self.prices[(in_run & -in_run).bit_length() - 1], self.prices[in_run.bit_length() - 1]]
+        tail = self.tail
+        prices += [tail[run + offset] for offset in _positions(mask >> run) if run + offset in tail]
+        if not prices:
+            return None
+        return min(prices) * multiplier, max(prices) * multiplier
+
+    def search(self, filters, multiplier):
+        masks = {}
+        if filters.category is not None:
+            masks['category'] = self.values['category'].get(filters.category, 0)
+        for facet, selected in (('size', filters.sizes), ('color', filters.colors)):
+            if selected:
+                mask = 0
+                for value in selected:
+                    mask |= self.values[facet].get(value, 0)
+                masks[facet] = mask
+        if filters.min_price is not None or filters.max_price is not None:
+            masks['price'] = self.price_mask(filters.min_price, filters.max_price, multiplier)
+        if filters.in_stock:
+            masks['in_stock'] = self.in_stock
+
+        def without(name):
+            mask = self.live
+            for other, other_mask in masks.items():
+                if other != name:
+                    mask &= other_mask
+            return mask
+
+        matches = without(None)
+        counts = {}
+        for facet in FACETS:
+            base = without(facet) if facet in masks else matches
+            counts[facet] = {value: (bitmap & base).bit_count() for value, bitmap in self.values[facet].items()}
+        return FacetResult(
+            index=self, filters=filters, matches=matches, total=matches.bit_count(), counts=counts,
+            in_stock_count=(self.in_stock & without('in_stock')).bit_count(),
+            price_range=self.price_range(without('price'), multiplier),
+        )
+
+
+_index = None
+_lock = threading.Lock()
+
+
+def get_index():
+    """This process's facet index, synced with the journal when the catalog has changed."""
+    global _index
+    generation = get_generation()
+    index = _index
+    if index is None:
+        with _lock:
+            if _index is None:
+                _index = FacetIndex.build(generation)
+            return _index
+    # Only one thread syncs or rebuilds; the others keep reading the current state.
+    if (index.is_expired() or index.is_due(generation)) and _lock.acquire(blocking=False):
+        try:
+            index = _index = FacetIndex.build(generation) if _index.is_expired() else _index.sync(generation)
+        finally:
+            _lock.release()
+    return index
+
+
+def warm_up():
+    """
+    Build this process's index before it serves requests, so no visitor
+    waits for it (see ``marketplace.wsgi`` and ``marketplace.asgi``). If the
+    database isn't ready (e.g. before ``migrate``) the first request builds it.
+    """
+    if not settings.PRODUCT_FACET_WARM_UP:
+        return None
+    start = time.perf_counter()
+    try:
+        index = get_index()
+    except DatabaseError:
+        logger.warning('Could not build the facet index at startup; the first listing will.', exc_info=True)
+        return None
+    finally:
+        # Under ``gunicorn --preload`` this runs before the workers fork,
+        # and they must not share its connections.
+        for database in connections.all(initialized_only=True):
+            if not database.in_atomic_block:
+                database.close()
+    logger.info(f'Facet index of {len(index.positions)} products built in {time.perf_counter() - start:.2f}s.')
+    return index
+
+
+def reset_index():
+    """Drop this process's index; the next request rebuilds it."""
+    global _index
+    _index = None
+
+
+def record_changes(product_ids):
+    """Journal products whose facet values changed, once the current transaction commits."""
+    product_ids = set(product_ids)
+    if not product_ids:
+        return
+
+    def record():
+        if connection.vendor in ('postgresql', 'sqlite'):
+            # The bulk_create below compiles Now() into every row, which
+            # takes several times longer than the insert for big imports.
+            table = connection.ops.quote_name(FacetChange._meta.db_table)
+            now, _ = FacetChange.objects.all().query.get_compiler(connection=connection).compile(Now())
+            # Atomic, as this runs after the commit and each row would be
+            # its own transaction otherwise.
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(
+                    f'INSERT INTO {table} (product_id, changed_at) VALUES (%s, {now}) '
+                    f'ON CONFLICT (product_id) DO UPDATE SET changed_at = EXCLUDED.changed_at',
+                    [[product_id] for product_id in product_ids],
+                )
+        else:
+            FacetChange.objects.bulk_create(
+                [FacetChange(product_id=product_id) for product_id in product_ids],
+                update_conflicts=True, unique_fields=['product_id'], update_fields=['changed_at'],
+            )
+        FacetChange.objects.filter(changed_at__lt=Now() - JOURNAL_RETENTION).delete()
+        # Bumped again after the journal write, so a process that syncs on
+        # the new generation is sure to find the rows.
+        bump_generation()
+
+    transaction.on_commit(record)
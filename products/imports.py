@@ -0,0 +1,628 @@
+"""
+Bulk catalog import from CSV or JSON Lines, used by the product admin's
+import page and the ``import_products`` command.
+
+Each row describes one product, matched by ``slug``:
+
+* ``slug``: the product to create or update. Without one, the slug comes
+  from the name. A product with that slug and the same name is updated;
+  otherwise a new product gets the first free ``<slug>-2``, ``<slug>-3``...
+* ``name``, ``description``, ``price``, ``category`` (name or slug, created
+  if missing), ``stock``, ``available``.
+* ``sizes`` and ``colors``: names separated by ``|`` in CSV, lists in JSON,
+  created if missing. They replace the product's current set.
+
+Empty cells, JSON nulls and missing columns leave a field as it is; new
+products need ``name``, ``price`` and ``category``. Products missing from the
+file are left alone.
+
+The file is read a line at a time and applied in batches of
+``PRODUCT_IMPORT_BATCH_SIZE`` rows. One query loads a batch's existing
+products, and each row is compared with its product field by field. Only the
+fields that changed are written with ``bulk_update``; new products and link
+table rows are inserted with one ``executemany`` per table, and link rows
+deleted in bulk. Rows whose name-made slug another product holds have the
+suffixed slugs looked up for the batch at once. Descriptions that differ
+from the stored text, and whose hash differs from ``description_hash`` (the
+text the stored one was sanitized from), are sanitized as ``Product.save``
+would do, each distinct text once. A batch with many of them uses a pool of
+``PRODUCT_IMPORT_WORKERS`` processes.
+
+Bulk writes bypass the model signals, so once the import commits it
+reindexes search, journals facet changes and bumps the catalog generation
+itself. Images aren't imported, so renditions are unaffected.
+
+The import is a single transaction. Rows that fail validation are reported
+and skipped. A dry run goes through every step and then rolls back, so its
+report shows exactly what the import would change. The report lists the
+first ``REPORT_LIMIT`` changed and skipped rows; its counts cover them all.
+"""
+import codecs
+import csv
+import json
+import multiprocessing
+import re
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict, dataclass, field
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_slug
+from django.db import connections, router, transaction
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.text import slugify
+
+from . import facets, search
+from .cache import bump_generation_on_commit
+from .models import Category, Color, Product, Size, description_hash
+from .sanitizer import sanitize
+
+FORMATS = ('csv', 'jsonl')
+LINKS = {'sizes': Size, 'colors': Color}
+COLUMNS = {'slug', 'name', 'description', 'price', 'category', 'stock', 'available', *LINKS}
+# Separates size and color names in CSV cells.
+LIST_SEPARATOR = '|'
+# Batches with fewer descriptions to sanitize than this don't use the pool.
+POOL_THRESHOLD = 200
+# Changed and skipped rows listed in the report; the counts cover every row.
+REPORT_LIMIT = 1000
+# Slugs whose suffixed variants one query looks up; see _Importer.suffixed.
+SUFFIXED_QUERY_SIZE = 100
+# Sanitized descriptions remembered across batches, for text many rows share.
+SANITIZED_CACHE_SIZE = 10000
+# Fields whose changes need a search reindex or a facet journal entry.
+SEARCH_FIELDS = {'name', 'description', 'category_id', 'available'}
+FACET_FIELDS = {'price', 'category_id', 'stock', 'available', *LINKS}
+
+_TRUE = {'1', 'true', 'yes', 'y'}
+_FALSE = {'0', 'false', 'no', 'n'}
+_MAX_PRICE = Decimal(10) ** (Product._meta.get_field('price').max_digits - 2)
+_CENT = Decimal('0.01')
+# The largest PositiveIntegerField value every supported database stores.
+_MAX_STOCK = 2 ** 31 - 1
+# Column values a new product is inserted with, and field types whose
+# cleaned values go to the database driver as they are.
+_NEW_FIELDS = [field.attname for field in Product._meta.concrete_fields if not field.primary_key]
+_DRIVER_TYPES = {
+    'BigAutoField', 'BigIntegerField', 'BooleanField', 'CharField', 'IntegerField',
+    'PositiveIntegerField', 'SlugField', 'TextField',
+}
+_CURRENT_FIELDS = (
+    'id', 'slug', 'name', 'description', 'description_hash', 'price', 'category_id', 'stock', 'available',
+)
+
+
+def _max_length(model, name):
+    return model._meta.get_field(name).max_length
+
+
+def _text(max_length=None, strip=True):
+    def clean(value):
+        if not isinstance(value, str):
+            raise ValueError('must be text')
+        if strip:
+            value = value.strip()
+        if max_length and len(value) > max_length:
+            raise ValueError(f'longer than {max_length} characters')
+        return value
+    return clean
+
+
+def _slug(value):
+    value = _text(_max_length(Product, 'slug'))(value)
+    try:
+        validate_slug(value)
+    except ValidationError:
+        raise ValueError('not a valid slug')
+    return value
+
+
+def _price(value):
+    if isinstance(value, bool):
+        raise ValueError('not a number')
+    try:
+        price = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError('not a number')
+    if not price.is_finite() or price < 0 or price >= _MAX_PRICE:
+        raise ValueError(f'must be between 0 and {_MAX_PRICE}')
+    return price.quantize(_CENT)
+
+
+def _stock(value):
+    if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+        raise ValueError('not a whole number')
+    try:
+        stock = int(value.strip() if isinstance(value, str) else value)
+    except (TypeError, ValueError):
+        raise ValueError('not a whole number')
+    if not 0 <= stock <= _MAX_STOCK:
+        raise ValueError(f'must be between 0 and {_MAX_STOCK}')
+    return stock
+
+
+def _available(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lower() in _TRUE | _FALSE:
+        return value.strip().lower() in _TRUE
+    raise ValueError('must be true or false')
+
+
+def _names(model):
+    clean_name = _text(_max_length(model, 'name'))
+
+    def clean(value):
+        if isinstance(value, str):
+            value = value.split(LIST_SEPARATOR)
+        elif not isinstance(value, list):
+            raise ValueError('must be a list of names')
+        return sorted({name for name in map(clean_name, value) if name})
+    return clean
+
+
+_CLEANERS = {
+    'slug': _slug,
+    'name': _text(_max_length(Product, 'name')),
+    'description': _text(strip=False),
+    'price': _price,
+    'category': _text(_max_length(Category, 'name')),
+    'stock': _stock,
+    'available': _available,
+    **{column: _names(model) for column, model in LINKS.items()},
+}
+
+
+def clean_row(row):
+    """Validate a row; returns the values of the columns it sets, or raises ``ValueError``."""
+    if None in row:
+        raise ValueError('More cells than columns.')
+    unknown = set(row) - COLUMNS
+    if unknown:
+        raise ValueError(f'Unknown column(s): {", ".join(sorted(unknown))}.')
+    values = {}
+    for column, value in row.items():
+        if value is None or value == '':
+            continue
+        try:
+            values[column] = _CLEANERS[column](value)
+        except ValueError as e:
+            raise ValueError(f'{column}: {e}.')
+    if not values.get('slug') and not values.get('name'):
+        raise ValueError('A row needs a slug or a name.')
+    return values
+
+
+def read_rows(file, format='csv'):
+    """
+    Yield ``(line, row, error)`` for each row of a binary file, reading a
+    line at a time. Raises ``ValueError`` for an unusable CSV header.
+    """
+    lines = codecs.iterdecode(file, 'utf-8-sig')
+    if format == 'csv':
+        reader = csv.DictReader(lines)
+        header = set(reader.fieldnames or ())
+        if header - COLUMNS or not header & {'slug', 'name'}:
+            raise ValueError(f'The CSV header needs a slug or name column and may only have: '
+                             f'{", ".join(sorted(COLUMNS))}.')
+        try:
+            for row in reader:
+                yield reader.line_num, row, None
+        except csv.Error as e:
+            raise ValueError(f'Line {reader.line_num}: {e}')
+    elif format == 'jsonl':
+        for line, text in enumerate(lines, 1):
+            if not text.strip():
+                continue
+            try:
+                row = json.loads(text)
+            except ValueError as e:
+                yield line, None, f'Invalid JSON: {e}.'
+                continue
+            if isinstance(row, dict):
+                yield line, row, None
+            else:
+                yield line, None, 'Expected a JSON object.'
+    else:
+        raise ValueError(f'Unknown import format {format!r}.')
+
+
+def _preview(value, length=60):
+    if isinstance(value, str) and len(value) > length:
+        return value[:length - 1] + '…'
+    return str(value) if isinstance(value, Decimal) else value
+
+
+def _free_slug(base, max_length, *taken):
+    """``base``, or ``base-2``, ``base-3``... whichever is in none of ``taken``."""
+    slug, number = base, 1
+    while any(slug in container for container in taken):
+        number += 1
+        suffix = f'-{number}'
+        slug = base[:max_length - len(suffix)] + suffix
+    return slug
+
+
+def _insert(model, fields, rows):
+    """
+    Insert ``rows``, sequences of values for ``fields`` (attribute names) of
+    ``model``, with one executemany. ``bulk_create`` spends several times
+    longer preparing values than the database spends inserting them, but it
+    also fills in defaults and ``auto_now``; here every field must be given.
+    """
+    connection = connections[router.db_for_write(model)]
+    fields = [model._meta.get_field(name) for name in fields]
+    prepare = [(i, field) for i, field in enumerate(fields)
+               if (field.target_field if field.is_relation else field).get_internal_type() not in _DRIVER_TYPES]
+    params = []
+    for row in rows:
+        if prepare:
+            row = list(row)
+            for i, field in prepare:
+                row[i] = field.get_db_prep_save(row[i], connection)
+        params.append(row)
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            f'INSERT INTO {qn(model._meta.db_table)} ({", ".join(qn(field.column) for field in fields)}) '
+            f'VALUES ({", ".join(["%s"] * len(fields))})',
+            params,
+        )
+
+
+@dataclass
+class ImportReport:
+    dry_run: bool = False
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    # Distinct descriptions run through the sanitizer.
+    sanitized: int = 0
+    elapsed_s: float = 0.0
+    skipped: int = 0
+    # (line, message) for the first REPORT_LIMIT skipped rows, by line.
+    errors: list = field(default_factory=list)
+    # Products changed per field.
+    field_changes: Counter = field(default_factory=Counter)
+    new_categories: list = field(default_factory=list)
+    new_sizes: list = field(default_factory=list)
+    new_colors: list = field(default_factory=list)
+    # The first REPORT_LIMIT created or updated rows, with old and new values.
+    changes: list = field(default_factory=list)
+
+    def summary(self):
+        prefix = 'Dry run: would have ' if self.dry_run else ''
+        return (f'{prefix}{self.created} created, {self.updated} updated, {self.unchanged} unchanged, '
+                f'{self.skipped} row(s) skipped.')
+
+    def skip(self, line, message):
+        self.skipped += 1
+        self.errors.append((line, message))
+        # Rows are skipped while reading and while applying a batch, so not
+        # quite in line order; trimming now and then keeps the first ones.
+        if len(self.errors) >= 2 * REPORT_LIMIT:
+            self.trim_errors()
+
+    def trim_errors(self):
+        self.errors.sort()
+        del self.errors[REPORT_LIMIT:]
+
+    def as_dict(self):
+        return {**asdict(self), 'field_changes': dict(self.field_changes)}
+
+
+class _Importer:
+    """Applies batches of cleaned rows; holds what carries over between batches."""
+
+    def __init__(self, report, workers):
+        self.report = report
+        self.workers = workers
+        self.pool = None
+        self.sanitized = {}
+        # Slug -> name of every product the file has touched so far.
+        self.claimed = {}
+        self.categories, self.category_names, self.category_slugs = {}, {}, set()
+        for pk, name, slug in Category.objects.values_list('pk', 'name', 'slug'):
+            self.add_category(pk, name, slug)
+        self.link_ids = {column: dict(model.objects.values_list('name', 'pk')) for column, model in LINKS.items()}
+        self.link_names = {column: {pk: name for name, pk in ids.items()} for column, ids in self.link_ids.items()}
+        self.search_ids, self.facet_ids = set(), set()
+        # A new product's values for the columns a row leaves out.
+        product = Product()
+        self.new_product = {name: getattr(product, name) for name in _NEW_FIELDS}
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def add_category(self, pk, name, slug):
+        self.categories.setdefault(slug.lower(), pk)
+        self.categories.setdefault(name.lower(), pk)
+        self.category_names[pk] = name
+        self.category_slugs.add(slug)
+
+    def category(self, value):
+        pk = self.categories.get(value.lower())
+        if pk is None:
+            base = slugify(value)[:_max_length(Category, 'slug')] or 'category'
+            category = Category.objects.create(
+                name=value, slug=_free_slug(base, _max_length(Category, 'slug'), self.category_slugs),
+            )
+            self.add_category(category.pk, category.name, category.slug)
+            self.report.new_categories.append(value)
+            pk = category.pk
+        return pk
+
+    def add_link_names(self, column, names):
+        known = self.link_ids[column]
+        missing = sorted(set(names) - set(known))
+        if not missing:
+            return
+        model = LINKS[column]
+        model.objects.bulk_create([model(name=name) for name in missing], ignore_conflicts=True)
+        for name, pk in model.objects.filter(name__in=missing).values_list('name', 'pk'):
+            known[name] = pk
+            self.link_names[column][pk] = name
+        getattr(self.report, f'new_{column}').extend(missing)
+
+    def sanitize(self, texts):
+        """Sanitize each text not seen before, in the pool if there are many."""
+        if len(self.sanitized) > SANITIZED_CACHE_SIZE:
+            self.sanitized.clear()
+        texts = [text for text in set(texts) if text not in self.sanitized]
+        if not texts:
+            return
+        if self.workers > 1 and len(texts) >= POOL_THRESHOLD:
+            if self.pool is None:
+                # Spawned, so workers don't inherit this process's database
+                # connections; they only need products.sanitizer.
+                self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn'))
+            cleaned = self.pool.map(sanitize, texts, chunksize=max(1, len(texts) // (self.workers * 4)))
+        else:
+            cleaned = map(sanitize, texts)
+        self.sanitized.update(zip(texts, cleaned))
+        self.report.sanitized += len(texts)
+
+    @staticmethod
+    def needs_sanitizing(text, current):
+        return current is None or (text != current['description']
+                                   and description_hash(text) != current['description_hash'])
+
+    def resolve(self, batch):
+        """Match rows to existing products; returns ``(line, slug, current values or None, values)``."""
+        slug_max_length = _max_length(Product, 'slug')
+        keys = {values.get('slug') or slugify(values['name'])[:slug_max_length] for _, values in batch}
+        existing = {row['slug']: row for row in Product.objects.filter(slug__in=keys).values(*_CURRENT_FIELDS)}
+        # Name-made slugs that a different product may hold, looked up for
+        # the whole batch rather than row by row.
+        given = {values['slug'] for _, values in batch if values.get('slug')}
+        named = [(values['name'], slugify(values['name'])[:slug_max_length])
+                 for _, values in batch if not values.get('slug')]
+        counts = Counter(slug for _, slug in named)
+        suffixed = self.suffixed({slug for name, slug in named if slug and (
+            counts[slug] > 1 or slug in given or slug in self.claimed
+            or (slug in existing and existing[slug]['name'] != name))})
+        resolved = []
+        for line, values in batch:
+            if values.get('slug'):
+                slug = values['slug']
+                if slug in self.claimed:
+                    self.report.skip(line, f'Slug {slug} appears earlier in the file.')
+                    continue
+                current = existing.get(slug)
+            else:
+                name, slug = values['name'], slugify(values['name'])[:slug_max_length]
+                if not slug:
+                    self.report.skip(line, 'name: nothing to make a slug from.')
+                    continue
+                if self.claimed.get(slug) == name:
+                    self.report.skip(line, f'Product {name} appears earlier in the file.')
+                    continue
+                current = existing.get(slug)
+                if slug in self.claimed or (current is not None and current['name'] != name):
+                    # A different product has this slug; this one may be
+                    # under a suffixed slug from an earlier import.
+                    if slug not in suffixed:
+                        # Claimed by a suffixed slug earlier in this batch.
+                        suffixed.update(self.suffixed([slug]))
+                    taken = suffixed[slug]
+                    current = next((row for candidate, row in taken.items()
+                                    if row['name'] == name and candidate not in self.claimed
+                                    and re.fullmatch(rf'{re.escape(slug)}-\d+', candidate)), None)
+                    slug = current['slug'] if current else _free_slug(slug, slug_max_length, taken, self.claimed)
+            if current is None:
+                missing = [column for column in ('name', 'price', 'category') if column not in values]
+                if missing:
+                    self.report.skip(line, f'New product {slug} needs {", ".join(missing)}.')
+                    continue
+            self.claimed[slug] = values.get('name') or current['name']
+            resolved.append((line, slug, current, values))
+        return resolved
+
+    def suffixed(self, slugs):
+        """
+        ``{slug: {slug: current values}}``: the products whose slug starts
+        with each of ``slugs``, a few slugs per query.
+        """
+        slugs = sorted(slugs)
+        suffixed = {slug: {} for slug in slugs}
+        for start in range(0, len(slugs), SUFFIXED_QUERY_SIZE):
+            chunk = slugs[start:start + SUFFIXED_QUERY_SIZE]
+            prefixes = Q(*[Q(slug__startswith=slug) for slug in chunk], _connector=Q.OR)
+            for row in Product.objects.filter(prefixes).values(*_CURRENT_FIELDS):
+                for slug in chunk:
+                    if row['slug'].startswith(slug):
+                        suffixed[slug][row['slug']] = row
+        return suffixed
+
+    def current_links(self, resolved):
+        """``{column: {product id: set of ids}}`` for updated rows that set sizes or colors."""
+        links = {}
+        for column in LINKS:
+            product_ids = [current['id'] for _, _, current, values in resolved
+                           if current is not None and column in values]
+            field_ = Product._meta.get_field(column)
+            through = field_.remote_field.through
+            target = f'{field_.m2m_reverse_field_name()}_id'
+            links[column] = defaultdict(dict)
+            for pk, product_id, link_id in through.objects.filter(product_id__in=product_ids).values_list(
+                    'pk', 'product_id', target):
+                links[column][product_id][link_id] = pk
+        return links
+
+    def apply(self, batch):
+        resolved = self.resolve(batch)
+        self.sanitize(values['description'] for _, _, current, values in resolved
+                      if 'description' in values and self.needs_sanitizing(values['description'], current))
+        for column in LINKS:
+            self.add_link_names(column, [name for *_, values in resolved for name in values.get(column, ())])
+        current_links = self.current_links(resolved)
+
+        creates, updates = [], defaultdict(list)
+        link_adds, link_removes = defaultdict(list), defaultdict(list)
+        now = timezone.now()
+        for line, slug, current, values in resolved:
+            changes = {}
+            for name in ('name', 'price', 'stock', 'available'):
+                if name in values and (current is None or values[name] != current[name]):
+                    changes[name] = values[name]
+            if 'category' in values:
+                category_id = self.category(values['category'])
+                if current is None or category_id != current['category_id']:
+                    changes['category_id'] = category_id
+            if 'description' in values and self.needs_sanitizing(values['description'], current):
+                description = self.sanitized[values['description']]
+                if current is None or description != current['description']:
+                    changes['description'] = description
+                changes['description_hash'] = description_hash(values['description'])
+            links = {}
+            for column in LINKS:
+                if column not in values:
+                    continue
+                wanted = {self.link_ids[column][name] for name in values[column]}
+                have = current_links[column].get(current['id'], {}) if current is not None else {}
+                if wanted != set(have):
+                    links[column] = (set(have), wanted)
+
+            if current is None:
+                row = {**self.new_product, 'slug': slug, 'created_at': now, 'updated_at': now, **changes}
+                creates.append((slug, [row[name] for name in _NEW_FIELDS], links))
+                self.record(line, slug, 'create', changes, None, links)
+                continue
+            if changes:
+                fields = sorted(changes)
+                if fields != ['description_hash']:
+                    fields.append('updated_at')
+                updates[tuple(fields)].append(Product(pk=current['id'], updated_at=now, **changes))
+            if changes.keys() <= {'description_hash'} and not links:
+                # New text that sanitizes to the stored description.
+                self.report.unchanged += 1
+                continue
+            for column, (have, wanted) in links.items():
+                through_ids = current_links[column][current['id']]
+                link_removes[column].extend(through_ids[pk] for pk in have - wanted)
+                link_adds[column].extend((current['id'], pk) for pk in wanted - have)
+            self.record(line, slug, 'update', changes, current, links)
+            self.track(current['id'], changes, links)
+
+        if creates:
+            _insert(Product, _NEW_FIELDS, [row for _, row, _ in creates])
+            ids = dict(Product.objects.filter(slug__in=[slug for slug, *_ in creates]).values_list('slug', 'pk'))
+            for slug, _, links in creates:
+                for column, (_, wanted) in links.items():
+                    link_adds[column].extend((ids[slug], pk) for pk in wanted)
+                self.track(ids[slug], None, links)
+        # Grouped by changed fields, so stock a row leaves alone isn't
+        # written back over a concurrent checkout's update.
+        for fields, products in updates.items():
+            Product.objects.bulk_update(products, fields)
+        for column in LINKS:
+            through = Product._meta.get_field(column).remote_field.through
+            target = f'{Product._meta.get_field(column).m2m_reverse_field_name()}_id'
+            if link_removes[column]:
+                through.objects.filter(pk__in=link_removes[column]).delete()
+            if link_adds[column]:
+                _insert(through, ['product_id', target], link_adds[column])
+
+    def track(self, product_id, changes, links):
+        """Remember what the product needs once the import commits; ``changes`` is None for new products."""
+        if changes is None or SEARCH_FIELDS & changes.keys():
+            self.search_ids.add(product_id)
+        if changes is None or FACET_FIELDS & changes.keys() or links:
+            self.facet_ids.add(product_id)
+
+    def record(self, line, slug, action, changes, current, links):
+        report = self.report
+        setattr(report, f'{action}d', getattr(report, f'{action}d') + 1)
+        changes = {name: value for name, value in changes.items() if name != 'description_hash'}
+        report.field_changes.update(name.removesuffix('_id') for name in changes.keys() | links.keys())
+        if len(report.changes) >= REPORT_LIMIT:
+            return
+        fields = {}
+        for name, value in changes.items():
+            old = current[name] if current is not None else None
+            if name == 'category_id':
+                name, old, value = 'category', self.category_names.get(old), self.category_names[value]
+            fields[name] = [_preview(old), _preview(value)]
+        for column, (have, wanted) in links.items():
+            names = self.link_names[column]
+            fields[column] = [sorted(names[pk] for pk in have), sorted(names[pk] for pk in wanted)]
+        report.changes.append({'line': line, 'slug': slug, 'action': action, 'fields': fields})
+
+    def finish(self):
+        if self.facet_ids:
+            facets.record_changes(self.facet_ids)
+        if self.search_ids:
+            product_ids = sorted(self.search_ids)
+
+            def reindex():
+                with transaction.atomic():
+                    search.index_products(product_ids)
+            transaction.on_commit(reindex)
+        if self.facet_ids or self.search_ids:
+            bump_generation_on_commit()
+
+
+def import_products(file, format='csv', dry_run=False, workers=None, batch_size=None):
+    """
+    Import products from a binary file object in ``format`` (see ``FORMATS``)
+    and return an ``ImportReport``. Raises ``ValueError`` for a file that
+    can't be read at all (bad CSV header, not UTF-8), importing nothing.
+    """
+    if format not in FORMATS:
+        raise ValueError(f'Unknown import format {format!r}.')
+    workers = settings.PRODUCT_IMPORT_WORKERS if workers is None else workers
+    batch_size = batch_size or settings.PRODUCT_IMPORT_BATCH_SIZE
+    report = ImportReport(dry_run=dry_run)
+    start = time.perf_counter()
+    with transaction.atomic():
+        importer = _Importer(report, workers)
+        try:
+            batch = []
+            for line, row, error in read_rows(file, format):
+                report.rows += 1
+                if error is None:
+                    try:
+                        batch.append((line, clean_row(row)))
+                    except ValueError as e:
+                        error = str(e)
+                if error is not None:
+                    report.skip(line, error)
+                if len(batch) >= batch_size:
+                    importer.apply(batch)
+                    batch = []
+            if batch:
+                importer.apply(batch)
+            importer.finish()
+            report.trim_errors()
+        finally:
+            importer.close()
+        if dry_run:
+            transaction.set_rollback(True)
+    report.elapsed_s = time.perf_counter() - start
+    return report
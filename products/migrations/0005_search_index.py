@@ -0,0 +1,55 @@
+from django.db import migrations
+
+# Mirrors products.search; kept inline so the migration doesn't depend on
+# the current version of that module.
+POSTGRES_FORWARDS = [
+    """
+    CREATE TABLE products_search (
+        product_id bigint PRIMARY KEY REFERENCES products_product (id) ON DELETE CASCADE DEFERRABLE INITIALLY DEFERRED,
+        document tsvector NOT NULL
+    )
+    """,
+    'CREATE INDEX products_search_document_idx ON products_search USING GIN (document)',
+    """
+    INSERT INTO products_search (product_id, document)
+    SELECT p.id,
+           setweight(to_tsvector('english', p.name), 'A') ||
+           setweight(to_tsvector('english', c.name), 'B') ||
+           setweight(to_tsvector('english', p.description), 'C')
+    FROM products_product p JOIN products_category c ON c.id = p.category_id
+    WHERE p.available
+    """,
+]
+POSTGRES_BACKWARDS = ['DROP TABLE products_search']
+
+SQLITE_FORWARDS = [
+    "CREATE VIRTUAL TABLE products_search_fts USING fts5(name, category, description, tokenize='porter unicode61')",
+    """
+    INSERT INTO products_search_fts (rowid, name, category, description)
+    SELECT p.id, p.name, c.name, p.description
+    FROM products_product p JOIN products_category c ON c.id = p.category_id
+    WHERE p.available
+    """,
+]
+SQLITE_BACKWARDS = ['DROP TABLE products_search_fts']
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0004_listing_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRES_FORWARDS, 'sqlite': SQLITE_FORWARDS}),
+            run({'postgresql': POSTGRES_BACKWARDS, 'sqlite': SQLITE_BACKWARDS}),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+# Mirrors products.search; kept inline so the migration doesn't depend on
+# the current version of that module.
+POSTGRES_FORWARDS = [
+    """
+    CREATE TABLE products_search_heading (
+        product_id bigint PRIMARY KEY,
+        heading tsvector NOT NULL
+    )
+    """,
+    'CREATE INDEX products_search_heading_idx ON products_search_heading USING GIN (heading)',
+    """
+    INSERT INTO products_search_heading (product_id, heading)
+    SELECT p.id,
+           setweight(to_tsvector('english', p.name), 'A') ||
+           setweight(to_tsvector('english', c.name), 'B')
+    FROM products_product p JOIN products_category c ON c.id = p.category_id
+    WHERE p.available
+    ORDER BY p.id
+    """,
+]
+POSTGRES_BACKWARDS = ['DROP TABLE products_search_heading']
+
+
+def run(statements):
+    def operation(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return operation
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0010_search_index_without_foreign_key'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run({'postgresql': POSTGRES_FORWARDS}),
+            run({'postgresql': POSTGRES_BACKWARDS}),
+        ),
+    ]
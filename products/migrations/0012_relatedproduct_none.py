@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-18 17:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('products', '0011_search_headings'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='relatedproduct',
+            name='related',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='neighbour_of', to='products.product'),
+        ),
+        migrations.AlterField(
+            model_name='relatedproduct',
+            name='source',
+            field=models.CharField(choices=[('co_purchase', 'Bought together'), ('category', 'Same category'), ('none', 'None found')], max_length=20),
+        ),
+    ]
@@ -1,9 +1,85 @@
-import bleach
+import hashlib
+
 from django.db import models
+from django.db.models import ExpressionWrapper, F, Q, Value
+from django.db.models.functions import Now, Substr
 from django.utils.text import slugify
 from django.urls import reverse
 from decimal import Decimal
 
+from .sanitizer import sanitize
+
+# Price multipliers per pricing tier; see Product.get_price
+PRICE_TIER_MULTIPLIERS = {
+    'guest': Decimal('1.1'),
+    'normal': Decimal('1'),
+    'business': Decimal('0.75'),
+}
+
+
+def get_price_tier(user=None):
+    """Return the pricing tier ('guest', 'normal' or 'business') for a user."""
+    if user and user.is_authenticated:
+        if getattr(user, 'user_type', None) == 'business':
+            return 'business'
+        return 'normal'
+    return 'guest'
+
+
+class TierPriceField(models.DecimalField):
+    """
+    Output field for computed prices. SQLite hands back floats for computed
+    expressions without quantizing them, so round to ``decimal_places`` here.
+    """
+
+    def from_db_value(self, value, expression, connection):
+        if value is None:
+            return value
+        return value.quantize(Decimal(1).scaleb(-self.decimal_places))
+
+
+def description_hash(text):
+    """Fingerprint of a description as written, before sanitizing; see Product.save."""
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+# Long enough for the |truncatechars:80 used on product cards to render
+# exactly as it would with the full description.
+DESCRIPTION_EXCERPT_LENGTH = 81
+
+
+class ProductQuerySet(models.QuerySet):
+    def for_listing(self):
+        """
+        Columns needed by product cards (grid pages, home page). The full
+        description is replaced by a short ``description_excerpt``.
+        """
+        return self.only(
+            'id', 'name', 'slug', 'price', 'image', 'renditions', 'stock', 'available', 'created_at',
+        ).annotate(description_excerpt=Substr('description', 1, DESCRIPTION_EXCERPT_LENGTH))
+
+    def for_detail(self):
+        """Everything the product page renders, without lazy per-relation queries."""
+        return self.select_related('category').prefetch_related('sizes', 'colors')
+
+    def with_price_for(self, user=None):
+        """
+        Annotate ``tier_price`` with the price ``user`` pays, computed in the
+        database so listings can sort and filter on it. Matches
+        ``Product.get_price`` exactly, including the Decimal exponent.
+        """
+        multiplier = PRICE_TIER_MULTIPLIERS[get_price_tier(user)]
+        price_field = Product._meta.get_field('price')
+        extra_places = -multiplier.as_tuple().exponent
+        return self.annotate(tier_price=ExpressionWrapper(
+            F('price') * Value(multiplier),
+            output_field=TierPriceField(
+                max_digits=price_field.max_digits + extra_places + 1,
+                decimal_places=price_field.decimal_places + extra_places,
+            ),
+        ))
+
+
 class Category(models.Model):
     name = models.CharField(max_length=100, unique=True)
     slug = models.SlugField(max_length=100, unique=True)
@@ -36,26 +112,75 @@ class Product(models.Model):
     name = models.CharField(max_length=200)
     slug = models.SlugField(max_length=200, unique=True)
     description = models.TextField()
+    # description_hash() of the text description was sanitized from, so
+    # imports can skip sanitizing text that hasn't changed.
+    description_hash = models.CharField(max_length=64, blank=True, editable=False)
     price = models.DecimalField(max_digits=10, decimal_places=2)
     image = models.ImageField(upload_to='products/', blank=True, null=True)
+    # Resized copies of image and their URLs, see products.renditions.
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
     stock = models.PositiveIntegerField(default=1)
+    reserved = models.PositiveIntegerField(default=0, editable=False)
     available = models.BooleanField(default=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     sizes = models.ManyToManyField(Size, blank=True)
     colors = models.ManyToManyField(Color, blank=True)
     
+    objects = ProductQuerySet.as_manager()
+    
     class Meta:
         ordering = ('-created_at',)
+        # One per listing sort, with and without a category filter. Each
+        # ends in id, the keyset pagination tiebreaker, and only covers
+        # available products since listings never show the others.
+        indexes = [
+            models.Index(fields=['created_at', 'id'], condition=Q(available=True),
+                         name='product_avail_created_idx'),
+            models.Index(fields=['price', 'id'], condition=Q(available=True),
+                         name='product_avail_price_idx'),
+            models.Index(fields=['name', 'id'], condition=Q(available=True),
+                         name='product_avail_name_idx'),
+            models.Index(fields=['category', 'created_at', 'id'], condition=Q(available=True),
+                         name='product_cat_created_idx'),
+            models.Index(fields=['category', 'price', 'id'], condition=Q(available=True),
+                         name='product_cat_price_idx'),
+            models.Index(fields=['category', 'name', 'id'], condition=Q(available=True),
+                         name='product_cat_name_idx'),
+        ]
     
     def __str__(self):
         return self.name
     
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Stored descriptions are already sanitized; see save().
+        instance._sanitized_description = instance.__dict__.get('description')
+        return instance
+
     def save(self, *args, **kwargs):
         if not self.slug:
             self.slug = slugify(self.name)
-        self.description = bleach.clean(self.description)
+        # Only sanitize a loaded description that changed, so stock or price
+        # saves (and saves of instances with it deferred) skip bleach.
+        description = self.__dict__.get('description')
+        if description is not None and description != getattr(self, '_sanitized_description', None):
+            self.description = self._sanitized_description = sanitize(description)
+            self.description_hash = description_hash(description)
+            update_fields = kwargs.get('update_fields')
+            if update_fields is not None and 'description' in update_fields:
+                kwargs['update_fields'] = {*update_fields, 'description_hash'}
+        # ``reserved`` is only written by the F() updates in orders.inventory:
+        # saving a copy read earlier (the admin, list_editable) would undo the
+        # reservations made since. Updates leave it out unless asked for.
+        if kwargs.get('update_fields') is None and not self._state.adding and not kwargs.get('force_insert'):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name != 'reserved' and field.attname not in deferred
+            ]
         super().save(*args, **kwargs)
     
     def get_absolute_url(self):
@@ -68,11 +193,77 @@ class Product(models.Model):
         - Normal users: Regular price
         - Business users: Price - 25%
         """
-        if user and user.is_authenticated:
-            if hasattr(user, 'user_type') and user.user_type == 'business':
-                # 25% discount for business users
-                return self.price * Decimal('0.75')
-            # Regular price for normal users
-            return self.price
-        #  10% markup for guests
-        return self.price * Decimal('1.1')
+        return self.price * PRICE_TIER_MULTIPLIERS[get_price_tier(user)]
+
+
+class FacetChange(models.Model):
+    """
+    Products whose facet values changed, so each process can update its
+    in-memory facet index (``products.facets``) without a full rebuild. One
+    row per product; ``changed_at`` is set by the database clock.
+    """
+    # Not a foreign key: deletions are recorded too.
+    product_id = models.BigIntegerField(unique=True)
+    changed_at = models.DateTimeField(db_default=Now(), db_index=True)
+
+    def __str__(self):
+        return f'{self.product_id} @ {self.changed_at}'
+
+
+class CoPurchase(models.Model):
+    """
+    Entries of the co-purchase matrix built by ``products.related``: the
+    paid orders that contain both products. Stored in both directions so a
+    product's row is one index range; the ``product_id == other_id`` entry
+    counts the orders containing the product. Not foreign keys, so deleting
+    a product doesn't cascade through the matrix; a rebuild drops it.
+    """
+    product_id = models.BigIntegerField()
+    other_id = models.BigIntegerField()
+    orders = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['product_id', 'other_id'], name='copurchase_pair_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} & {self.other_id}: {self.orders}'
+
+
+class CoPurchasedOrder(models.Model):
+    """Orders counted in ``CoPurchase``, so refreshes only read new ones."""
+    # Not a foreign key, like CoPurchase.
+    order_id = models.BigIntegerField(primary_key=True)
+
+    def __str__(self):
+        return f'Order {self.order_id}'
+
+
+class RelatedProduct(models.Model):
+    """
+    The products shown next to a product on its page, best first, as
+    computed by ``products.related``: the ones most often bought with it,
+    topped up from its category. A product with none to show has a single
+    row without ``related``, recording that it was ranked.
+    """
+    SOURCE_CHOICES = (
+        ('co_purchase', 'Bought together'),
+        ('category', 'Same category'),
+        ('none', 'None found'),
+    )
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='neighbours')
+    related = models.ForeignKey(Product, on_delete=models.CASCADE, null=True, related_name='neighbour_of')
+    rank = models.PositiveSmallIntegerField()
+    score = models.FloatField(default=0)
+    source = models.CharField(max_length=20, choices=SOURCE_CHOICES)
+
+    class Meta:
+        ordering = ('product', 'rank')
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'rank'], name='relatedproduct_rank_uniq'),
+        ]
+
+    def __str__(self):
+        return f'{self.product_id} #{self.rank}: {self.related_id}'
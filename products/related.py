@@ -0,0 +1,256 @@
+"""
+Related products for the product page, from what customers buy together.
+
+``refresh`` (the ``refresh_related_products`` command, meant to run
+periodically) maintains a sparse co-purchase matrix in ``CoPurchase``. With
+A the order x product matrix of paid orders it holds AᵀA: for each pair of
+products the orders containing both, and on the diagonal the orders
+containing each. Orders not yet in ``CoPurchasedOrder`` are read
+``RELATED_PRODUCTS_BATCH_SIZE`` at a time; the database multiplies each
+batch out with a self-join of its order items grouped by product pair, and
+the result is added to the stored counts with an upsert. Memory is bounded
+by the batch however long the order history, and a refresh only reads the
+orders placed since the last one.
+
+Neighbours are ranked by cosine similarity, ``orders(a, b) / sqrt(orders(a)
+* orders(b))``, so best-sellers don't top every list, and the best
+``RELATED_PRODUCTS_STORED`` are written to ``RelatedProduct``. Products
+with fewer co-purchased neighbours (new or rarely sold ones) are topped up
+with the newest available products of their category, which is what the
+page showed before. The page then reads its neighbours with one lookup on
+``(product, rank)`` (``related_products``).
+
+A refresh reranks the products in newly counted orders and the products
+never ranked before. A product with nothing to show (no co-purchases and
+no other available product in its category) gets a row without a
+neighbour, so it isn't reranked on every run. Other products' scores drift
+a little as their neighbours sell, and orders stay counted if they are
+later cancelled, until ``refresh(rebuild=True)`` recounts everything.
+"""
+import heapq
+import math
+import time
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+from django.db.models import Count, Exists, F, OuterRef, Window
+from django.db.models.functions import RowNumber
+
+from orders.models import Order, OrderItem
+from orders.rollups import SALES_STATUSES
+from .cache import bump_generation
+from .models import CoPurchase, CoPurchasedOrder, Product, RelatedProduct
+
+# Neighbours shown on the product page.
+SHOWN = 4
+# Keeps SQLite under its bound-parameter limit.
+BATCH_SIZE = 300
+
+
+@dataclass
+class RefreshReport:
+    rebuild: bool = False
+    # Orders counted into the co-purchase matrix.
+    orders: int = 0
+    # Matrix entries added to.
+    pairs: int = 0
+    # Products whose neighbours were rewritten.
+    products: int = 0
+    elapsed_s: float = 0.0
+
+    def summary(self):
+        return (f'{"Rebuilt" if self.rebuild else "Refreshed"} related products: {self.orders} order(s) counted, '
+                f'{self.pairs} co-purchase entries updated, {self.products} product(s) reranked '
+                f'in {self.elapsed_s:.1f}s.')
+
+
+def related_products(product, user=None, limit=SHOWN):
+    """The products to show next to ``product``, as listing cards priced for ``user``."""
+    def cards(products):
+        return list(products.filter(available=True).for_listing().with_price_for(user)[:limit])
+
+    related = cards(Product.objects.filter(neighbour_of__product=product).order_by('neighbour_of__rank'))
+    if related:
+        return related
+    # Not ranked yet (or every neighbour is unavailable).
+    return cards(Product.objects.filter(category_id=product.category_id).exclude(pk=product.pk))
+
+
+def _add_counts(counts):
+    """Add ``{(product id, other id): orders}`` to ``CoPurchase``, in key order."""
+    rows = sorted(counts.items())
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        for (product_id, other_id), orders in rows:
+            _add_count(product_id, other_id, orders)
+        return
+    qn = connection.ops.quote_name
+    table = qn(CoPurchase._meta.db_table)
+    with connection.cursor() as cursor:
+        for start in range(0, len(rows), BATCH_SIZE):
+            batch = rows[start:start + BATCH_SIZE]
+            cursor.execute(
+                f'INSERT INTO {table} ({qn("product_id")}, {qn("other_id")}, {qn("orders")}) '
+                f'VALUES {", ".join(["(%s, %s, %s)"] * len(batch))} '
+                f'ON CONFLICT ({qn("product_id")}, {qn("other_id")}) '
+                f'DO UPDATE SET {qn("orders")} = {table}.{qn("orders")} + excluded.{qn("orders")}',
+                [param for (product_id, other_id), orders in batch for param in (product_id, other_id, orders)],
+            )
+
+
+def _add_count(product_id, other_id, orders):
+    pair = CoPurchase.objects.filter(product_id=product_id, other_id=other_id)
+    if pair.update(orders=F('orders') + orders):
+        return
+    try:
+        with transaction.atomic():
+            CoPurchase.objects.create(product_id=product_id, other_id=other_id, orders=orders)
+    except IntegrityError:
+        # Another refresh created the entry first.
+        pair.update(orders=F('orders') + orders)
+
+
+def _count_orders(after_id, batch_size):
+    """
+    Add the next ``batch_size`` uncounted paid orders with an id above
+    ``after_id`` to the matrix. Returns their last id, how many there were,
+    the entries added to and the products they contain.
+    """
+    orders = Order.objects.filter(pk__gt=after_id, status__in=SALES_STATUSES).filter(
+        ~Exists(CoPurchasedOrder.objects.filter(order_id=OuterRef('pk'))))
+    with transaction.atomic():
+        if connection.features.has_select_for_update_skip_locked:
+            orders = orders.select_for_update(skip_locked=True, of=('self',))
+        order_ids = list(orders.order_by('pk').values_list('pk', flat=True)[:batch_size])
+        if not order_ids:
+            return None, 0, 0, set()
+        # One row per pair of products in the same order, including each
+        # product with itself: the batch's rows of AᵀA.
+        counts = {
+            (product_id, other_id): orders
+            for product_id, other_id, orders in OrderItem.objects.filter(order_id__in=order_ids)
+            .values('product_id', other=F('order__items__product_id'))
+            .annotate(orders=Count('order_id', distinct=True))
+            .values_list('product_id', 'other', 'orders')
+        }
+        _add_counts(counts)
+        CoPurchasedOrder.objects.bulk_create([CoPurchasedOrder(order_id=order_id) for order_id in order_ids])
+    return order_ids[-1], len(order_ids), len(counts), {product_id for product_id, _ in counts}
+
+
+class _Ranker:
+    """Writes ``RelatedProduct`` rows for batches of products."""
+
+    def __init__(self, stored):
+        self.stored = stored
+        # Category id -> its newest available products, for topping up.
+        self.newest = {}
+
+    def _newest_in(self, category_ids):
+        missing = [category_id for category_id in category_ids if category_id not in self.newest]
+        for category_id in missing:
+            self.newest[category_id] = []
+        if not missing:
+            return
+        # Enough to fill a list after skipping the product itself and its
+        # co-purchased neighbours.
+        rows = Product.objects.filter(available=True, category_id__in=missing).annotate(
+            position=Window(RowNumber(), partition_by=F('category_id'),
+                            order_by=[F('created_at').desc(), F('pk').desc()]),
+        ).filter(position__lte=2 * self.stored + 1).order_by('category_id', 'position')
+        for category_id, product_id in rows.values_list('category_id', 'pk'):
+            self.newest[category_id].append(product_id)
+
+    def rank(self, product_ids):
+        categories = dict(Product.objects.filter(pk__in=product_ids).values_list('pk', 'category_id'))
+        neighbours = {product_id: {} for product_id in categories}
+        for product_id, other_id, orders in CoPurchase.objects.filter(
+                product_id__in=list(categories)).values_list('product_id', 'other_id', 'orders'):
+            neighbours[product_id][other_id] = orders
+        others = list({other_id for row in neighbours.values() for other_id in row})
+        totals, available = {}, set()
+        for start in range(0, len(others), BATCH_SIZE):
+            chunk = others[start:start + BATCH_SIZE]
+            totals.update(CoPurchase.objects.filter(product_id__in=chunk, other_id=F('product_id'))
+                          .values_list('product_id', 'orders'))
+            available.update(Product.objects.filter(pk__in=chunk, available=True).values_list('pk', flat=True))
+        self._newest_in(set(categories.values()))
+
+        related = []
+        for product_id, category_id in categories.items():
+            row = neighbours[product_id]
+            own = row.get(product_id, 0)
+            scored = heapq.nsmallest(self.stored, (
+                (-orders / math.sqrt(own * totals[other_id]), -orders, other_id)
+                for other_id, orders in row.items()
+                if own and other_id != product_id and other_id in available and totals.get(other_id)
+            ))
+            chosen = [(other_id, -score, 'co_purchase') for score, _, other_id in scored]
+            seen = {product_id, *(other_id for other_id, _, _ in chosen)}
+            for other_id in self.newest[category_id]:
+                if len(chosen) >= self.stored:
+                    break
+                if other_id not in seen:
+                    chosen.append((other_id, 0.0, 'category'))
+            related.extend(
+                RelatedProduct(product_id=product_id, related_id=other_id, rank=rank, score=score, source=source)
+                for rank, (other_id, score, source) in enumerate(chosen or [(None, 0.0, 'none')])
+            )
+        with transaction.atomic():
+            RelatedProduct.objects.filter(product_id__in=list(categories)).delete()
+            RelatedProduct.objects.bulk_create(related)
+        return len(categories)
+
+
+def _all_products():
+    """Every product id, ``BATCH_SIZE`` at a time."""
+    after_id = 0
+    products = Product.objects.order_by('pk').values_list('pk', flat=True)
+    while batch := list(products.filter(pk__gt=after_id)[:BATCH_SIZE]):
+        yield batch
+        after_id = batch[-1]
+
+
+def _unranked():
+    return Product.objects.filter(~Exists(RelatedProduct.objects.filter(product=OuterRef('pk'))))
+
+
+def refresh(rebuild=False, batch_size=None, stored=None, progress=None):
+    """
+    Count the orders placed since the last refresh into the co-purchase
+    matrix and rerank the products they contain, plus any product never
+    ranked. ``rebuild`` recounts every order and reranks every product.
+    ``progress`` is called with a line of text after each batch.
+    """
+    batch_size = batch_size or settings.RELATED_PRODUCTS_BATCH_SIZE
+    report = RefreshReport(rebuild=rebuild)
+    start = time.perf_counter()
+    report_progress = progress or (lambda message: None)
+    if rebuild:
+        with transaction.atomic():
+            CoPurchase.objects.all().delete()
+            CoPurchasedOrder.objects.all().delete()
+
+    touched, after_id = set(), 0
+    while True:
+        after_id, orders, pairs, products = _count_orders(after_id, batch_size)
+        if not orders:
+            break
+        report.orders += orders
+        report.pairs += pairs
+        touched |= products
+        report_progress(f'{report.orders} order(s) counted, {len(touched)} product(s) to rerank.')
+
+    ranker = _Ranker(stored or settings.RELATED_PRODUCTS_STORED)
+    if rebuild:
+        to_rank = _all_products()
+    else:
+        product_ids = sorted(touched | set(_unranked().values_list('pk', flat=True)))
+        to_rank = (product_ids[offset:offset + BATCH_SIZE] for offset in range(0, len(product_ids), BATCH_SIZE))
+    for batch in to_rank:
+        report.products += ranker.rank(batch)
+        report_progress(f'{report.products} product(s) reranked.')
+    if report.products:
+        bump_generation()
+    report.elapsed_s = time.perf_counter() - start
+    return report
@@ -0,0 +1,158 @@
+"""
+Responsive renditions of product images.
+
+Uploaded images used to be sent at full resolution everywhere, so a grid
+of twelve cards could weigh tens of megabytes. Each product image is now
+resized with Pillow to the widths in ``PRODUCT_IMAGE_WIDTHS`` (never
+upscaled), in WebP and JPEG, next to the original in the same storage.
+
+What templates need is stored on ``Product.renditions``, URLs included, so
+``{% product_image %}`` emits ``<picture>``/``srcset`` markup without asking
+the storage for a URL per image:
+
+    {'source': 'products/shoe.jpg', 'width': 2400, 'height': 1600,
+     'src': '<jpeg URL>', 'srcset': {'image/webp': '<url> 240w, ...',
+     'image/jpeg': '...'}, 'files': ['products/renditions/...', ...]}
+
+Renditions are made when a product is saved with a new image (see
+``products.signals``) and in bulk by the ``generate_renditions`` command.
+``render`` only touches the storage, never the database, so the command
+can run it in worker processes.
+"""
+import hashlib
+import io
+import logging
+import os
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .cache import bump_generation_on_commit
+from .models import Product
+
+logger = logging.getLogger(__name__)
+
+RENDITION_DIR = 'products/renditions'
+# (MIME type, Pillow format, file extension, save options)
+FORMATS = (
+    ('image/webp', 'WEBP', 'webp', {'method': 4}),
+    ('image/jpeg', 'JPEG', 'jpg', {'optimize': True, 'progressive': True}),
+)
+
+
+def get_storage():
+    return Product._meta.get_field('image').storage
+
+
+def _target_widths(width):
+    widths = sorted({w for w in settings.PRODUCT_IMAGE_WIDTHS if w < width})
+    if len(widths) < len(settings.PRODUCT_IMAGE_WIDTHS):
+        # The image is narrower than some targets: add it at its own width.
+        widths.append(width)
+    return widths
+
+
+def _flatten(image):
+    """RGB for JPEG, with any transparency laid over white."""
+    if image.mode == 'RGB':
+        return image
+    if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+        rgba = image.convert('RGBA')
+        background = Image.new('RGB', rgba.size, (255, 255, 255))
+        background.paste(rgba, mask=rgba.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def render(name, storage=None):
+    """Write the renditions of the image stored as ``name`` and return their metadata."""
+    storage = storage or get_storage()
+    with storage.open(name, 'rb') as f:
+        image = Image.open(f)
+        image = ImageOps.exif_transpose(image)
+        image.load()
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA' if image.mode in ('LA', 'P') else 'RGB')
+    width, height = image.size
+
+    stem = os.path.splitext(os.path.basename(name))[0]
+    digest = hashlib.md5(name.encode()).hexdigest()[:8]
+    srcsets = {mime: [] for mime, *_ in FORMATS}
+    files = []
+    src = None
+    for target in _target_widths(width):
+        resized = image if target == width else image.resize(
+            (target, max(1, round(height * target / width))), Image.Resampling.LANCZOS, reducing_gap=3.0)
+        for mime, image_format, extension, options in FORMATS:
+            buffer = io.BytesIO()
+            (_flatten(resized) if image_format == 'JPEG' else resized).save(
+                buffer, image_format, quality=settings.PRODUCT_IMAGE_QUALITY, **options)
+            path = f'{RENDITION_DIR}/{stem}-{digest}-{target}.{extension}'
+            if storage.exists(path):
+                storage.delete(path)
+            path = storage.save(path, ContentFile(buffer.getvalue()))
+            url = storage.url(path)
+            files.append(path)
+            srcsets[mime].append(f'{url} {target}w')
+            if image_format == 'JPEG' and (src is None or target <= settings.PRODUCT_IMAGE_DEFAULT_WIDTH):
+                src = url
+    return {
+        'source': name,
+        'width': width,
+        'height': height,
+        'src': src,
+        'srcset': {mime: ', '.join(entries) for mime, entries in srcsets.items()},
+        'files': files,
+    }
+
+
+def delete_files(names, storage=None):
+    storage = storage or get_storage()
+    for name in names:
+        try:
+            storage.delete(name)
+        except Exception:
+            logger.warning('Could not delete rendition %s', name, exc_info=True)
+
+
+def save(product_id, source, metadata):
+    """
+    Store ``metadata`` on the product if its image is still ``source``, and
+    delete rendition files it no longer uses. Returns whether it was stored.
+    """
+    storage = get_storage()
+    with transaction.atomic():
+        current = (Product.objects.select_for_update().filter(pk=product_id)
+                   .values_list('image', 'renditions').first())
+        if current is None or current[0] != source:
+            delete_files(metadata['files'], storage)
+            return False
+        Product.objects.filter(pk=product_id).update(renditions=metadata)
+        bump_generation_on_commit()
+    stale = set(current[1].get('files', ())) - set(metadata['files'])
+    delete_files(stale, storage)
+    return True
+
+
+def update_product(product_id):
+    """Bring one product's renditions in line with its current image."""
+    current = Product.objects.filter(pk=product_id).values_list('image', 'renditions').first()
+    if current is None:
+        return
+    name, renditions = current
+    if not name:
+        if renditions:
+            Product.objects.filter(pk=product_id).update(renditions={})
+            bump_generation_on_commit()
+            delete_files(renditions.get('files', ()))
+        return
+    if renditions.get('source') == name:
+        return
+    try:
+        metadata = render(name)
+    except Exception:
+        logger.exception('Could not render product %s image %s', product_id, name)
+        return
+    save(product_id, name, metadata)
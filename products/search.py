@@ -0,0 +1,315 @@
+"""
+Full-text product search over name, category name and description, weighted
+in that order.
+
+The index lives in a table next to ``products_product``, created by
+migration 0005, and only holds available products:
+
+* PostgreSQL: ``products_search`` holds one weighted ``tsvector`` per
+  product under a GIN index. Queries are ranked with ``ts_rank_cd``.
+  ``products_search_heading`` (migration 0011) repeats the name and
+  category part in narrow rows under its own GIN index, for the name and
+  category tiers below.
+* SQLite: ``products_search_fts`` is an FTS5 table keyed by product id.
+  Queries use ``MATCH`` and are ranked with ``bm25``.
+* Other backends fall back to unranked ``icontains`` filtering.
+
+Words are ANDed. Every match is ranked by where its words are, as the
+column weights would rank it: all in the name first, then all in the name
+or category, then the rest (a weighted rank cutoff). So a broad query
+("soil" in a soil shop) returns the products named after it, not the
+newest ones that mention it. Tiers of at most ``PRODUCT_SEARCH_SCORE_LIMIT``
+matches are ordered by ``bm25``/``ts_rank_cd``; a larger tier is listed
+newest first instead, since scoring costs time per match (about 3µs a row
+on SQLite). On SQLite, words in more than half the index are left out of
+``bm25``, which gives them no weight but would count every row they are
+in. The index engine produces the ranked ids, at most
+``PRODUCT_SEARCH_MAX_RESULTS`` of them; product rows are then fetched a
+page at a time by primary key.
+
+Products are reindexed after each committed save (see ``products.signals``).
+Bulk writes bypass signals, so ``rebuild_index`` (the
+``rebuild_search_index`` command) or ``index_products`` must follow them.
+"""
+import re
+from collections.abc import Sequence
+
+from django.conf import settings
+from django.db import connection, connections, router
+from django.db.models import Q
+
+from .models import Product
+
+TEXT_SEARCH_CONFIG = 'english'
+SEARCH_TABLE = 'products_search'
+HEADING_TABLE = 'products_search_heading'
+FTS_TABLE = 'products_search_fts'
+# Column weights for bm25, matching the A/B/C weights of the tsvector.
+FTS_WEIGHTS = (10.0, 4.0, 1.0)
+# Keeps SQLite under its bound-parameter limit.
+BATCH_SIZE = 500
+
+_SOURCE = (
+    'FROM products_product p JOIN products_category c ON c.id = p.category_id'
+)
+_HEADING = (
+    "setweight(to_tsvector(%(config)s, p.name), 'A') || "
+    "setweight(to_tsvector(%(config)s, c.name), 'B')"
+)
+_TSVECTOR = _HEADING + " || setweight(to_tsvector(%(config)s, p.description), 'C')"
+
+
+def _index(where, params):
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            config = {'config': f"'{TEXT_SEARCH_CONFIG}'"}
+            for table, column, tsvector in ((SEARCH_TABLE, 'document', _TSVECTOR % config),
+                                            (HEADING_TABLE, 'heading', _HEADING % config)):
+                cursor.execute(
+                    f'DELETE FROM {table} WHERE product_id IN '
+                    f'(SELECT p.id {_SOURCE} WHERE {where} AND NOT p.available)',
+                    params,
+                )
+                # In id order, so a rebuild lays rows out the way newest-first
+                # listings read them.
+                cursor.execute(
+                    f'INSERT INTO {table} (product_id, {column}) '
+                    f'SELECT p.id, {tsvector} {_SOURCE} WHERE {where} AND p.available ORDER BY p.id '
+                    f'ON CONFLICT (product_id) DO UPDATE SET {column} = EXCLUDED.{column}',
+                    params,
+                )
+        elif connection.vendor == 'sqlite':
+            cursor.execute(
+                f'DELETE FROM {FTS_TABLE} WHERE rowid IN (SELECT p.id {_SOURCE} WHERE {where})', params,
+            )
+            cursor.execute(
+                f'INSERT INTO {FTS_TABLE} (rowid, name, category, description) '
+                f'SELECT p.id, p.name, c.name, p.description {_SOURCE} WHERE {where} AND p.available',
+                params,
+            )
+
+
+def index_products(product_ids):
+    """Add or refresh the index entries of the given products."""
+    product_ids = list(product_ids)
+    for start in range(0, len(product_ids), BATCH_SIZE):
+        batch = product_ids[start:start + BATCH_SIZE]
+        _index(f'p.id IN ({", ".join(["%s"] * len(batch))})', batch)
+
+
+def index_category(category_id):
+    """Refresh every product of a category, e.g. after it is renamed."""
+    _index('p.category_id = %s', [category_id])
+
+
+def remove_products(product_ids):
+    product_ids = list(product_ids)
+    if connection.vendor not in ('postgresql', 'sqlite'):
+        return
+    # The index tables have no foreign key to products_product (so it can be
+    # truncated); rows of deleted products only go here.
+    if connection.vendor == 'postgresql':
+        tables = [(SEARCH_TABLE, 'product_id'), (HEADING_TABLE, 'product_id')]
+    else:
+        tables = [(FTS_TABLE, 'rowid')]
+    with connection.cursor() as cursor:
+        for start in range(0, len(product_ids), BATCH_SIZE):
+            batch = product_ids[start:start + BATCH_SIZE]
+            for table, key in tables:
+                cursor.execute(f'DELETE FROM {table} WHERE {key} IN ({", ".join(["%s"] * len(batch))})', batch)
+
+
+def rebuild_index():
+    """Reindex every product from scratch; returns the number of entries."""
+    with connection.cursor() as cursor:
+        if connection.vendor == 'postgresql':
+            cursor.execute(f'TRUNCATE {SEARCH_TABLE}, {HEADING_TABLE}')
+            _index('TRUE', [])
+            cursor.execute(f'ANALYZE {SEARCH_TABLE}, {HEADING_TABLE}')
+            cursor.execute(f'SELECT COUNT(*) FROM {SEARCH_TABLE}')
+        elif connection.vendor == 'sqlite':
+            cursor.execute(f'DELETE FROM {FTS_TABLE}')
+            _index('1', [])
+            cursor.execute(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')")
+            cursor.execute(f'SELECT COUNT(*) FROM {FTS_TABLE}')
+        else:
+            return 0
+        return cursor.fetchone()[0]
+
+
+def _tiers(words, vendor):
+    """
+    ``(table, match, params)`` per tier, best first: a condition on an
+    index table matching the products whose words are all in the tier's
+    columns. Each tier contains the ones before it.
+    """
+    if vendor == 'postgresql':
+        # Weight labels restrict lexemes to the name (A) or category (B).
+        # GIN can't check weights, so PostgreSQL rechecks every candidate
+        # row; the name and category tiers read the narrow heading rows
+        # instead of the whole document.
+        queries = [' & '.join(f"'{word}'{weights}" for word in words) for weights in (':A', ':AB', '')]
+        return [
+            (HEADING_TABLE, 'heading @@ to_tsquery(%s, %s)', [TEXT_SEARCH_CONFIG, queries[0]]),
+            (HEADING_TABLE, 'heading @@ to_tsquery(%s, %s)', [TEXT_SEARCH_CONFIG, queries[1]]),
+            (SEARCH_TABLE, 'document @@ to_tsquery(%s, %s)', [TEXT_SEARCH_CONFIG, queries[2]]),
+        ]
+    phrases = ' '.join(f'"{word}"' for word in words)
+    queries = [f'{{name}} : ({phrases})', f'{{name category}} : ({phrases})', f'({phrases})']
+    return [(FTS_TABLE, f'{FTS_TABLE} MATCH %s', [query]) for query in queries]
+
+
+def _excluding(tier, previous, vendor):
+    """``tier`` without the products of ``previous``."""
+    (table, match, params), (_, _, previous_params) = tier, previous
+    if vendor == 'postgresql':
+        # The weighted query of the previous tier means the same on either
+        # vector, so it's checked against this tier's.
+        return f'{match} AND NOT {match}', [*params, *previous_params]
+    return match, [f'{params[0]} NOT {previous_params[0]}']
+
+
+def _bm25_words(cursor, words, tier, limit):
+    """
+    The words to score tier number ``tier`` with on SQLite. bm25 counts the
+    rows matching each word, which for a word in most of the index costs
+    more than the rest of the search, yet FTS5 floors the IDF of a word in
+    more than half the rows at 1e-6: it adds nothing to the score. Such
+    words are left out while another word matches at most ``limit`` rows,
+    so what the rest match is still small enough to score. A word's share
+    is judged over the newest ``2 * limit`` rows.
+    """
+    if len(words) < 2:
+        return words
+    for word in words:
+        cursor.execute(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s LIMIT 1 OFFSET %s',
+                       [f'"{word}"', limit])
+        if cursor.fetchone() is None:
+            break
+    else:
+        return words
+    window = 2 * limit
+    cursor.execute(f'SELECT rowid FROM {FTS_TABLE} ORDER BY rowid DESC LIMIT 1 OFFSET %s', [window - 1])
+    row = cursor.fetchone()
+    if row is None:
+        return words
+    kept = []
+    for word in words:
+        _, match, params = _tiers([word], 'sqlite')[tier]
+        cursor.execute(f'SELECT COUNT(*) FROM {FTS_TABLE} WHERE {match} AND rowid >= %s', [*params, row[0]])
+        if cursor.fetchone()[0] * 2 <= window:
+            kept.append(word)
+    return kept
+
+
+def ranked_ids(query):
+    """
+    Ids of the best matches for ``query``, best first. Returns the ids and
+    whether the result was cut short by the result cap.
+    """
+    limit = settings.PRODUCT_SEARCH_MAX_RESULTS
+    score_limit = settings.PRODUCT_SEARCH_SCORE_LIMIT
+    words = re.findall(r'\w+', query)
+    if not words:
+        return [], False
+    # The index is replicated with the products it covers.
+    database = connections[router.db_for_read(Product)]
+    if database.vendor not in ('postgresql', 'sqlite'):
+        condition = Q()
+        for word in words:
+            condition &= (Q(name__icontains=word) | Q(description__icontains=word)
+                          | Q(category__name__icontains=word))
+        ids = list(Product.objects.filter(condition, available=True)
+                   .order_by('-created_at', '-id').values_list('id', flat=True)[:limit + 1])
+        return ids[:limit], len(ids) > limit
+
+    key = 'product_id' if database.vendor == 'postgresql' else 'rowid'
+    tiers = _tiers(words, database.vendor)
+    members = []
+    ids = []
+    with database.cursor() as cursor:
+        # Only as many rows as it takes to tell whether a tier is small enough
+        # to score. The first tier is read newest first, so when it's too
+        # large to score (any common word) the probe is already its listing.
+        listed = None
+        for number, (table, match, params) in enumerate(tiers):
+            if number:
+                cursor.execute(f'SELECT {key} FROM {table} WHERE {match} LIMIT %s', [*params, score_limit + 1])
+            else:
+                cursor.execute(f'SELECT {key} FROM {table} WHERE {match} ORDER BY {key} DESC LIMIT %s',
+                               [*params, max(score_limit, limit) + 1])
+            rows = [row[0] for row in cursor.fetchall()]
+            if len(rows) > score_limit:
+                if not number:
+                    listed = rows
+                break
+            members.append(set(rows))
+        if members:
+            # The largest scorable tier is scored once; scoring the ones it
+            # contains separately would repeat bm25's per-word document
+            # counts, which are slow for common words.
+            table, match, params = tiers[len(members) - 1]
+            if database.vendor == 'postgresql':
+                # Its members are known, so only their documents are read.
+                cursor.execute(
+                    f'SELECT product_id FROM {SEARCH_TABLE} WHERE product_id = ANY(%s) '
+                    f'ORDER BY ts_rank_cd(document, to_tsquery(%s, %s)) DESC, product_id DESC',
+                    [sorted(members[-1]), *params],
+                )
+            else:
+                # Without the words bm25 ignores, this can match more than
+                # the tier; the extra rows are dropped below.
+                _, match, params = _tiers(_bm25_words(cursor, words, len(members) - 1, score_limit),
+                                          database.vendor)[len(members) - 1]
+                weights = ', '.join(str(w) for w in FTS_WEIGHTS)
+                cursor.execute(f'SELECT rowid FROM {FTS_TABLE} WHERE {match} '
+                               f'ORDER BY bm25({FTS_TABLE}, {weights}), rowid DESC LIMIT %s',
+                               [*params, score_limit])
+            scored = [row[0] for row in cursor.fetchall() if row[0] in members[-1]]
+            ids = sorted(scored, key=lambda product_id: next(
+                number for number, found in enumerate(members) if product_id in found
+            ))
+        if listed is not None:
+            ids = listed
+        # One extra row tells whether anything was left out.
+        for number in range(len(members) + (listed is not None), len(tiers)):
+            wanted = limit + 1 - len(ids)
+            if wanted <= 0:
+                break
+            table, match, params = tiers[number]
+            if number:
+                match, params = _excluding(tiers[number], tiers[number - 1], database.vendor)
+            cursor.execute(f'SELECT {key} FROM {table} WHERE {match} ORDER BY {key} DESC LIMIT %s',
+                           [*params, wanted])
+            ids.extend(row[0] for row in cursor.fetchall())
+    return ids[:limit], len(ids) > limit
+
+
+class SearchResults(Sequence):
+    """
+    Ranked matches, as a sequence a ``Paginator`` can slice. Only the
+    sliced page is loaded, through ``queryset`` so its annotations (such as
+    ``tier_price``) apply.
+    """
+
+    def __init__(self, queryset, ids, truncated=False):
+        self.queryset = queryset
+        self.ids = ids
+        self.truncated = truncated
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        ids = self.ids[index]
+        products = self.queryset.in_bulk(ids)
+        # Products deleted or hidden since they were indexed are skipped.
+        return [products[product_id] for product_id in ids if product_id in products]
+
+
+def search(queryset, query):
+    """Products of ``queryset`` matching ``query``, best match first."""
+    ids, truncated = ranked_ids(query.strip())
+    return SearchResults(queryset, ids, truncated)
@@ -0,0 +1,74 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from . import facets, renditions, search
+from .cache import bump_generation_on_commit
+from .models import Category, Color, Product, Size
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=Size)
+@receiver(post_delete, sender=Size)
+@receiver(post_save, sender=Color)
+@receiver(post_delete, sender=Color)
+@receiver(m2m_changed, sender=Product.sizes.through)
+@receiver(m2m_changed, sender=Product.colors.through)
+def invalidate_catalog_cache(sender, **kwargs):
+    bump_generation_on_commit()
+
+
+@receiver(post_save, sender=Product)
+def reindex_product(sender, instance, **kwargs):
+    transaction.on_commit(lambda: search.index_products([instance.pk]))
+
+
+@receiver(post_delete, sender=Product)
+def unindex_product(sender, instance, **kwargs):
+    product_id = instance.pk
+    transaction.on_commit(lambda: search.remove_products([product_id]))
+
+
+@receiver(post_save, sender=Category)
+def reindex_category(sender, instance, created, **kwargs):
+    if not created:
+        transaction.on_commit(lambda: search.index_category(instance.pk))
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+def record_product_facets(sender, instance, **kwargs):
+    facets.record_changes([instance.pk])
+
+
+@receiver(m2m_changed, sender=Product.sizes.through)
+@receiver(m2m_changed, sender=Product.colors.through)
+def record_link_facets(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        facets.record_changes([instance.pk])
+    elif action == 'pre_clear':
+        # Clearing a size or color's products doesn't say which they were.
+        facets.record_changes(instance.product_set.values_list('pk', flat=True))
+    else:
+        facets.record_changes(pk_set)
+
+
+@receiver(post_save, sender=Product)
+def render_product_image(sender, instance, **kwargs):
+    if {'image', 'renditions'} & instance.get_deferred_fields():
+        return
+    if (instance.image.name or None) != instance.renditions.get('source'):
+        product_id = instance.pk
+        transaction.on_commit(lambda: renditions.update_product(product_id))
+
+
+@receiver(post_delete, sender=Product)
+def delete_product_renditions(sender, instance, **kwargs):
+    files = instance.__dict__.get('renditions', {}).get('files', ())
+    if files:
+        transaction.on_commit(lambda: renditions.delete_files(files))
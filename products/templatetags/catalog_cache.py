@@ -0,0 +1,41 @@
+from django import template
+
+from products.cache import CSRF_SENTINEL
+
+register = template.Library()
+
+
+class CatalogFragmentNode(template.Node):
+    def __init__(self, name, nodelist):
+        self.name = name
+        self.nodelist = nodelist
+
+    def render(self, context):
+        page = context.get('catalog_page')
+        if page is None:
+            return self.nodelist.render(context)
+        if page.hit:
+            html = page.fragments.get(self.name, '')
+        else:
+            # Render with a placeholder token so the fragment can be shared.
+            with context.push(csrf_token=CSRF_SENTINEL):
+                html = self.nodelist.render(context)
+            page.rendered[self.name] = html
+        if CSRF_SENTINEL in html:
+            html = html.replace(CSRF_SENTINEL, str(context.get('csrf_token', '')))
+        return html
+
+
+@register.tag
+def catalog_fragment(parser, token):
+    """
+    Cache the enclosed markup per catalog page and pricing tier:
+
+        {% catalog_fragment "content" %}...{% endcatalog_fragment %}
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' takes a fragment name.")
+    nodelist = parser.parse(('endcatalog_fragment',))
+    parser.delete_first_token()
+    return CatalogFragmentNode(bits[1].strip('"\''), nodelist)
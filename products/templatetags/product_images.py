@@ -0,0 +1,26 @@
+from django import template
+
+register = template.Library()
+
+
+@register.inclusion_tag('components/product_image.html')
+def product_image(product, sizes='100vw', css_class='', loading='lazy'):
+    """
+    ``<picture>`` markup for a product image from its stored renditions,
+    falling back to the original until they exist:
+
+        {% product_image product sizes="(min-width: 1024px) 25vw, 100vw" css_class="w-full h-full" %}
+    """
+    renditions = product.renditions or {}
+    if renditions.get('source') != product.image.name:
+        renditions = {}
+    srcset = renditions.get('srcset', {})
+    return {
+        'product': product,
+        'renditions': renditions,
+        'webp_srcset': srcset.get('image/webp'),
+        'jpeg_srcset': srcset.get('image/jpeg'),
+        'sizes': sizes,
+        'css_class': css_class,
+        'loading': loading,
+    }
@@ -0,0 +1,577 @@
+import io
+import shutil
+import tempfile
+from decimal import Decimal
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.template import Context, Template
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import include, path, reverse
+from PIL import Image
+
+from marketplace.management.commands import bench_facets
+from marketplace.testing import LOCAL_CACHE, ConditionalGetTestsMixin
+from orders.models import Order, OrderItem
+from . import facets, imports, related, renditions, views
+from .cache import bump_generation
+from .facets import get_index, reset_index, warm_up
+from .models import PRICE_TIER_MULTIPLIERS, Category, Color, CoPurchase, Product, RelatedProduct, Size
+from .search import index_products, ranked_ids
+
+# The site with its catalog pages routed as under ASGI (ASYNC_VIEWS).
+urlpatterns = [
+    path('products/', views.AsyncProductListView.as_view(), name='product_list'),
+    path('products/<slug:slug>/', views.AsyncProductDetailView.as_view(), name='product_detail'),
+    path('', include('marketplace.urls')),
+]
+
+# Prices whose tier price needs every decimal place: cents that don't divide
+# evenly, the smallest and largest prices the field holds, and whole ones.
+EDGE_PRICES = ['0.01', '0.03', '0.05', '0.15', '0.99', '1.00', '19.99', '33.33', '1234.56', '99999999.99']
+
+
+class TierPriceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Pots', slug='pots')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Pot {i}', slug=f'pot-{i}', description='Clay pot', price=Decimal(price), category=category)
+            for i, price in enumerate(EDGE_PRICES)
+        ])
+        User = get_user_model()
+        cls.users = {
+            'guest': AnonymousUser(),
+            'normal': User.objects.create_user(username='normal', password=None, user_type='normal'),
+            'business': User.objects.create_user(username='business', password=None, user_type='business'),
+        }
+
+    def test_annotation_matches_get_price(self):
+        for tier, user in self.users.items():
+            annotated = dict(Product.objects.with_price_for(user).values_list('pk', 'tier_price'))
+            for product in self.products:
+                with self.subTest(tier=tier, price=product.price):
+                    expected = product.get_price(user)
+                    self.assertEqual(annotated[product.pk], expected)
+                    # Same exponent too, so templates format both alike.
+                    self.assertEqual(str(annotated[product.pk]), str(expected))
+
+    def test_no_user_is_a_guest(self):
+        annotated = dict(Product.objects.with_price_for(None).values_list('pk', 'tier_price'))
+        for product in self.products:
+            self.assertEqual(annotated[product.pk], product.get_price(self.users['guest']))
+
+    def test_sorting_and_filtering_on_the_tier_price(self):
+        for tier, user in self.users.items():
+            with self.subTest(tier=tier):
+                products = Product.objects.with_price_for(user)
+                self.assertEqual(
+                    list(products.order_by('tier_price', 'pk').values_list('pk', flat=True)),
+                    [p.pk for p in sorted(self.products, key=lambda p: (p.get_price(user), p.pk))],
+                )
+                limit = self.products[3].get_price(user)
+                self.assertCountEqual(
+                    products.filter(tier_price__lte=limit).values_list('pk', flat=True),
+                    [p.pk for p in self.products if p.get_price(user) <= limit],
+                )
+
+
+@override_settings(CATALOG_CACHE_TIMEOUT=0)
+class CatalogQueryCountTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        categories = [Category.objects.create(name=f'Category {i}', slug=f'category-{i}') for i in range(2)]
+        cls.sizes = sizes = [Size.objects.create(name=name) for name in ('S', 'M', 'L')]
+        colors = [Color.objects.create(name=name) for name in ('Red', 'Blue')]
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Pot {i}', slug=f'pot-{i}', description='Clay pot', price=Decimal('10.00') + i,
+                    category=categories[i % 2])
+            for i in range(40)
+        ])
+        for i, product in enumerate(cls.products):
+            product.sizes.set(sizes[:1 + i % 3])
+            product.colors.set(colors[:1 + i % 2])
+
+    def setUp(self):
+        cache.clear()
+        # The facet index is per process; build it before counting queries.
+        reset_index()
+        get_index()
+
+    def test_product_list_page(self):
+        # Categories, sizes and colors for the filters, and the page itself.
+        for query in ({}, {'page': 2}, {'sort': 'price_low_to_high'}, {'sort': 'name_a_to_z', 'size': self.sizes[0].pk}):
+            with self.subTest(**query), self.assertNumQueries(4):
+                response = self.client.get(reverse('product_list'), query, secure=True)
+            self.assertEqual(len(response.context['products']), 12)
+
+    def test_product_list_by_category(self):
+        # Plus the category lookup.
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('product_list_by_category', args=['category-1']), secure=True)
+        self.assertEqual(len(response.context['products']), 12)
+
+    def test_index_is_built_before_the_first_listing(self):
+        reset_index()
+        self.assertEqual(len(warm_up().positions), len(self.products))
+        with self.assertNumQueries(4):
+            self.client.get(reverse('product_list'), secure=True)
+
+    @override_settings(PRODUCT_FACET_WARM_UP=False)
+    def test_warm_up_can_be_turned_off(self):
+        reset_index()
+        self.assertIsNone(warm_up())
+        self.assertIsNone(facets._index)
+
+    def test_product_detail(self):
+        related.refresh()
+        # The product, its sizes, its colors and its related products.
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('product_detail', args=['pot-3']), secure=True)
+        self.assertEqual(len(response.context['related_products']), related.SHOWN)
+
+
+class FacetCountTests(TestCase):
+    """The facet index's counts against GROUP BY, as bench_facets checks them."""
+
+    @classmethod
+    def setUpTestData(cls):
+        # Products already in the catalog, one without sizes or colors.
+        category = Category.objects.create(name='Existing', slug='existing')
+        existing = Product.objects.bulk_create([
+            Product(name=f'Existing {i}', slug=f'existing-{i}', description='Old', price=Decimal('20.00'),
+                    category=category, stock=5)
+            for i in range(2)
+        ])
+        existing[0].sizes.add(Size.objects.create(name='XL'))
+        bench = bench_facets.Command(stdout=io.StringIO())
+        bench.seed({'products': 300, 'categories': 4, 'sizes': 5, 'colors': 5})
+        cls.seeded = {name: getattr(bench, name) for name in ('categories', 'sizes', 'colors')}
+
+    def setUp(self):
+        self.bench = bench_facets.Command()
+        self.bench.__dict__.update(self.seeded)
+
+    def test_index_counts_match_group_by(self):
+        self.assertTrue(Product.objects.filter(sizes__isnull=True, category__in=self.bench.categories).exists())
+        self.assertTrue(Product.objects.filter(colors__isnull=True, category__in=self.bench.categories).exists())
+        index = facets.FacetIndex.build(generation=0)
+        base = Product.objects.filter(available=True).with_price_for(None)
+        seeded = base.filter(category__in=self.bench.categories)
+        for name, filters in self.bench.combinations():
+            with self.subTest(name):
+                result = index.search(filters, PRICE_TIER_MULTIPLIERS['guest'])
+                self.assertEqual(self.bench.differing_facets(result, self.bench.group_by_counts(filters, seeded)), [])
+                self.assertEqual(result.total, filters.apply(base).count())
+
+
+class SearchRankingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Plants', slug='plants')
+        # The best match is the oldest product; many newer ones only mention it.
+        cls.products = Product.objects.bulk_create([
+            Product(name='Boston fern', slug='boston-fern', description='A leafy houseplant', price=Decimal('12.00'),
+                    category=category),
+            *(Product(name=f'Planter {i}', slug=f'planter-{i}', description='Fits a small fern', price=Decimal('9.00'),
+                      category=category) for i in range(30)),
+            Product(name='Hidden fern', slug='hidden-fern', description='Fern', price=Decimal('9.00'),
+                    category=category, available=False),
+        ])
+        index_products(product.pk for product in cls.products)
+
+    @override_settings(PRODUCT_SEARCH_MAX_RESULTS=10)
+    def test_best_match_wins_however_many_newer_matches(self):
+        ids, truncated = ranked_ids('fern')
+        self.assertEqual(ids[0], self.products[0].pk)
+        self.assertEqual(len(ids), 10)
+        self.assertTrue(truncated)
+
+    def test_every_available_match_is_returned(self):
+        ids, truncated = ranked_ids('fern')
+        self.assertCountEqual(ids, [product.pk for product in self.products[:-1]])
+        self.assertFalse(truncated)
+        # Words are ANDed.
+        self.assertCountEqual(ranked_ids('fern planter')[0], [product.pk for product in self.products[1:-1]])
+        self.assertEqual(ranked_ids(' ?! '), ([], False))
+
+    @override_settings(PRODUCT_SEARCH_SCORE_LIMIT=5)
+    def test_name_matches_come_before_a_tier_too_large_to_score(self):
+        ids, truncated = ranked_ids('fern')
+        planters = sorted((product.pk for product in self.products[1:-1]), reverse=True)
+        self.assertEqual(ids, [self.products[0].pk, *planters])
+        self.assertFalse(truncated)
+
+    @skipUnless(connection.vendor == 'sqlite', 'ranked with bm25')
+    @override_settings(PRODUCT_SEARCH_SCORE_LIMIT=2)
+    def test_words_in_most_products_are_left_out_of_bm25(self):
+        ivy = Product.objects.create(name='Boston ivy', slug='boston-ivy', description='Climbs walls',
+                                     price=Decimal('9.00'), category=self.products[0].category)
+        index_products([ivy.pk])
+        # "fern" is in three of the four newest products, so only "boston"
+        # is scored; ivy matches that alone and is dropped.
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(ranked_ids('fern boston'), ([self.products[0].pk], False))
+        [scoring] = [query['sql'] for query in queries if 'bm25' in query['sql']]
+        self.assertIn("""MATCH '("boston")'""", scoring)
+
+
+class RelatedProductsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.plants = Category.objects.create(name='Plants', slug='plants')
+        cls.fern, cls.pot, cls.soil, cls.cold, cls.old = (
+            Product.objects.create(name=name.title(), slug=name, description='', price=Decimal('10.00'),
+                                   category=cls.plants)
+            for name in ('fern', 'pot', 'soil', 'cold', 'old')
+        )
+        cls.hidden = Product.objects.create(name='Hidden', slug='hidden', description='', price=Decimal('10.00'),
+                                            category=cls.plants, available=False)
+        tools = Category.objects.create(name='Tools', slug='tools')
+        cls.trowel = Product.objects.create(name='Trowel', slug='trowel', description='', price=Decimal('10.00'),
+                                            category=tools)
+        # Fern is bought with soil twice and with the pot once, but soil
+        # also sells on its own, so the pot is the closer neighbour:
+        # 1 / sqrt(3 * 1) for the pot against 2 / sqrt(3 * 7) for soil.
+        for products in ([cls.fern, cls.pot], [cls.fern, cls.soil], [cls.fern, cls.soil], *[[cls.soil]] * 5):
+            cls.order(products)
+
+    @staticmethod
+    def order(products, status='processing'):
+        order = Order.objects.create(email='buyer@example.com', full_name='Buyer', address='Street 1',
+                                     status=status, total_amount=Decimal('10.00'))
+        for product in products:
+            OrderItem.objects.create(order=order, product=product, price=product.price)
+        return order
+
+    def neighbours(self, product):
+        return list(RelatedProduct.objects.filter(product=product).values_list('related_id', 'source'))
+
+    def test_neighbours_are_ranked_by_cosine_similarity(self):
+        related.refresh(stored=2)
+        rows = list(RelatedProduct.objects.filter(product=self.fern))
+        self.assertEqual([(row.related_id, row.source) for row in rows],
+                         [(self.pot.pk, 'co_purchase'), (self.soil.pk, 'co_purchase')])
+        self.assertAlmostEqual(rows[0].score, 1 / 3 ** 0.5)
+        self.assertAlmostEqual(rows[1].score, 2 / 21 ** 0.5)
+
+    def test_cold_products_are_topped_up_from_their_category(self):
+        related.refresh(stored=4)
+        # Newest first, without the product itself, unavailable products or other categories.
+        self.assertEqual(self.neighbours(self.cold), [
+            (self.old.pk, 'category'), (self.soil.pk, 'category'), (self.pot.pk, 'category'),
+            (self.fern.pk, 'category'),
+        ])
+        # Co-purchased neighbours come first, and aren't repeated.
+        self.assertEqual(self.neighbours(self.pot), [
+            (self.fern.pk, 'co_purchase'), (self.old.pk, 'category'), (self.cold.pk, 'category'),
+            (self.soil.pk, 'category'),
+        ])
+
+    def test_refresh_only_counts_new_paid_orders(self):
+        self.assertEqual(related.refresh().orders, 8)
+        self.order([self.pot, self.soil], status='pending')
+        self.order([self.pot, self.soil], status='cancelled')
+        self.order([self.pot, self.soil])
+        report = related.refresh()
+        self.assertEqual((report.orders, report.products), (1, 2))
+        self.assertEqual(CoPurchase.objects.get(product_id=self.pot.pk, other_id=self.soil.pk).orders, 1)
+        self.assertEqual(CoPurchase.objects.get(product_id=self.soil.pk, other_id=self.soil.pk).orders, 8)
+        report = related.refresh()
+        self.assertEqual((report.orders, report.products), (0, 0))
+
+    def test_products_without_neighbours_are_only_ranked_once(self):
+        report = related.refresh()
+        self.assertEqual(report.products, 7)
+        self.assertEqual(self.neighbours(self.trowel), [(None, 'none')])
+        self.assertEqual(related.related_products(self.trowel), [])
+        self.assertEqual(related.refresh().products, 0)
+
+    def test_page_falls_back_to_the_category_when_no_neighbour_is_available(self):
+        related.refresh(stored=2)
+        Product.objects.filter(pk__in=[self.pot.pk, self.soil.pk]).update(available=False)
+        self.assertCountEqual([product.pk for product in related.related_products(self.fern)],
+                              [self.cold.pk, self.old.pk])
+
+    def test_page_reads_its_neighbours_in_one_query(self):
+        related.refresh(stored=2)
+        with self.assertNumQueries(1):
+            shown = related.related_products(self.fern)
+        self.assertEqual([product.pk for product in shown], [self.pot.pk, self.soil.pk])
+
+
+class ProductImportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = get_user_model().objects.create_superuser(username='admin', password=None)
+
+    def csv(self, rows):
+        return ''.join(['slug,name,description,price,category\n', *rows]).encode()
+
+    @mock.patch.object(imports, 'REPORT_LIMIT', 3)
+    def test_report_lists_the_first_skipped_rows(self):
+        # New products without a price are skipped.
+        rows = [f'pot-{i},Pot {i},Clay pot,,Pots\n' for i in range(10)]
+        report = imports.import_products(SimpleUploadedFile('pots.csv', self.csv(rows)), batch_size=4)
+        self.assertEqual(report.skipped, 10)
+        self.assertEqual([line for line, _ in report.errors], [2, 3, 4])
+        self.assertIn('10 row(s) skipped', report.summary())
+
+    def test_out_of_range_stock_skips_the_row(self):
+        csv = (b'slug,name,price,category,stock\n'
+               b'big,Big pot,9.99,Pots,99999999999999999999\n'
+               b'max,Max pot,9.99,Pots,2147483647\n'
+               b'neg,Negative pot,9.99,Pots,-1\n')
+        report = imports.import_products(SimpleUploadedFile('pots.csv', csv))
+        self.assertEqual(report.created, 1)
+        self.assertEqual([(line, message.split(':')[0]) for line, message in report.errors],
+                         [(2, 'stock'), (4, 'stock')])
+        self.assertEqual(Product.objects.get().stock, 2147483647)
+
+    def test_names_taken_by_other_products_get_suffixed_slugs(self):
+        category = Category.objects.create(name='Pots', slug='pots')
+        Product.objects.create(name='Planter', slug='pot', price=1, category=category)
+        header = 'slug,name,price,category,sizes\n'
+        rows = ['vase,Vase,2.00,Pots,S|M\n', ',Vase!,3.00,Pots,\n', ',Pot,4.00,Pots,\n', ',Pot 2,5.00,Pots,\n']
+        report = imports.import_products(SimpleUploadedFile('pots.csv', ''.join([header, *rows]).encode()))
+        self.assertEqual((report.created, report.skipped), (4, 0))
+        products = {product.slug: product for product in Product.objects.prefetch_related('sizes')}
+        self.assertEqual({slug: product.name for slug, product in products.items()},
+                         {'pot': 'Planter', 'vase': 'Vase', 'vase-2': 'Vase!', 'pot-2': 'Pot', 'pot-2-2': 'Pot 2'})
+        vase = products['vase']
+        self.assertEqual((vase.stock, vase.available, vase.description), (1, True, ''))
+        self.assertIsNotNone(vase.created_at)
+        self.assertEqual(sorted(size.name for size in vase.sizes.all()), ['M', 'S'])
+
+        # Named rows find their suffixed product again, in one query per batch.
+        rows = [',Pot,6.00,Pots,\n', ',Vase,7.00,Pots,\n']
+        with CaptureQueriesContext(connection) as queries:
+            report = imports.import_products(SimpleUploadedFile('pots.csv', ''.join([header, *rows]).encode()))
+        self.assertEqual((report.created, report.updated), (0, 2))
+        self.assertEqual(Product.objects.get(slug='pot-2').price, Decimal('6.00'))
+        self.assertEqual(Product.objects.get(slug='vase').price, Decimal('7.00'))
+        self.assertEqual(sum('LIKE' in query['sql'] for query in queries.captured_queries), 1)
+
+    def test_admin_imports_in_the_request_without_a_pool(self):
+        rows = [f'pot-{i},Pot {i},Clay pot {i},9.99,Pots\n' for i in range(imports.POOL_THRESHOLD)]
+        self.client.force_login(self.admin)
+        with mock.patch.object(imports, 'ProcessPoolExecutor') as pool:
+            response = self.client.post(reverse('admin:products_product_import'), {
+                'file': SimpleUploadedFile('pots.csv', self.csv(rows)),
+            }, secure=True)
+        pool.assert_not_called()
+        self.assertContains(response, f'{imports.POOL_THRESHOLD} created')
+        self.assertEqual(Product.objects.count(), imports.POOL_THRESHOLD)
+
+    @override_settings(PRODUCT_IMPORT_ADMIN_MAX_BYTES=100)
+    def test_admin_refers_large_files_to_the_command(self):
+        rows = [f'pot-{i},Pot {i},Clay pot,9.99,Pots\n' for i in range(10)]
+        self.client.force_login(self.admin)
+        response = self.client.post(reverse('admin:products_product_import'), {
+            'file': SimpleUploadedFile('pots.csv', self.csv(rows)),
+        }, secure=True)
+        self.assertContains(response, 'manage.py import_products')
+        self.assertFormError(response.context['form'], 'file',
+                             'Files over 100\xa0bytes are imported with manage.py import_products.')
+        self.assertFalse(Product.objects.exists())
+
+
+def png(width, height, color=(200, 50, 50, 128)):
+    buffer = io.BytesIO()
+    Image.new('RGBA', (width, height), color).save(buffer, 'PNG')
+    return buffer.getvalue()
+
+
+@override_settings(CACHES=LOCAL_CACHE, PRODUCT_IMAGE_WIDTHS=[240, 480, 960], PRODUCT_IMAGE_DEFAULT_WIDTH=480)
+class RenditionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Plants', slug='plants')
+
+    def setUp(self):
+        cache.clear()
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        media_root = override_settings(MEDIA_ROOT=media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.storage = renditions.get_storage()
+
+    def create(self, image=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return Product.objects.create(
+                name='Fern', slug='fern', description='', price=Decimal('10.00'), category=self.category,
+                image=image and SimpleUploadedFile('fern.png', image, content_type='image/png'),
+            )
+
+    def test_every_width_in_webp_and_jpeg(self):
+        name = self.storage.save('products/fern.png', ContentFile(png(1200, 600)))
+        metadata = renditions.render(name, self.storage)
+        self.assertEqual((metadata['source'], metadata['width'], metadata['height']), (name, 1200, 600))
+        self.assertEqual(len(metadata['files']), 6)
+        for path in metadata['files']:
+            with self.storage.open(path) as f, Image.open(f) as image:
+                width = int(path.rsplit('-', 1)[1].split('.')[0])
+                self.assertEqual(image.size, (width, width // 2))
+                self.assertEqual(image.format, 'JPEG' if path.endswith('.jpg') else 'WEBP')
+                if image.format == 'JPEG':
+                    # Transparency is laid over white.
+                    self.assertGreater(image.convert('RGB').getpixel((0, 0))[1], 100)
+        self.assertTrue(metadata['src'].endswith('-480.jpg'))
+        self.assertEqual([entry.rsplit(' ', 1)[1] for entry in metadata['srcset']['image/webp'].split(', ')],
+                         ['240w', '480w', '960w'])
+
+    def test_small_images_are_not_upscaled(self):
+        name = self.storage.save('products/fern.png', ContentFile(png(300, 200)))
+        metadata = renditions.render(name, self.storage)
+        self.assertEqual([entry.rsplit(' ', 1)[1] for entry in metadata['srcset']['image/jpeg'].split(', ')],
+                         ['240w', '300w'])
+        self.assertTrue(metadata['src'].endswith('-300.jpg'))
+
+    def test_saving_a_new_image_renders_it(self):
+        product = self.create(png(1200, 600))
+        product.refresh_from_db()
+        old = product.renditions
+        self.assertEqual(old['source'], product.image.name)
+        self.assertTrue(all(self.storage.exists(path) for path in old['files']))
+        response = self.client.get(product.get_absolute_url(), secure=True)
+        self.assertContains(response, f'<img src="{old["src"]}"')
+        self.assertContains(response, '<source type="image/webp"')
+
+        # A new image replaces them; removing it drops them.
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image = SimpleUploadedFile('palm.png', png(600, 600), content_type='image/png')
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.renditions['source'], product.image.name)
+        self.assertFalse(any(self.storage.exists(path) for path in old['files']))
+        files = product.renditions['files']
+        with self.captureOnCommitCallbacks(execute=True):
+            product.image = None
+            product.save()
+        product.refresh_from_db()
+        self.assertEqual(product.renditions, {})
+        self.assertFalse(any(self.storage.exists(path) for path in files))
+
+    def test_original_is_shown_until_renditions_exist(self):
+        with mock.patch.object(renditions, 'update_product'):
+            product = self.create(png(1200, 600))
+        html = Template('{% load product_images %}{% product_image product %}').render(Context({'product': product}))
+        self.assertNotIn('<picture', html)
+        self.assertIn(f'<img src="{product.image.url}"', html)
+
+    def test_products_without_an_image_keep_the_placeholder(self):
+        with mock.patch.object(renditions, 'render') as render:
+            product = self.create()
+        render.assert_not_called()
+        self.assertEqual(Product.objects.get(pk=product.pk).renditions, {})
+        response = self.client.get(product.get_absolute_url(), secure=True)
+        self.assertNotContains(response, '<picture')
+        self.assertNotContains(response, '<img src=""')
+        self.assertContains(response, 'h-96 w-full bg-gray-200')
+
+
+@override_settings(CACHES=LOCAL_CACHE)
+class CatalogConditionalGetTests(ConditionalGetTestsMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Pots', slug='pots')
+        cls.products = Product.objects.bulk_create([
+            Product(name=f'Pot {i}', slug=f'pot-{i}', description='Clay pot', price=Decimal('19.99'),
+                    category=cls.category, stock=10)
+            for i in range(5)
+        ])
+        cls.member = get_user_model().objects.create_user(username='member', password=None, user_type='business')
+
+    def setUp(self):
+        reset_index()
+        # Last-Modified is only known once a catalog change has been recorded.
+        bump_generation()
+        product = self.products[1]
+        self.product = product
+        self.urls = {
+            'product_list': reverse('product_list'),
+            'product_list_by_category': reverse('product_list_by_category', args=[self.category.slug]),
+            'product_detail': reverse('product_detail', args=[product.slug]),
+        }
+
+    def test_guest_pages_revalidate(self):
+        for name, url in self.urls.items():
+            with self.subTest(name):
+                self.assertRevalidates(self.client, url, last_modified_sent=True)
+
+    def test_catalog_change_gives_full_pages(self):
+        etags = {name: self.assertRevalidates(self.client, url, True) for name, url in self.urls.items()}
+        Product.objects.filter(pk=self.product.pk).update(name='Renamed pot')
+        bump_generation()
+        for name, url in self.urls.items():
+            with self.subTest(name):
+                response, _ = self.get(self.client, url, if_none_match=etags[name])
+                self.assertEqual(response.status_code, 200)
+        self.assertContains(self.get(self.client, self.urls['product_detail'])[0], 'Renamed pot')
+
+    def test_cart_change_gives_full_page(self):
+        url = self.urls['product_detail']
+        etag = self.assertRevalidates(self.client, url, True)
+        self.client.post(reverse('add_to_cart', args=[self.product.pk]), {'quantity': 1}, secure=True)
+        self.client.get(reverse('cart'), secure=True)  # Consume the "added" message.
+        response, _ = self.get(self.client, url, if_none_match=etag)
+        self.assertEqual(response.status_code, 200)
+
+    def test_member_pages_revalidate_without_last_modified(self):
+        member = self.client_class()
+        member.force_login(self.member)
+        for name, url in self.urls.items():
+            with self.subTest(name):
+                etag = self.assertRevalidates(member, url, last_modified_sent=False)
+                # Another tier's page isn't valid for a guest.
+                response, _ = self.get(self.client, url, if_none_match=etag)
+                self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CACHES=LOCAL_CACHE, ROOT_URLCONF=__name__)
+class AsyncCatalogViewTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(name='Pots', slug='pots')
+        Product.objects.bulk_create([
+            Product(name=f'Pot {i}', slug=f'pot-{i}', description='Clay pot', price=Decimal('19.99'),
+                    category=category, stock=10)
+            for i in range(5)
+        ])
+
+    def setUp(self):
+        reset_index()
+        bump_generation()
+
+    def get(self, url, **headers):
+        # Through the ASGI handler, like the async client; queries stay on this thread.
+        return async_to_sync(self.async_client.get)(url, secure=True, headers=headers)
+
+    def test_revalidation_runs_no_queries(self):
+        for url in ('/products/', '/products/pot-1/'):
+            with self.subTest(url):
+                first = self.get(url)
+                self.assertContains(first, 'Pot 1')
+                self.assertTrue(first.headers.get('Last-Modified'))
+                with self.assertNumQueries(0):
+                    response = self.get(url, if_none_match=first['ETag'])
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], first['ETag'])
+
+    def test_catalog_change_gives_full_page(self):
+        first = self.get('/products/pot-1/')
+        Product.objects.filter(slug='pot-1').update(name='Renamed pot')
+        bump_generation()
+        self.assertContains(self.get('/products/pot-1/', if_none_match=first['ETag']), 'Renamed pot')
+
+    def test_views_are_async(self):
+        self.assertTrue(views.AsyncProductListView.view_is_async)
+        self.assertTrue(views.AsyncProductDetailView.view_is_async)
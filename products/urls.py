@@ -1,8 +1,18 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+
+def view(name):
+    # The catalog pages have async twins for ASGI deployments.
+    if settings.ASYNC_VIEWS:
+        name = f'Async{name}'
+    return getattr(views, name).as_view()
+
+
 urlpatterns = [
-    path('', views.ProductListView.as_view(), name='product_list'),
-    path('category/<slug:category_slug>/', views.ProductListView.as_view(), name='product_list_by_category'),
-    path('<slug:slug>/', views.ProductDetailView.as_view(), name='product_detail'),
+    path('', view('ProductListView'), name='product_list'),
+    path('category/<slug:category_slug>/', view('ProductListView'), name='product_list_by_category'),
+    path('search/', views.ProductSearchView.as_view(), name='product_search'),
+    path('<slug:slug>/', view('ProductDetailView'), name='product_detail'),
 ]
\ No newline at end of file
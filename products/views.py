@@ -1,24 +1,41 @@
 from django.shortcuts import render, get_object_or_404
 from django.views.generic import ListView, DetailView
-from .models import Category, Product
+from django.utils.functional import SimpleLazyObject
+from marketplace.conditional import AsyncConditionalGetMixin
+from marketplace.pagination import KeysetPaginationMixin
+from .cache import CatalogCacheMixin, CatalogConditionalGetMixin
+from .facets import FILTER_PARAMS, FacetFilters, get_index
+from .models import PRICE_TIER_MULTIPLIERS, Category, Color, Product, Size, get_price_tier
+from .related import related_products
+from .search import search
 
-class ProductListView(ListView):
+class ProductListView(CatalogConditionalGetMixin, CatalogCacheMixin, KeysetPaginationMixin, ListView):
     model = Product
     template_name = 'products/product_list.html'
     context_object_name = 'products'
     paginate_by = 12
+    catalog_cache_params = CatalogCacheMixin.catalog_cache_params + FILTER_PARAMS
     
     def get_queryset(self):
-        queryset = Product.objects.filter(available=True)
+        queryset = Product.objects.filter(available=True).for_listing().with_price_for(self.request.user)
         
+        self.category = None
         category_slug = self.kwargs.get('category_slug')
         if category_slug:
-            category = get_object_or_404(Category, slug=category_slug)
-            queryset = queryset.filter(category=category)
+            self.category = get_object_or_404(Category, slug=category_slug)
+            queryset = queryset.filter(category=self.category)
+
+        # Matches and facet counts come from the in-memory facet index.
+        self.filters = FacetFilters.from_query(self.request.GET, category=self.category and self.category.pk)
+        multiplier = PRICE_TIER_MULTIPLIERS[get_price_tier(self.request.user)]
+        self.facets = get_index().search(self.filters, multiplier)
+        queryset = self.facets.filter(queryset)
         
         sort_by = self.request.GET.get('sort')
         if sort_by == 'latest':
             queryset = queryset.order_by('-created_at')
+        # tier_price is price times a constant, so sorting by the indexed
+        # column gives the same order and lets cursors seek on it.
         elif sort_by == 'price_low_to_high':
             queryset = queryset.order_by('price')
         elif sort_by == 'price_high_to_low':
@@ -27,19 +44,27 @@ class ProductListView(ListView):
             queryset = queryset.order_by('name')
             
         return queryset
+
+    def get_paginator(self, queryset, per_page, **kwargs):
+        return super().get_paginator(queryset, per_page, count=self.facets.total, **kwargs)
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = Category.objects.all()
-        
-        # Process pricing based on user authentication status
-        products_with_prices = []
-        for product in context['products']:
-            products_with_prices.append({
-                'product': product,
-                'price': product.get_price(self.request.user)
-            })
-        context['products_with_prices'] = products_with_prices
+        counts = self.facets.counts
+        context['category'] = self.category
+        context['category_slug'] = self.category and self.category.slug
+        context['categories'] = [
+            (category, counts['category'].get(category.pk, 0)) for category in Category.objects.all()
+        ]
+        context['size_facets'] = [
+            (size, counts['size'].get(size.pk, 0), size.pk in self.filters.sizes) for size in Size.objects.all()
+        ]
+        context['color_facets'] = [
+            (color, counts['color'].get(color.pk, 0), color.pk in self.filters.colors) for color in Color.objects.all()
+        ]
+        context['filters'] = self.filters
+        context['filter_query'] = self.filters.query_string()
+        context['facets'] = self.facets
         
         # Add user type info for price display explanation
         user = self.request.user
@@ -50,11 +75,37 @@ class ProductListView(ListView):
             
         return context
 
-class ProductDetailView(DetailView):
+class ProductSearchView(ListView):
+    model = Product
+    template_name = 'products/search.html'
+    context_object_name = 'products'
+    paginate_by = 12
+
+    def get_queryset(self):
+        self.query = self.request.GET.get('q', '').strip()[:200]
+        if not self.query:
+            return Product.objects.none()
+        queryset = Product.objects.filter(available=True).for_listing().with_price_for(self.request.user)
+        # Ranked ids come from the search index; only the shown page is
+        # loaded, with plain page numbers since the ranking isn't a column.
+        return search(queryset, self.query)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['query'] = self.query
+        context['results_truncated'] = getattr(self.object_list, 'truncated', False)
+        context['user_type'] = get_price_tier(self.request.user)
+        return context
+
+class ProductDetailView(CatalogConditionalGetMixin, CatalogCacheMixin, DetailView):
     model = Product
     template_name = 'products/product_detail.html'
     context_object_name = 'product'
     slug_url_kwarg = 'slug'
+    stock_slug_kwarg = 'slug'
+    
+    def get_queryset(self):
+        return Product.objects.for_detail()
     
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
@@ -70,9 +121,20 @@ class ProductDetailView(DetailView):
         else:
             context['user_type'] = 'guest'
             
-        # Add related products
-        context['related_products'] = Product.objects.filter(
-            category=product.category
-        ).exclude(id=product.id)[:4]
+        # Add related products, only queried when the page isn't cached
+        context['related_products'] = SimpleLazyObject(lambda: related_products(product, user))
         
-        return context
\ No newline at end of file
+        return context
+
+
+# Async variants of the catalog views, routed instead of the ones above when
+# ASYNC_VIEWS is on (see marketplace.asgi). A revalidation is answered with
+# a 304 without handing the request to a thread; building a full page (ORM
+# queries, template rendering) is still synchronous and runs in one.
+
+class AsyncProductListView(AsyncConditionalGetMixin, ProductListView):
+    pass
+
+
+class AsyncProductDetailView(AsyncConditionalGetMixin, ProductDetailView):
+    pass
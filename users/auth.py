@@ -0,0 +1,122 @@
+"""
+Authenticated-user resolution without the per-request session and user queries.
+
+``AuthenticationMiddleware`` loads the session and then the user row on
+every request that looks at ``request.user``, although most pages only need
+to know who is signed in and their ``user_type`` for pricing.
+``SnapshotAuthenticationMiddleware`` replaces it: once Django has resolved
+and verified a session's user the usual way, a slim snapshot of that user is
+cached under the session key, and later requests carrying that session
+cookie get a ``SessionUser`` built from it without touching the database.
+Fields outside the snapshot are loaded on first access, in one query.
+
+Snapshots carry the user's cache version, which is dropped whenever the
+user is saved (password changes included), logs in or logs out, so every
+snapshot of that user stops being used at once. A session given a new key
+(``cycle_key()``) drops the snapshot kept under its old one. Snapshots
+also expire after ``AUTH_SNAPSHOT_TIMEOUT`` seconds; 0 turns them off.
+With a per-process cache (locmem), invalidation only reaches the process
+it happened in, so production should use a shared ``CACHE_URL``.
+"""
+import hashlib
+import uuid
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.middleware import AuthenticationMiddleware
+from django.core.cache import cache
+from django.db import router, transaction
+from django.utils.functional import SimpleLazyObject
+
+from .models import SessionUser
+
+SNAPSHOT_FIELDS = ('id', 'username', 'email', 'user_type', 'is_staff', 'is_superuser', 'is_active')
+
+
+def _session_cache_key(session_key):
+    return f'auth:session:{hashlib.sha256(session_key.encode()).hexdigest()}'
+
+
+def _version_cache_key(user_id):
+    return f'auth:user:{user_id}'
+
+
+def invalidate_user(user_id):
+    """Stop using every cached snapshot of ``user_id`` once the current transaction commits."""
+    transaction.on_commit(partial(cache.delete, _version_cache_key(user_id)))
+
+
+def forget_session(session_key):
+    if session_key:
+        cache.delete(_session_cache_key(session_key))
+
+
+def _from_snapshot(snapshot):
+    fields = [f.attname for f in SessionUser._meta.concrete_fields if f.attname in SNAPSHOT_FIELDS]
+    user = SessionUser.from_db(router.db_for_read(SessionUser), fields, [snapshot[name] for name in fields])
+    user.session_auth_hash = snapshot['hash']
+    return user
+
+
+def _cached_user(session_key):
+    snapshot = cache.get(_session_cache_key(session_key))
+    if snapshot is None:
+        return None
+    if cache.get(_version_cache_key(snapshot['id'])) != snapshot['version']:
+        return None
+    return _from_snapshot(snapshot)
+
+
+def get_user(request):
+    # Shared by request.user and request.auser(), so they resolve once.
+    if not hasattr(request, '_cached_user'):
+        request._cached_user = _resolve_user(request)
+    return request._cached_user
+
+
+def _resolve_user(request):
+    timeout = settings.AUTH_SNAPSHOT_TIMEOUT
+    session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not session_key or timeout <= 0:
+        return auth.get_user(request)
+
+    user = _cached_user(session_key)
+    if user is not None:
+        return user
+
+    # Take the version before the user row is read, so a save that lands in
+    # between leaves the snapshot below already out of date.
+    user_id = request.session.get(auth.SESSION_KEY)
+    version = cache.get_or_set(_version_cache_key(user_id), uuid.uuid4().hex, None) if user_id else None
+    user = auth.get_user(request)
+    if version and user.is_authenticated and str(user.pk) == str(user_id) and request.session.session_key:
+        snapshot = {name: getattr(user, name) for name in SNAPSHOT_FIELDS}
+        snapshot.update(hash=user.get_session_auth_hash(), version=version)
+        cache.set(_session_cache_key(request.session.session_key), snapshot,
+                  min(timeout, request.session.get_expiry_age()))
+    return user
+
+
+async def auser(request):
+    if not hasattr(request, '_acached_user'):
+        request._acached_user = await sync_to_async(get_user)(request)
+    return request._acached_user
+
+
+class SnapshotAuthenticationMiddleware(AuthenticationMiddleware):
+    """``AuthenticationMiddleware`` that serves ``request.user`` from the snapshot cache."""
+
+    def process_request(self, request):
+        super().process_request(request)
+        request.user = SimpleLazyObject(lambda: get_user(request))
+        request.auser = partial(auser, request)
+
+    def process_response(self, request, response):
+        # The old key's session is gone, but its snapshot would still be served.
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        session = getattr(request, 'session', None)
+        if session_key and session is not None and session.session_key != session_key:
+            forget_session(session_key)
+        return response
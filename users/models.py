@@ -17,4 +17,28 @@ class CustomUser(AbstractUser):
     def get_discount_percent(self):
         if self.user_type == 'business':
             return 25  # 25% discount for business users
-        return 0  # No discount for normal users
\ No newline at end of file
+        return 0  # No discount for normal users
+
+
+class SessionUser(CustomUser):
+    """
+    A ``CustomUser`` built from a cached snapshot (see ``users.auth``) with
+    only the fields most pages need loaded. Touching any other field loads
+    the whole row once, so admin and account views work as usual.
+    """
+
+    session_auth_hash = None
+
+    class Meta:
+        proxy = True
+
+    def get_session_auth_hash(self):
+        if self.session_auth_hash and 'password' in self.get_deferred_fields():
+            return self.session_auth_hash
+        return super().get_session_auth_hash()
+
+    def refresh_from_db(self, using=None, fields=None):
+        deferred = self.get_deferred_fields()
+        if fields is not None and deferred.intersection(fields):
+            fields = list(deferred.union(fields))
+        super().refresh_from_db(using, fields)
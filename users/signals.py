@@ -0,0 +1,24 @@
+from django.contrib.auth.signals import user_logged_in, user_logged_out
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .auth import forget_session, invalidate_user
+from .models import CustomUser
+
+
+@receiver(post_save)
+@receiver(post_delete)
+def invalidate_user_snapshots(sender, instance, **kwargs):
+    # Not limited by sender: saving a SessionUser sends its proxy class.
+    if isinstance(instance, CustomUser):
+        invalidate_user(instance.pk)
+
+
+@receiver(user_logged_in)
+@receiver(user_logged_out)
+def invalidate_session_snapshots(sender, request, user, **kwargs):
+    if user is not None:
+        invalidate_user(user.pk)
+    session = getattr(request, 'session', None)
+    if session is not None:
+        forget_session(session.session_key)
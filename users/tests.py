@@ -0,0 +1,117 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.db import connection
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from marketplace.testing import LOCAL_CACHE
+from .auth import SnapshotAuthenticationMiddleware, get_user
+from .models import SessionUser
+
+
+@override_settings(CACHES=LOCAL_CACHE, AUTH_SNAPSHOT_TIMEOUT=60)
+class SnapshotAuthenticationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user(username='shopper', email='shopper@example.com',
+                                                        password=None, user_type='business')
+
+    def setUp(self):
+        cache.clear()
+
+    def login(self, client=None):
+        client = client or self.client
+        # Invalidation waits for the commit.
+        with self.captureOnCommitCallbacks(execute=True):
+            client.force_login(self.user)
+        return client.session.session_key
+
+    def request(self, session_key):
+        request = RequestFactory().get('/')
+        request.COOKIES[settings.SESSION_COOKIE_NAME] = session_key
+        request.session = SessionStore(session_key)
+        return request
+
+    def user_for(self, session_key):
+        """The request's user, and whether resolving it read the database."""
+        with CaptureQueriesContext(connection) as queries:
+            user = get_user(self.request(session_key))
+        return user, bool(queries)
+
+    def assertSnapshot(self, session_key):
+        user, queried = self.user_for(session_key)
+        self.assertFalse(queried)
+        self.assertIsInstance(user, SessionUser)
+        self.assertEqual(user.pk, self.user.pk)
+        return user
+
+    def assertNoSnapshot(self, session_key):
+        user, queried = self.user_for(session_key)
+        self.assertTrue(queried)
+        return user
+
+    def test_snapshot_serves_later_requests(self):
+        session_key = self.login()
+        self.assertTrue(self.user_for(session_key)[1])
+        user = self.assertSnapshot(session_key)
+        self.assertEqual((user.username, user.user_type), ('shopper', 'business'))
+        # Anything else is loaded once, when first used.
+        with self.assertNumQueries(1):
+            self.assertEqual((user.date_joined, user.address), (self.user.date_joined, None))
+
+    @override_settings(AUTH_SNAPSHOT_TIMEOUT=0)
+    def test_snapshots_can_be_turned_off(self):
+        session_key = self.login()
+        self.user_for(session_key)
+        self.assertNoSnapshot(session_key)
+
+    def test_saving_the_user_drops_its_snapshots(self):
+        session_key = self.login()
+        self.user_for(session_key)
+        user = self.assertSnapshot(session_key)
+        # Saved through the snapshot itself too, which sends the proxy class.
+        for changed in (self.user, user):
+            with self.subTest(model=type(changed).__name__):
+                with self.captureOnCommitCallbacks(execute=True):
+                    changed.user_type = 'normal' if changed.user_type == 'business' else 'business'
+                    changed.save()
+                self.assertEqual(self.assertNoSnapshot(session_key).user_type, changed.user_type)
+                self.assertSnapshot(session_key)
+
+    def test_deleting_the_user_drops_its_snapshots(self):
+        session_key = self.login()
+        self.user_for(session_key)
+        with self.captureOnCommitCallbacks(execute=True):
+            get_user_model().objects.get(pk=self.user.pk).delete()
+        self.assertFalse(self.assertNoSnapshot(session_key).is_authenticated)
+
+    def test_logging_in_elsewhere_drops_every_snapshot(self):
+        session_key = self.login()
+        self.user_for(session_key)
+        self.login(self.client_class())
+        self.assertNoSnapshot(session_key)
+
+    def test_logging_out_drops_the_sessions_snapshot(self):
+        session_key = self.login()
+        self.user_for(session_key)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.logout()
+        self.assertFalse(self.assertNoSnapshot(session_key).is_authenticated)
+
+    def test_new_session_key_drops_the_old_keys_snapshot(self):
+        session_key = self.login()
+        self.user_for(session_key)
+
+        def view(request):
+            request.session.cycle_key()
+            return HttpResponse()
+
+        request = self.request(session_key)
+        SnapshotAuthenticationMiddleware(view)(request)
+        new_key = request.session.session_key
+        self.assertNotEqual(new_key, session_key)
+        self.assertFalse(self.assertNoSnapshot(session_key).is_authenticated)
+        self.assertEqual(self.assertNoSnapshot(new_key).pk, self.user.pk)